@@ -1,22 +1,40 @@
 # Register your models here.
 from django.contrib import admin
-from .models import House, Booking, Payment
+from .models import House, Booking, Payment, MpesaCallback
+from .search import get_backend, query_terms
 
 @admin.register(House)
 class HouseAdmin(admin.ModelAdmin):
-    list_display = ('title', 'location', 'price', 'status')
+    list_display = ('title', 'location', 'price', 'status', 'latitude', 'longitude')
     list_filter = ('status', 'location')
     search_fields = ('title', 'location')
 
+    def get_search_results(self, request, queryset, search_term):
+        # Use the full-text index instead of LIKE '%term%' scans; a term with
+        # no words (only punctuation) would be an empty MATCH, so leave it to Django
+        if not query_terms(search_term):
+            return super().get_search_results(request, queryset, search_term)
+        hits = get_backend().search_ids(search_term, limit=None)
+        return queryset.filter(pk__in=[house_id for house_id, _, _ in hits]), False
+
 @admin.register(Booking)
 class BookingAdmin(admin.ModelAdmin):
     list_display = ('user', 'house', 'phone_number', 'booking_date')
+    list_select_related = ('user', 'house')
     search_fields = ('user__username', 'house__title')
 
 @admin.register(Payment)
 class PaymentAdmin(admin.ModelAdmin):
     list_display = ('id', 'booking', 'amount', 'status', 'created_at')
+    # Booking.__str__ reads the booking's user and house
+    list_select_related = ('booking__user', 'booking__house')
     list_filter = ('status', 'created_at')
     search_fields = ('booking__user__username', 'phone_number', 'mpesa_receipt_number')
     readonly_fields = ('created_at', 'updated_at', 'checkout_request_id')
 
+
+
+@admin.register(MpesaCallback)
+class MpesaCallbackAdmin(admin.ModelAdmin):
+    list_display = ('id', 'received_at', 'processed_at', 'attempts', 'error')
+    readonly_fields = ('payload', 'received_at', 'processed_at', 'attempts', 'error')
@@ -0,0 +1,47 @@
+"""
+Cached User Lookups
+Authentication backend that keeps request.user in the cache, so a
+logged-in request doesn't fetch its auth_user row every time
+
+The user is cached whole, password hash included, so Django's session
+hash check still logs out other sessions after a password change. Saving
+or deleting a user forgets the cached copy (see housesApp.signals);
+bulk QuerySet.update() on users bypasses that and is seen only once
+USER_CACHE_TIMEOUT runs out.
+
+Forgetting only reaches the cache this process uses, so every worker
+must share it: the SESSION_PROFILES that use this backend require Redis.
+"""
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+
+
+def user_cache_key(user_id):
+    return f'auth:user:{user_id}'
+
+
+def forget_user(user_id):
+    cache.delete(user_cache_key(user_id))
+
+
+class CachedModelBackend(ModelBackend):
+    """ModelBackend whose get_user reads through the cache"""
+
+    def get_user(self, user_id):
+        key = user_cache_key(user_id)
+        user = cache.get(key)
+        if user is None:
+            user = super().get_user(user_id)
+            if user is not None:
+                cache.set(key, user, getattr(settings, 'USER_CACHE_TIMEOUT', 300))
+        return user if user is not None and self.user_can_authenticate(user) else None
+
+    async def aget_user(self, user_id):
+        key = user_cache_key(user_id)
+        user = await cache.aget(key)
+        if user is None:
+            user = await super().aget_user(user_id)
+            if user is not None:
+                await cache.aset(key, user, getattr(settings, 'USER_CACHE_TIMEOUT', 300))
+        return user if user is not None and self.user_can_authenticate(user) else None
@@ -0,0 +1,42 @@
+"""
+House Reservation
+Books a house so that exactly one tenant can win it
+"""
+from django.db import transaction
+
+from .caching import invalidate_house
+from .models import House
+from .rollups import record_house_status
+
+
+def reserve_house(house, booking):
+    """
+    Atomically claim a vacant house and save the booking for it
+
+    The claim is a single conditional UPDATE ... WHERE status = 'vacant',
+    so when several tenants race for the same house the database lets
+    exactly one of them flip the status; everyone else updates zero rows.
+    Only the status column of the house is written.
+
+    Args:
+        house: the House being booked
+        booking: unsaved Booking with user and phone_number set
+
+    Returns:
+        True if the booking was saved, False if the house was already taken
+    """
+    with transaction.atomic():
+        claimed = House.objects.filter(
+            pk=house.pk, status=House.STATUS_VACANT
+        ).update(status=House.STATUS_OCCUPIED)
+        if not claimed:
+            return False
+
+        booking.house = house
+        booking.save()
+        record_house_status(house.pk, House.STATUS_OCCUPIED)
+        # The UPDATE skips post_save, so retire cached pages here
+        transaction.on_commit(lambda: invalidate_house(house.pk))
+
+    house.status = House.STATUS_OCCUPIED
+    return True
@@ -0,0 +1,143 @@
+"""
+Listing Cache Versioning
+Version counters that move whenever a house changes, so cached listing
+data and rendered pages can be keyed on them instead of being deleted
+key by key
+
+A version is the time of the last change in microseconds, which also
+gives pages their Last-Modified header.
+"""
+import hashlib
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+from nyumbaProject.replicas import replica_may_lag
+
+
+LISTINGS_VERSION_KEY = 'listings:version'
+
+
+def house_version_key(house_id):
+    return f'house:{house_id}:version'
+
+
+def _now_version():
+    return time.time_ns() // 1000
+
+
+def get_version(key):
+    version = cache.get(key)
+    if version is None:
+        # Unknown or evicted: start from now, which is newer than any
+        # version already baked into cached keys
+        cache.add(key, _now_version(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+async def aget_version(key):
+    version = await cache.aget(key)
+    if version is None:
+        await cache.aadd(key, _now_version(), timeout=None)
+        version = await cache.aget(key)
+    return version
+
+
+def bump_version(key):
+    """Move a version forward, retiring everything cached under the old one"""
+    current = cache.get(key) or 0
+    cache.set(key, max(_now_version(), current + 1), timeout=None)
+
+
+def get_listings_version():
+    return get_version(LISTINGS_VERSION_KEY)
+
+
+async def aget_listings_version():
+    return await aget_version(LISTINGS_VERSION_KEY)
+
+
+def bump_listings_version():
+    """Invalidate every cached listing entry at once"""
+    bump_version(LISTINGS_VERSION_KEY)
+
+
+def invalidate_house(house_id):
+    """Retire the cached detail page for one house and every listing it appears in"""
+    bump_version(house_version_key(house_id))
+    bump_listings_version()
+
+
+def filter_signature(filters, ignore=('after', 'limit')):
+    """Stable short hash of a filter dict, independent of key order"""
+    items = sorted(
+        (key, str(value)) for key, value in filters.items()
+        if key not in ignore and value not in (None, '')
+    )
+    return hashlib.sha1(repr(items).encode()).hexdigest()[:16]
+
+
+def query_signature(params):
+    """Stable short hash of a QueryDict, keeping repeated keys"""
+    return hashlib.sha1(repr(sorted(params.lists())).encode()).hexdigest()[:16]
+
+
+def versioned_page(page_key):
+    """
+    Cache an async view's rendered response under a version counter
+
+    Args:
+        page_key: function(request, *args, **kwargs) returning
+                  (cache key, version key) for the page
+
+    Responses carry an ETag and Last-Modified derived from the version,
+    so browsers and proxies revalidate with a 304 instead of downloading
+    the page again. Requests with flash messages waiting in the messages
+    cookie skip the cache, since those pages show per-visitor content, as
+    do pages read from a replica that may not have the latest change yet.
+    """
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD') or CookieStorage.cookie_name in request.COOKIES:
+                response = await view(request, *args, **kwargs)
+                patch_cache_control(response, private=True)
+                return response
+
+            key, version_key = page_key(request, *args, **kwargs)
+            version = await aget_version(version_key)
+            if replica_may_lag(version):
+                response = await view(request, *args, **kwargs)
+                patch_cache_control(response, no_cache=True)
+                return response
+            etag = '"%s"' % hashlib.sha1(f'{key}:{version}'.encode()).hexdigest()[:20]
+            last_modified = version // 1_000_000
+
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            if response is None:
+                cache_key = f'page:{key}:{version}'
+                cached = await cache.aget(cache_key)
+                if cached is not None:
+                    response = HttpResponse(cached['content'], content_type=cached['content_type'])
+                else:
+                    response = await view(request, *args, **kwargs)
+                    if response.status_code != 200:
+                        return response
+                    await cache.aset(cache_key, {
+                        'content': response.content,
+                        'content_type': response['Content-Type'],
+                    }, getattr(settings, 'PAGE_CACHE_TIMEOUT', 600))
+
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(last_modified)
+            patch_cache_control(response, no_cache=True)
+            return response
+        return wrapper
+    return decorator
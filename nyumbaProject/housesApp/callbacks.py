@@ -0,0 +1,230 @@
+"""
+M-Pesa Callback Inbox Worker
+Applies stored callback payloads to payments in idempotent batches
+"""
+import json
+import threading
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .dispatch import get_executor, _run_job
+from .events import publish_payments
+from .models import MpesaCallback, Payment
+from .rollups import record_settled_payments
+
+
+# A callback can beat the dispatcher recording its CheckoutRequestID; keep
+# retrying one with no matching payment until it is this old
+ORPHAN_AFTER = timedelta(minutes=10)
+
+# Daraja reports TransactionDate as a naive yyyymmddHHMMSS in Kenyan time
+DARAJA_TIMEZONE = ZoneInfo('Africa/Nairobi')
+
+# Redrain callbacks still waiting for their payment after 2, 4, 8... seconds,
+# and at least once a minute until ORPHAN_AFTER gives up on them
+RETRY_DELAY_MAX = 60
+
+_drain_scheduled = threading.Lock()
+_retry_scheduled = threading.Lock()
+
+
+def parse_callback(payload):
+    """
+    Extract the fields we store from a raw stkCallback payload
+
+    Returns:
+        dict with checkout_request_id, result_code, result_desc,
+        mpesa_receipt_number and transaction_date, or None if malformed
+    """
+    try:
+        data = json.loads(payload)
+        result = data['Body']['stkCallback']
+    except (ValueError, KeyError, TypeError):
+        return None
+
+    items = {}
+    for item in result.get('CallbackMetadata', {}).get('Item', []):
+        items[item.get('Name')] = item.get('Value')
+
+    transaction_date = None
+    if items.get('TransactionDate'):
+        try:
+            transaction_date = datetime.strptime(
+                str(items['TransactionDate']), '%Y%m%d%H%M%S'
+            ).replace(tzinfo=DARAJA_TIMEZONE)
+        except ValueError:
+            pass
+
+    return {
+        'checkout_request_id': result.get('CheckoutRequestID'),
+        'result_code': result.get('ResultCode'),
+        'result_desc': result.get('ResultDesc'),
+        'mpesa_receipt_number': items.get('MpesaReceiptNumber'),
+        'transaction_date': transaction_date,
+    }
+
+
+def apply_pending_callbacks(batch_size=500, after_id=0):
+    """
+    Apply one batch of unprocessed callbacks with ids above after_id
+
+    Pending payments are locked as they are read and only written back
+    while still pending, so a payment moves out of pending once even when
+    a duplicate callback sits in another worker's batch or reconcile gets
+    there first; only the writes that took effect reach the rollups and
+    watching browsers. A receipt number that is already recorded is never
+    written twice.
+
+    Returns:
+        (number of callbacks read, id of the last one)
+    """
+    with transaction.atomic():
+        callbacks = list(
+            MpesaCallback.objects.select_for_update(skip_locked=True)
+            .filter(processed_at__isnull=True, id__gt=after_id)
+            .order_by('id')[:batch_size]
+        )
+        if not callbacks:
+            return 0, after_id
+
+        parsed = {callback.id: parse_callback(callback.payload) for callback in callbacks}
+        checkout_ids = {data['checkout_request_id'] for data in parsed.values() if data}
+        payments = _pending_payments(checkout_ids)
+        settled = set(
+            Payment.objects.filter(checkout_request_id__in=checkout_ids - payments.keys())
+            .values_list('checkout_request_id', flat=True)
+        )
+        receipts = {
+            data['mpesa_receipt_number'] for data in parsed.values()
+            if data and data['mpesa_receipt_number']
+        }
+        seen_receipts = set(
+            Payment.objects.filter(mpesa_receipt_number__in=receipts).values_list('mpesa_receipt_number', flat=True)
+        )
+
+        now = timezone.now()
+        changed = {}
+        done, retry = [], []
+        for callback in callbacks:
+            data = parsed[callback.id]
+            if data is None:
+                callback.error = 'Malformed payload'
+                done.append(callback)
+                continue
+
+            if data['checkout_request_id'] in settled:
+                done.append(callback)  # duplicate callback, already applied
+                continue
+            payment = payments.get(data['checkout_request_id'])
+            if payment is None:
+                callback.attempts += 1
+                if now - callback.received_at > ORPHAN_AFTER:
+                    callback.error = 'Payment not found'
+                    done.append(callback)
+                else:
+                    retry.append(callback)
+                continue
+
+            done.append(callback)
+            if payment.id in changed:
+                continue  # duplicate within this batch
+
+            receipt = data['mpesa_receipt_number']
+            if data['result_code'] == 0 and receipt not in seen_receipts:
+                payment.status = Payment.STATUS_COMPLETED
+                payment.mpesa_receipt_number = receipt
+                payment.transaction_date = data['transaction_date']
+                if receipt:
+                    seen_receipts.add(receipt)
+            elif data['result_code'] == 0:
+                callback.error = 'Duplicate receipt number'
+                continue
+            else:
+                payment.status = Payment.STATUS_FAILED
+            payment.updated_at = now
+            changed[payment.id] = payment
+
+        # Conditional on still pending; the rows this batch moved are the
+        # ones now stamped with its updated_at
+        Payment.objects.filter(status=Payment.STATUS_PENDING).bulk_update(
+            changed.values(),
+            ['status', 'mpesa_receipt_number', 'transaction_date', 'updated_at'],
+            batch_size=batch_size
+        )
+        applied = set(Payment.objects.filter(id__in=changed, updated_at=now).values_list('id', flat=True))
+        changed = [payment for payment in changed.values() if payment.id in applied]
+        record_settled_payments([payment.id for payment in changed])
+        transaction.on_commit(lambda: publish_payments(changed))
+        for callback in done:
+            callback.processed_at = now
+        MpesaCallback.objects.bulk_update(done + retry, ['processed_at', 'attempts', 'error'], batch_size=batch_size)
+
+    return len(callbacks), callbacks[-1].id
+
+
+def _pending_payments(checkout_ids):
+    """Pending payments by checkout request id, locked until the batch commits"""
+    return {
+        payment.checkout_request_id: payment for payment in
+        Payment.objects.select_for_update()
+        .filter(checkout_request_id__in=checkout_ids, status=Payment.STATUS_PENDING)
+        .order_by('id')
+    }
+
+
+def drain_callbacks(batch_size=500):
+    """
+    Apply every unprocessed callback once, batch by batch
+
+    Callbacks still waiting for their payment are left for the next drain.
+
+    Returns:
+        number of callbacks read
+    """
+    total, after_id = 0, 0
+    while True:
+        read, after_id = apply_pending_callbacks(batch_size, after_id)
+        total += read
+        if read < batch_size:
+            return total
+
+
+def schedule_drain():
+    """
+    Drain the inbox on the background dispatcher
+
+    At most one drain is queued at a time. While callbacks are still
+    waiting for their payment, another drain follows after a backoff, so
+    they don't depend on a later callback arriving. Set
+    MPESA_CALLBACK_AUTO_APPLY = False when a dedicated `manage.py
+    process_callbacks` worker runs.
+    """
+    if not getattr(settings, 'MPESA_CALLBACK_AUTO_APPLY', True):
+        return
+    if not _drain_scheduled.acquire(blocking=False):
+        return
+    get_executor().submit(_run_job, _scheduled_drain)
+
+
+def _scheduled_drain():
+    # Release first so callbacks arriving mid-drain schedule the next one
+    _drain_scheduled.release()
+    drain_callbacks()
+    attempts = (
+        MpesaCallback.objects.filter(processed_at__isnull=True)
+        .aggregate(attempts=Max('attempts'))['attempts']
+    )
+    if attempts and _retry_scheduled.acquire(blocking=False):
+        timer = threading.Timer(min(2 ** attempts, RETRY_DELAY_MAX), _retry_drain)
+        timer.daemon = True
+        timer.start()
+
+
+def _retry_drain():
+    _retry_scheduled.release()
+    schedule_drain()
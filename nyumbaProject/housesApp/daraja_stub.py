@@ -0,0 +1,239 @@
+"""
+Local M-Pesa Daraja Stub Server
+Emulates the Daraja endpoints used by MpesaService for benchmarks and load tests
+
+Besides answering OAuth, STK push and STK query requests, the stub plays
+the customer's phone: a while after each accepted push it POSTs a
+realistic stkCallback to the push's CallBackURL, like Safaricom does.
+"""
+import heapq
+import json
+import random
+import threading
+import time
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+STK_PUSH_PATH = '/mpesa/stkpush/v1/processrequest'
+STK_QUERY_PATH = '/mpesa/stkpushquery/v1/query'
+
+# ResultCodes the stub reports for customers who don't pay
+FAILURE_RESULTS = [
+    (1032, 'Request cancelled by user'),
+    (1037, 'DS timeout user cannot be reached'),
+    (1, 'The balance is insufficient for the transaction'),
+]
+
+
+class DarajaStubHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so clients can keep connections alive between requests
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; don't let Nagle delay the body
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def do_GET(self):
+        if self.path.startswith('/oauth/v1/generate'):
+            self.server.simulate_latency()
+            return self.send_json({'access_token': uuid.uuid4().hex, 'expires_in': '3599'})
+        self.send_json({'errorMessage': 'Not found'}, status=404)
+
+    def do_POST(self):
+        if self.path == STK_PUSH_PATH:
+            payload = self.read_json()
+            self.server.simulate_latency()
+            if self.server.should_fail():
+                return self.send_json({
+                    'requestId': uuid.uuid4().hex[:12],
+                    'errorCode': '500.001.1001',
+                    'errorMessage': 'Unable to lock subscriber, a transaction is already in process for the current subscriber',
+                }, status=500)
+            return self.send_json(self.server.accept_push(payload))
+
+        if self.path == STK_QUERY_PATH:
+            payload = self.read_json()
+            self.server.simulate_latency()
+            return self.send_json(*self.server.query(payload.get('CheckoutRequestID')))
+
+        self.send_json({'errorMessage': 'Not found'}, status=404)
+
+
+class DarajaStubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, failure_rate=0.0,
+                 callback_delay=None, decline_rate=0.0, callback_url=None, seed=None):
+        """
+        Args:
+            host: interface to bind
+            port: port to bind, 0 picks a free one
+            latency: seconds added to every Daraja response
+            jitter: up to this many extra seconds, uniformly random
+            failure_rate: fraction of STK pushes rejected with an HTTP 500
+            callback_delay: seconds between an accepted push and its
+                            callback; None sends no callbacks
+            decline_rate: fraction of callbacks reporting a failed payment
+            callback_url: POST callbacks here instead of the push's CallBackURL
+            seed: make failures and declines reproducible
+        """
+        super().__init__((host, port), DarajaStubHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.callback_delay = callback_delay
+        self.decline_rate = decline_rate
+        self.callback_url = callback_url
+        self.connections = 0
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        # CheckoutRequestID -> result dict once the "customer" has answered
+        self.transactions = {}
+        self.callback_latencies = []
+        self.callbacks_failed = 0
+
+        self._due = []
+        self._due_ready = threading.Condition(self._lock)
+        self._senders = ThreadPoolExecutor(max_workers=16, thread_name_prefix='daraja-callback')
+        self._stopping = False
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def get_request(self):
+        # Count accepted TCP connections so benchmarks can show connection reuse
+        self.connections += 1
+        return super().get_request()
+
+    def simulate_latency(self):
+        delay = self.latency
+        if self.jitter:
+            with self._lock:
+                delay += self._random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+    def should_fail(self):
+        with self._lock:
+            return self._random.random() < self.failure_rate
+
+    def accept_push(self, payload):
+        """Record an accepted STK push, schedule its callback and build the response"""
+        merchant_id = f'{uuid.uuid4().hex[:5]}-{uuid.uuid4().hex[:8]}'
+        checkout_id = f'ws_CO_{datetime.now():%d%m%Y%H%M%S}{uuid.uuid4().hex[:12]}'
+        with self._lock:
+            self.transactions[checkout_id] = None
+            if self.callback_delay is not None:
+                callback = self._build_callback(merchant_id, checkout_id, payload)
+                url = self.callback_url or payload.get('CallBackURL')
+                heapq.heappush(self._due, (time.monotonic() + self.callback_delay, checkout_id, url, callback))
+                self._due_ready.notify()
+        return {
+            'MerchantRequestID': merchant_id,
+            'CheckoutRequestID': checkout_id,
+            'ResponseCode': '0',
+            'ResponseDescription': 'Success. Request accepted for processing',
+            'CustomerMessage': 'Success. Request accepted for processing',
+        }
+
+    def _build_callback(self, merchant_id, checkout_id, payload):
+        # Caller holds self._lock
+        result = {'MerchantRequestID': merchant_id, 'CheckoutRequestID': checkout_id}
+        if self._random.random() < self.decline_rate:
+            result['ResultCode'], result['ResultDesc'] = self._random.choice(FAILURE_RESULTS)
+        else:
+            result['ResultCode'] = 0
+            result['ResultDesc'] = 'The service request is processed successfully.'
+            result['CallbackMetadata'] = {'Item': [
+                {'Name': 'Amount', 'Value': payload.get('Amount')},
+                {'Name': 'MpesaReceiptNumber', 'Value': uuid.uuid4().hex[:10].upper()},
+                {'Name': 'Balance'},
+                {'Name': 'TransactionDate', 'Value': int(f'{datetime.now():%Y%m%d%H%M%S}')},
+                {'Name': 'PhoneNumber', 'Value': int(payload.get('PhoneNumber') or 0)},
+            ]}
+        return {'Body': {'stkCallback': result}}
+
+    def query(self, checkout_id):
+        """(body, status) for an STK query, mirroring Daraja's answers"""
+        with self._lock:
+            known = checkout_id in self.transactions
+            result = self.transactions.get(checkout_id)
+        if not known:
+            return {'requestId': uuid.uuid4().hex[:12], 'errorCode': '400.002.02',
+                    'errorMessage': 'Bad Request - Invalid CheckoutRequestID'}, 400
+        if result is None:
+            return {'requestId': uuid.uuid4().hex[:12], 'errorCode': '500.001.1001',
+                    'errorMessage': 'The transaction is being processed'}, 500
+        return {
+            'ResponseCode': '0',
+            'ResponseDescription': 'The service request has been accepted successsfully',
+            'MerchantRequestID': result['MerchantRequestID'],
+            'CheckoutRequestID': checkout_id,
+            'ResultCode': str(result['ResultCode']),
+            'ResultDesc': result['ResultDesc'],
+        }, 200
+
+    def _run_callbacks(self):
+        with self._lock:
+            while not self._stopping:
+                if not self._due:
+                    self._due_ready.wait()
+                    continue
+                wait = self._due[0][0] - time.monotonic()
+                if wait > 0:
+                    self._due_ready.wait(wait)
+                    continue
+                _, checkout_id, url, callback = heapq.heappop(self._due)
+                self.transactions[checkout_id] = callback['Body']['stkCallback']
+                self._senders.submit(self._send_callback, url, callback)
+
+    def _send_callback(self, url, callback):
+        request = urllib.request.Request(
+            url, data=json.dumps(callback).encode(), headers={'Content-Type': 'application/json'}
+        )
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                response.read()
+        except Exception as e:
+            with self._lock:
+                self.callbacks_failed += 1
+            print(f"Daraja stub callback to {url} failed: {e}")
+            return
+        with self._lock:
+            self.callback_latencies.append(time.perf_counter() - started)
+
+    def start(self):
+        """Serve from a daemon thread and return self"""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        threading.Thread(target=self._run_callbacks, name='daraja-callbacks', daemon=True).start()
+        return self
+
+    def stop(self):
+        with self._lock:
+            self._stopping = True
+            self._due_ready.notify()
+        self.shutdown()
+        self.server_close()
+        self._senders.shutdown(wait=False, cancel_futures=True)
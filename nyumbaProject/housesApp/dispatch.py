@@ -0,0 +1,288 @@
+"""
+Background Dispatcher
+Runs slow outbound work (M-Pesa STK pushes) off the request cycle
+"""
+import asyncio
+import contextvars
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.redis import RedisCache
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .events import publish_payments
+from .models import Payment
+from .mpesa_service import httpx, mpesa_service
+from .rollups import record_settled_payments
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_loop = None
+_slots = None
+
+# KEYS[1] sorted set of push slots scored by when they were taken; ARGV limit,
+# now, slot timeout in seconds, new member. Returns 1 if a slot was taken.
+RESERVE_SCRIPT = """
+local limit, now, timeout = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - timeout)
+if redis.call('ZCARD', KEYS[1]) >= limit then return 0 end
+redis.call('ZADD', KEYS[1], now, ARGV[4])
+redis.call('PEXPIRE', KEYS[1], math.ceil(timeout * 1000))
+return 1
+"""
+
+
+def get_executor():
+    """Process-wide thread pool, created on first use so forked workers get their own"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'DISPATCH_WORKERS', 8),
+                    thread_name_prefix='dispatch'
+                )
+    return _executor
+
+
+def _run_job(func, *args):
+    # Worker threads hold their own DB connections; drop stale ones around each job
+    close_old_connections()
+    try:
+        return func(*args)
+    except Exception as e:
+        print(f"Dispatch error in {func.__name__}: {e}")
+    finally:
+        close_old_connections()
+
+
+def get_event_loop():
+    """
+    Process-wide event loop running on a daemon thread
+
+    Coroutines queued here wait on Daraja without holding a thread each,
+    so thousands of STK pushes can be in flight at once.
+    """
+    global _loop
+    if _loop is None:
+        with _executor_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='dispatch-async', daemon=True).start()
+                _loop = loop
+    return _loop
+
+
+async def _arun_job(func, *args):
+    try:
+        return await func(*args)
+    except Exception as e:
+        print(f"Dispatch error in {func.__name__}: {e}")
+    finally:
+        await sync_to_async(close_old_connections)()
+
+
+def submit(func, *args):
+    """
+    Queue func(*args) on the background pool once the current transaction commits
+
+    With DISPATCH_EAGER = True (used by tests) the job runs inline instead.
+    """
+    if getattr(settings, 'DISPATCH_EAGER', False):
+        transaction.on_commit(lambda: func(*args))
+    else:
+        transaction.on_commit(lambda: get_executor().submit(_run_job, func, *args))
+
+
+def send_stk_push(payment_id):
+    """Send the STK push for a pending payment and record Daraja's answer"""
+    payment = Payment.objects.select_related('booking').get(pk=payment_id)
+    if payment.status != Payment.STATUS_PENDING or payment.checkout_request_id:
+        return
+
+    result = mpesa_service.initiate_stk_push(
+        phone_number=payment.phone_number,
+        amount=payment.amount,
+        house_id=payment.booking.house_id,
+        user_id=payment.booking.user_id
+    )
+
+    _save_push_result(payment_id, result)
+
+
+async def asend_stk_push(payment_id):
+    """Async counterpart of send_stk_push using httpx and the async ORM"""
+    payment = await Payment.objects.select_related('booking').aget(pk=payment_id)
+    if payment.status != Payment.STATUS_PENDING or payment.checkout_request_id:
+        return
+
+    result = await mpesa_service.ainitiate_stk_push(
+        phone_number=payment.phone_number,
+        amount=payment.amount,
+        house_id=payment.booking.house_id,
+        user_id=payment.booking.user_id
+    )
+
+    await sync_to_async(_save_push_result)(payment_id, result)
+
+
+def _save_push_result(payment_id, result):
+    """Record Daraja's answer on a payment that is still pending"""
+    fields = _push_result_fields(payment_id, result)
+    with transaction.atomic():
+        updated = Payment.objects.filter(pk=payment_id, status=Payment.STATUS_PENDING).update(**fields)
+        if updated and 'status' in fields:
+            record_settled_payments([payment_id])
+            transaction.on_commit(lambda: publish_payments([Payment(pk=payment_id, status=fields['status'])]))
+
+
+def _push_result_fields(payment_id, result):
+    """Payment fields to write for an STK push result"""
+    if result['status'] == 'success':
+        return {
+            'checkout_request_id': result.get('checkout_request_id'),
+            'merchant_request_id': result.get('merchant_request_id'),
+            'updated_at': timezone.now(),
+        }
+    print(f"STK push failed for payment {payment_id}: {result.get('message')}")
+    return {'status': Payment.STATUS_FAILED, 'updated_at': timezone.now()}
+
+
+class LocalSlots:
+    """Push slots counted in this process's memory"""
+    blocking = False
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, limit):
+        with self._lock:
+            if self.count >= limit:
+                return False
+            self.count += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.count = max(0, self.count - 1)
+
+
+class CacheSlots:
+    """
+    Push slots in the Redis cache, so the cap holds across every worker process
+
+    Each slot is a member of one sorted set, scored by when it was taken.
+    Slots are interchangeable, so a release drops the oldest one; a slot
+    older than MPESA_PUSH_SLOT_TIMEOUT belonged to a worker that died
+    mid-push and is swept on the next reserve.
+    """
+    blocking = True
+    key = 'dispatch:push_slots'
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.fallback = LocalSlots()
+        self._script = None
+
+    def reserve(self, limit):
+        key = self.cache.make_and_validate_key(self.key)
+        timeout = getattr(settings, 'MPESA_PUSH_SLOT_TIMEOUT', 60)
+        try:
+            client = self.cache._cache.get_client(key, write=True)
+            if self._script is None:
+                self._script = client.register_script(RESERVE_SCRIPT)
+            return bool(self._script(keys=[key], args=[limit, time.time(), timeout, uuid.uuid4().hex], client=client))
+        except Exception as e:
+            print(f"Push slot check in Redis failed, counting locally: {e}")
+            return self.fallback.reserve(limit)
+
+    def release(self):
+        key = self.cache.make_and_validate_key(self.key)
+        try:
+            self.cache._cache.get_client(key, write=True).zpopmin(key)
+        except Exception as e:
+            print(f"Push slot release in Redis failed: {e}")
+            self.fallback.release()
+
+
+def get_push_slots():
+    """Process-wide push slots: in Redis when it is the cache, else in memory"""
+    global _slots
+    if _slots is None:
+        with _executor_lock:
+            if _slots is None:
+                default = caches['default']
+                _slots = CacheSlots(default) if isinstance(default, RedisCache) else LocalSlots()
+    return _slots
+
+
+def reserve_push():
+    """
+    Claim one of the MPESA_MAX_INFLIGHT_PUSHES push slots
+
+    With the Redis cache the cap is shared by every worker process,
+    otherwise it is per process. Returns False when every slot is taken,
+    so the caller can turn the request away now rather than queue a push
+    that would time out.
+    """
+    return get_push_slots().reserve(getattr(settings, 'MPESA_MAX_INFLIGHT_PUSHES', 200))
+
+
+def release_push():
+    get_push_slots().release()
+
+
+async def areserve_push():
+    """reserve_push() for async views; Redis round trips run off the event loop"""
+    if get_push_slots().blocking:
+        return await sync_to_async(reserve_push)()
+    return reserve_push()
+
+
+async def arelease_push():
+    if get_push_slots().blocking:
+        return await sync_to_async(release_push)()
+    return release_push()
+
+
+def _send_reserved(payment_id):
+    try:
+        send_stk_push(payment_id)
+    finally:
+        release_push()
+
+
+async def _asend_reserved(payment_id):
+    try:
+        await asend_stk_push(payment_id)
+    finally:
+        await arelease_push()
+
+
+async def adispatch_stk_push(payment):
+    """
+    Queue the STK push from an async view
+
+    Async views never run inside ATOMIC_REQUESTS, so the payment row is
+    already committed and the push can be scheduled straight away. The
+    caller holds a slot from reserve_push(); it is released once Daraja
+    has answered.
+    """
+    if getattr(settings, 'DISPATCH_EAGER', False):
+        await _asend_reserved(payment.pk)
+    elif httpx is None:
+        get_executor().submit(_run_job, _send_reserved, payment.pk)
+    else:
+        # Start from an empty context: the request's would tie the job's
+        # async ORM calls to the request thread's executor, gone by then
+        contextvars.Context().run(
+            asyncio.run_coroutine_threadsafe, _arun_job(_asend_reserved, payment.pk), get_event_loop()
+        )
@@ -0,0 +1,168 @@
+"""
+Payment Status Events
+In-process pub/sub behind the server-sent events endpoint for payments
+
+Subscribers are asyncio queues, so an idle SSE connection costs one
+suspended coroutine and no thread. Publishing is thread-safe and can
+happen from the callback worker, the dispatcher or a management command.
+Set EVENTS_BACKEND to RedisBroker when several worker processes serve
+the site, so an event published in one reaches browsers on the others.
+"""
+import asyncio
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .models import Payment
+
+
+CHANNEL_PREFIX = 'payment:'
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+class LocalBroker:
+    """Delivers messages to subscribers in this process only"""
+
+    def __init__(self):
+        # channel -> {(event loop, queue)}
+        self._subscribers = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def publish(self, channel, message):
+        self._deliver(channel, message)
+
+    def _deliver(self, channel, message):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, message)
+            except RuntimeError:
+                pass  # the subscriber's loop has closed
+
+    @asynccontextmanager
+    async def subscribe(self, channel):
+        """Queue of messages published to channel while the block runs"""
+        subscriber = (asyncio.get_running_loop(), asyncio.Queue())
+        with self._lock:
+            self._subscribers[channel].add(subscriber)
+        try:
+            yield subscriber[1]
+        finally:
+            with self._lock:
+                self._subscribers[channel].discard(subscriber)
+                if not self._subscribers[channel]:
+                    del self._subscribers[channel]
+
+
+class RedisBroker(LocalBroker):
+    """
+    Shares messages between processes over Redis pub/sub
+
+    Each process holds one pattern subscription, read by a daemon thread
+    and fanned out to its local subscribers, however many there are.
+    """
+
+    def __init__(self, url=None):
+        import redis
+
+        super().__init__()
+        self.url = url or settings.REDIS_URL
+        self._client = redis.Redis.from_url(self.url)
+        self._listener = None
+
+    def publish(self, channel, message):
+        self._client.publish(channel, json.dumps(message))
+
+    @asynccontextmanager
+    async def subscribe(self, channel):
+        self._start_listener()
+        async with super().subscribe(channel) as queue:
+            yield queue
+
+    def _start_listener(self):
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen, name='events-redis', daemon=True)
+                self._listener.start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(f'{CHANNEL_PREFIX}*')
+                for message in pubsub.listen():
+                    self._deliver(message['channel'].decode(), json.loads(message['data']))
+            except Exception as e:
+                print(f"Event subscription to Redis failed: {e}")
+                time.sleep(1)
+
+
+def get_broker():
+    """The process-wide broker named by EVENTS_BACKEND"""
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                backend = getattr(settings, 'EVENTS_BACKEND', 'housesApp.events.LocalBroker')
+                _broker = import_string(backend)()
+    return _broker
+
+
+def payment_channel(payment_id):
+    return f'{CHANNEL_PREFIX}{payment_id}'
+
+
+def payment_message(payment):
+    return {
+        'id': payment.id,
+        'status': payment.status,
+        'receipt': payment.mpesa_receipt_number,
+    }
+
+
+def publish_payments(payments):
+    """Announce the current status of each payment; call after the change commits"""
+    broker = get_broker()
+    for payment in payments:
+        try:
+            broker.publish(payment_channel(payment.id), payment_message(payment))
+        except Exception as e:
+            print(f"Publishing status of payment {payment.id} failed: {e}")
+
+
+async def payment_event_stream(payment_id, keepalive=None, max_age=None):
+    """
+    Server-sent events for one payment: its status now, then every change
+
+    Ends once the payment is completed or failed, or after `max_age`
+    seconds, when EventSource reconnects after the `retry:` delay and
+    starts a fresh stream. A comment line goes out every `keepalive`
+    seconds so proxies keep the idle connection open.
+    """
+    keepalive = keepalive or getattr(settings, 'EVENTS_KEEPALIVE', 15)
+    max_age = max_age or getattr(settings, 'EVENTS_MAX_AGE', 300)
+    deadline = time.monotonic() + max_age
+    async with get_broker().subscribe(payment_channel(payment_id)) as queue:
+        # Read the row only after subscribing, so a change in between is not lost
+        payment = await Payment.objects.only('id', 'status', 'mpesa_receipt_number').aget(pk=payment_id)
+        message = payment_message(payment)
+        yield f'retry: 5000\nevent: payment\ndata: {json.dumps(message)}\n\n'
+
+        while message['status'] == Payment.STATUS_PENDING:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                message = await asyncio.wait_for(queue.get(), min(keepalive, remaining))
+            except asyncio.TimeoutError:
+                yield ': keepalive\n\n'
+                continue
+            yield f'event: payment\ndata: {json.dumps(message)}\n\n'
@@ -0,0 +1,173 @@
+"""
+Listing Facets
+Counts houses per location, status and price bucket for the current
+filters in one grouped query, cached per filter signature
+"""
+from dataclasses import dataclass
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import BooleanField, Case, CharField, Count, Q, Value, When
+
+from nyumbaProject.replicas import replica_may_lag
+
+from .caching import aget_listings_version, filter_signature, get_listings_version
+from .listings import filter_houses
+from .models import House
+
+
+# (key, label, lower bound inclusive, upper bound exclusive)
+PRICE_BUCKETS = [
+    ('0-10k', 'Under Ksh 10k', None, Decimal('10000')),
+    ('10k-20k', 'Ksh 10k–20k', Decimal('10000'), Decimal('20000')),
+    ('20k-50k', 'Ksh 20k–50k', Decimal('20000'), Decimal('50000')),
+    ('50k-100k', 'Ksh 50k–100k', Decimal('50000'), Decimal('100000')),
+    ('100k+', 'Ksh 100k and above', Decimal('100000'), None),
+]
+
+STATUS_LABELS = dict(House.STATUS_CHOICES)
+
+
+@dataclass
+class FacetValue:
+    value: str
+    label: str
+    count: int
+
+
+def price_bucket_expression():
+    whens = []
+    for key, _, _, upper in PRICE_BUCKETS[:-1]:
+        whens.append(When(price__lt=upper, then=Value(key)))
+    return Case(*whens, default=Value(PRICE_BUCKETS[-1][0]), output_field=CharField())
+
+
+def bucket_bounds(key):
+    """(min_price, max_price) filter values that select one price bucket"""
+    for bucket_key, _, lower, upper in PRICE_BUCKETS:
+        if bucket_key == key:
+            # max_price is inclusive, so stop a cent short of the next bucket
+            return lower, (upper - Decimal('0.01') if upper is not None else None)
+    raise KeyError(key)
+
+
+def price_range_expression(filters):
+    """Whether a house's price is within the min_price/max_price filters"""
+    in_range = Q()
+    if filters.get('min_price') is not None:
+        in_range &= Q(price__gte=filters['min_price'])
+    if filters.get('max_price') is not None:
+        in_range &= Q(price__lte=filters['max_price'])
+    if not in_range:
+        return Value(True)
+    return Case(When(in_range, then=Value(True)), default=Value(False), output_field=BooleanField())
+
+
+def _facet_queryset(filters):
+    # No filter goes in the WHERE clause: location, status and whether the
+    # price is in range are grouped on instead, so each facet can still
+    # offer its other values while one of them is selected
+    return (
+        filter_houses({})
+        .order_by()
+        .annotate(bucket=price_bucket_expression(), in_price=price_range_expression(filters))
+        .values('location', 'status', 'bucket', 'in_price')
+        .annotate(count=Count('id'))
+    )
+
+
+def _build_facets(rows, filters):
+    location = filters.get('location')
+    status = filters.get('status')
+    locations, statuses, buckets = {}, {}, {}
+    for row in rows:
+        location_match = not location or row['location'] == location
+        status_match = not status or row['status'] == status
+        if status_match and row['in_price']:
+            locations[row['location']] = locations.get(row['location'], 0) + row['count']
+        if location_match and row['in_price']:
+            statuses[row['status']] = statuses.get(row['status'], 0) + row['count']
+        if location_match and status_match:
+            buckets[row['bucket']] = buckets.get(row['bucket'], 0) + row['count']
+
+    return {
+        'location': [
+            FacetValue(value, value, count)
+            for value, count in sorted(locations.items(), key=lambda item: (-item[1], item[0]))
+        ],
+        'status': [
+            FacetValue(value, STATUS_LABELS[value], statuses[value])
+            for value, _ in House.STATUS_CHOICES if statuses.get(value)
+        ],
+        'price': [
+            FacetValue(key, label, buckets[key])
+            for key, label, _, _ in PRICE_BUCKETS if buckets.get(key)
+        ],
+    }
+
+
+def _cache_key(version, filters):
+    return f'facets:{version}:{filter_signature(filters)}'
+
+
+def get_facets(filters):
+    """
+    Facet counts for a set of listing filters
+
+    Args:
+        filters: cleaned_data from ListingFilterForm
+
+    Returns:
+        dict of 'location', 'status' and 'price' -> [FacetValue], each
+        counted with every filter applied except the facet's own
+    """
+    version = get_listings_version()
+    key = _cache_key(version, filters)
+    facets = cache.get(key)
+    if facets is None:
+        facets = _build_facets(_facet_queryset(filters), filters)
+        if not replica_may_lag(version):
+            cache.set(key, facets, getattr(settings, 'FACET_CACHE_TIMEOUT', 300))
+    return facets
+
+
+async def aget_facets(filters):
+    """Async counterpart of get_facets for async views"""
+    version = await aget_listings_version()
+    key = _cache_key(version, filters)
+    facets = await cache.aget(key)
+    if facets is None:
+        rows = [row async for row in _facet_queryset(filters)]
+        facets = _build_facets(rows, filters)
+        # Counts from a replica may predate the change that set this version
+        if not replica_may_lag(version):
+            await cache.aset(key, facets, getattr(settings, 'FACET_CACHE_TIMEOUT', 300))
+    return facets
+
+
+def facet_links(facets, params):
+    """
+    Pair each facet value with the query string that selects it
+
+    Args:
+        facets: result of get_facets
+        params: the current request.GET QueryDict
+
+    Returns:
+        dict of facet name -> [(FacetValue, query string)]
+    """
+    links = {}
+    for name, values in facets.items():
+        links[name] = []
+        for facet in values:
+            query = params.copy()
+            query.pop('after', None)
+            if name == 'price':
+                min_price, max_price = bucket_bounds(facet.value)
+                query['min_price'] = '' if min_price is None else min_price
+                query['max_price'] = '' if max_price is None else max_price
+            else:
+                query[name] = facet.value
+            links[name].append((facet, query.urlencode()))
+    return links
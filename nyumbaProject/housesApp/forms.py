@@ -1,7 +1,7 @@
 from django import forms
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User
-from .models import Booking
+from .models import Booking, House
 
 
 class UserRegistrationForm(UserCreationForm):
@@ -71,4 +71,53 @@ class PaymentForm(forms.Form):
         if len(phone_digits) < 10:
             raise forms.ValidationError("Phone number must be at least 10 digits")
         
-        return phone
\ No newline at end of file
+        return phone
+
+
+class ListingFilterForm(forms.Form):
+    """Query-string filters and keyset cursor for the house listings"""
+    status = forms.ChoiceField(
+        choices=[('', 'Any status')] + House.STATUS_CHOICES,
+        required=False,
+        widget=forms.Select(attrs={'class': 'form-select'})
+    )
+    location = forms.CharField(
+        max_length=200,
+        required=False,
+        widget=forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'Location'})
+    )
+    min_price = forms.DecimalField(
+        max_digits=10,
+        decimal_places=2,
+        min_value=0,
+        required=False,
+        widget=forms.NumberInput(attrs={'class': 'form-control', 'placeholder': 'Min price'})
+    )
+    max_price = forms.DecimalField(
+        max_digits=10,
+        decimal_places=2,
+        min_value=0,
+        required=False,
+        widget=forms.NumberInput(attrs={'class': 'form-control', 'placeholder': 'Max price'})
+    )
+    after = forms.IntegerField(min_value=1, required=False, widget=forms.HiddenInput())
+    limit = forms.IntegerField(min_value=1, required=False, widget=forms.HiddenInput())
+
+    def clean_location(self):
+        return self.cleaned_data.get('location', '').strip()
+
+    def clean(self):
+        cleaned_data = super().clean()
+        min_price = cleaned_data.get('min_price')
+        max_price = cleaned_data.get('max_price')
+        if min_price is not None and max_price is not None and min_price > max_price:
+            raise forms.ValidationError("Minimum price cannot be greater than maximum price")
+        return cleaned_data
+
+
+class NearbyForm(forms.Form):
+    """Point and radius for the nearby houses endpoint"""
+    lat = forms.FloatField(min_value=-90, max_value=90)
+    lng = forms.FloatField(min_value=-180, max_value=180)
+    radius = forms.FloatField(min_value=0.01, max_value=100, required=False, help_text='Kilometres')
+    limit = forms.IntegerField(min_value=1, max_value=100, required=False)
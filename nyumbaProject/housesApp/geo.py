@@ -0,0 +1,159 @@
+"""
+Nearby House Search
+Radius and nearest-neighbour queries over House coordinates
+
+On SQLite the coordinates are mirrored into an R-tree virtual table kept
+in sync by model signals; other databases answer the bounding box from
+the (latitude, longitude) index. Either way the box only narrows the
+candidates and exact distances are worked out with the haversine formula.
+"""
+import math
+from dataclasses import dataclass
+
+from django.db import connection
+
+from .models import House
+
+
+RTREE_TABLE = 'housesApp_house_rtree'
+
+EARTH_RADIUS_KM = 6371.0088
+
+# Nearest-neighbour search widens its radius from here until it has enough houses
+NEAREST_START_KM = 1.0
+NEAREST_MAX_KM = 100.0
+
+
+@dataclass
+class NearbyResult:
+    house: House
+    distance_km: float
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """Great-circle distance between two points in kilometres"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lng2 - lng1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bounding_box(lat, lng, radius_km):
+    """(min_lat, max_lat, min_lng, max_lng) enclosing a circle; ignores the antimeridian"""
+    d_lat = math.degrees(radius_km / EARTH_RADIUS_KM)
+    cos_lat = max(math.cos(math.radians(lat)), 1e-6)
+    d_lng = min(180.0, d_lat / cos_lat)
+    return lat - d_lat, lat + d_lat, lng - d_lng, lng + d_lng
+
+
+def uses_rtree():
+    return connection.vendor == 'sqlite'
+
+
+def index_points(points):
+    """Add or move houses in the R-tree from (house_id, latitude, longitude) rows"""
+    if not uses_rtree():
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f'INSERT OR REPLACE INTO {RTREE_TABLE} (id, min_lat, max_lat, min_lng, max_lng) '
+            f'VALUES (%s, %s, %s, %s, %s)',
+            [(house_id, lat, lat, lng, lng) for house_id, lat, lng in points]
+        )
+
+
+def index_location(house):
+    """Mirror one house's coordinates into the R-tree"""
+    if house.latitude is None or house.longitude is None:
+        remove_location(house.pk)
+    else:
+        index_points([(house.pk, house.latitude, house.longitude)])
+
+
+def remove_location(house_id):
+    if not uses_rtree():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {RTREE_TABLE} WHERE id = %s', [house_id])
+
+
+def rebuild_locations():
+    """Re-populate the R-tree from the house table"""
+    if not uses_rtree():
+        return
+    table = House._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {RTREE_TABLE}')
+        cursor.execute(
+            f'INSERT INTO {RTREE_TABLE} (id, min_lat, max_lat, min_lng, max_lng) '
+            f'SELECT id, latitude, latitude, longitude, longitude FROM "{table}" '
+            f'WHERE latitude IS NOT NULL AND longitude IS NOT NULL'
+        )
+
+
+def _candidates(box):
+    min_lat, max_lat, min_lng, max_lng = box
+    if uses_rtree():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT id, (min_lat + max_lat) / 2, (min_lng + max_lng) / 2 FROM {RTREE_TABLE} '
+                f'WHERE max_lat >= %s AND min_lat <= %s AND max_lng >= %s AND min_lng <= %s',
+                [min_lat, max_lat, min_lng, max_lng]
+            )
+            return cursor.fetchall()
+    return House.objects.filter(
+        latitude__range=(min_lat, max_lat), longitude__range=(min_lng, max_lng)
+    ).values_list('id', 'latitude', 'longitude')
+
+
+def within_radius(lat, lng, radius_km, limit=None):
+    """
+    Houses within radius_km of a point
+
+    Returns:
+        [(house_id, distance_km)] nearest first
+    """
+    hits = []
+    for house_id, house_lat, house_lng in _candidates(bounding_box(lat, lng, radius_km)):
+        distance = haversine_km(lat, lng, house_lat, house_lng)
+        if distance <= radius_km:
+            hits.append((house_id, distance))
+    hits.sort(key=lambda hit: hit[1])
+    return hits[:limit] if limit else hits
+
+
+def nearest(lat, lng, limit=20, max_radius_km=NEAREST_MAX_KM):
+    """
+    The `limit` houses closest to a point, up to max_radius_km away
+
+    The search radius doubles until it holds `limit` houses, so dense
+    areas are answered from a small box.
+
+    Returns:
+        [(house_id, distance_km)] nearest first
+    """
+    radius = min(NEAREST_START_KM, max_radius_km)
+    while True:
+        hits = within_radius(lat, lng, radius, limit)
+        if len(hits) >= limit or radius >= max_radius_km:
+            return hits
+        radius = min(radius * 2, max_radius_km)
+
+
+def nearby(lat, lng, radius_km=None, limit=20):
+    """
+    NearbyResults around a point
+
+    Args:
+        radius_km: only houses this close; without it the nearest
+                   `limit` houses are returned
+    """
+    # Even with a radius, widen from a small box so a dense area never
+    # reads every house in the circle just to keep the closest few
+    hits = nearest(lat, lng, limit, max_radius_km=radius_km or NEAREST_MAX_KM)
+    houses = House.objects.in_bulk([house_id for house_id, _ in hits])
+    return [
+        NearbyResult(house=houses[house_id], distance_km=distance)
+        for house_id, distance in hits if house_id in houses
+    ]
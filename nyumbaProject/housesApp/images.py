@@ -0,0 +1,105 @@
+"""
+House Image Variants
+Builds resized WebP/JPEG copies of House.image for responsive templates
+"""
+import posixpath
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+from .caching import invalidate_house
+from .models import House
+
+
+# Variant name -> maximum width in pixels
+VARIANT_WIDTHS = {
+    'thumb': 320,
+    'card': 640,
+    'detail': 1280,
+}
+
+# Output format -> (file extension, Pillow save options)
+VARIANT_FORMATS = {
+    'webp': ('webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+VARIANT_DIR = 'house_images/variants'
+
+
+def variant_path(image_name, variant, fmt):
+    stem = posixpath.splitext(posixpath.basename(image_name))[0]
+    extension = VARIANT_FORMATS[fmt][0]
+    return f'{VARIANT_DIR}/{stem}_{variant}.{extension}'
+
+
+def generate_variants(image_name, storage=None):
+    """
+    Resize one uploaded image into every variant and format
+
+    Pure file work with no database access, so it can run in a worker
+    process. Images are never upscaled; a variant wider than the original
+    is skipped.
+
+    Returns:
+        dict stored on House.image_variants:
+        {'source': image_name, 'variants': {name: {'width', 'webp', 'jpeg'}}}
+    """
+    storage = storage or default_storage
+    with storage.open(image_name, 'rb') as f:
+        original = ImageOps.exif_transpose(Image.open(f))
+        original = original.convert('RGB')
+
+    variants = {}
+    for variant, max_width in VARIANT_WIDTHS.items():
+        if max_width > original.width and variants:
+            continue
+        image = original.copy()
+        image.thumbnail((max_width, max_width * 4), Image.Resampling.LANCZOS)
+
+        entry = {'width': image.width}
+        for fmt, (_, options) in VARIANT_FORMATS.items():
+            buffer = BytesIO()
+            image.save(buffer, format=fmt.upper(), **options)
+            name = variant_path(image_name, variant, fmt)
+            if storage.exists(name):
+                storage.delete(name)
+            entry[fmt] = storage.save(name, ContentFile(buffer.getvalue()))
+        variants[variant] = entry
+
+    return {'source': image_name, 'variants': variants}
+
+
+def generate_house_variants(house_id):
+    """Background job: build variants for a house and record them"""
+    house = House.objects.filter(pk=house_id).only('image').first()
+    if house is None or not house.image:
+        return
+
+    data = generate_variants(house.image.name)
+    # Skip the write if the image was replaced while we were resizing
+    if House.objects.filter(pk=house_id, image=house.image.name).update(image_variants=data):
+        invalidate_house(house_id)
+
+
+def needs_variants(house):
+    return bool(house.image) and (house.image_variants or {}).get('source') != house.image.name
+
+
+def srcset(house, fmt):
+    """srcset attribute value for one format, or '' if no variants exist yet"""
+    if needs_variants(house):
+        return ''
+    entries = sorted(house.image_variants['variants'].values(), key=lambda entry: entry['width'])
+    return ', '.join(f"{default_storage.url(entry[fmt])} {entry['width']}w" for entry in entries)
+
+
+def variant_url(house, variant, fmt='jpeg'):
+    """URL of the closest available variant, falling back to the original upload"""
+    if needs_variants(house):
+        return house.image.url if house.image else ''
+    variants = house.image_variants['variants']
+    entry = variants.get(variant) or max(variants.values(), key=lambda entry: entry['width'])
+    return default_storage.url(entry[fmt])
@@ -0,0 +1,97 @@
+"""
+House Listings Engine
+Filters houses and pages through them by keyset instead of OFFSET
+"""
+from dataclasses import dataclass, field
+
+from .models import House
+
+
+DEFAULT_PAGE_SIZE = 24
+MAX_PAGE_SIZE = 100
+
+
+@dataclass
+class ListingPage:
+    houses: list = field(default_factory=list)
+    next_cursor: int = None
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+def filter_houses(filters, queryset=None):
+    """
+    Apply listing filters to a House queryset
+
+    Args:
+        filters: cleaned_data from ListingFilterForm (status, location,
+                 min_price, max_price)
+        queryset: base queryset, defaults to every house
+
+    Returns:
+        filtered queryset ordered newest first
+    """
+    if queryset is None:
+        queryset = House.objects.all()
+
+    if filters.get('status'):
+        queryset = queryset.filter(status=filters['status'])
+    if filters.get('location'):
+        queryset = queryset.filter(location=filters['location'])
+    if filters.get('min_price') is not None:
+        queryset = queryset.filter(price__gte=filters['min_price'])
+    if filters.get('max_price') is not None:
+        queryset = queryset.filter(price__lte=filters['max_price'])
+
+    return queryset.order_by('-id')
+
+
+async def aget_page(filters, queryset=None):
+    """
+    Fetch one page of houses by seeking on -id
+
+    The cursor is the id of the last house on the previous page, so the
+    database only ever reads `limit + 1` rows from the primary key index
+    no matter how deep into the catalog the tenant has scrolled.
+    """
+    queryset, limit = _page_queryset(filters, queryset)
+    return _make_page([house async for house in queryset], limit)
+
+
+def _page_queryset(filters, queryset):
+    limit = min(filters.get('limit') or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+    queryset = filter_houses(filters, queryset)
+
+    if filters.get('after'):
+        queryset = queryset.filter(id__lt=filters['after'])
+
+    # Fetch one extra row to find out whether another page exists
+    return queryset[:limit + 1], limit
+
+
+def _make_page(houses, limit):
+    next_cursor = None
+    if len(houses) > limit:
+        houses = houses[:limit]
+        next_cursor = houses[-1].id
+    return ListingPage(houses=houses, next_cursor=next_cursor)
+
+
+def serialize_house(house, request=None):
+    """Convert a house into the dict shape used by the JSON listings endpoint"""
+    image_url = house.image.url if house.image else None
+    if image_url and request is not None:
+        image_url = request.build_absolute_uri(image_url)
+
+    return {
+        'id': house.id,
+        'title': house.title,
+        'location': house.location,
+        'price': str(house.price),
+        'status': house.status,
+        'latitude': house.latitude,
+        'longitude': house.longitude,
+        'image': image_url,
+    }
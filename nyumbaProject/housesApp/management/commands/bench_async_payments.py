@@ -0,0 +1,83 @@
+"""
+Compare in-flight STK push capacity of thread-per-request vs the async MpesaService
+
+Measures the Daraja client on its own, against a slow local stub. For the
+whole request path under one uvicorn process, run `loadtest` against
+`uvicorn nyumbaProject.asgi:application` instead.
+"""
+import asyncio
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+
+from housesApp.daraja_stub import DarajaStubServer
+from housesApp.mpesa_service import MpesaService, httpx
+
+
+class Command(BaseCommand):
+    help = 'Load-test STK pushes against a slow local Daraja stub, sync threads vs asyncio'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='STK pushes per run')
+        parser.add_argument('--threads', type=int, default=20, help='worker threads for the sync run')
+        parser.add_argument('--latency', type=float, default=0.5, help='seconds of simulated Daraja latency')
+
+    def handle(self, *args, **options):
+        if httpx is None:
+            raise CommandError('The async run needs httpx installed')
+
+        total = options['requests']
+        server = DarajaStubServer(latency=options['latency']).start()
+        try:
+            self.stdout.write(f"{'run':<24} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'threads':>8}")
+            self.report(f"sync ({options['threads']} threads)", total, options['threads'],
+                        *self.run_sync(server, total, options['threads']))
+            self.report('async (1 event loop)', total, 1, *self.run_async(server, total))
+        finally:
+            server.stop()
+
+    def report(self, label, total, threads, elapsed, latencies):
+        quantiles = statistics.quantiles(latencies, n=100)
+        self.stdout.write(
+            f"{label:<24} {total / elapsed:>9.0f} {quantiles[49] * 1000:>9.1f} "
+            f"{quantiles[98] * 1000:>9.1f} {threads:>8}"
+        )
+
+    def run_sync(self, server, total, threads):
+        cache.clear()
+        service = MpesaService(base_url=server.base_url)
+        service.pool_size = threads
+
+        def push(i):
+            started = time.perf_counter()
+            service.initiate_stk_push('254708374149', 1, house_id=i, user_id=1)
+            return time.perf_counter() - started
+
+        # Warm the token cache, as the async run does, so both time STK pushes only
+        service.get_access_token()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            latencies = list(executor.map(push, range(total)))
+        return time.perf_counter() - started, latencies
+
+    def run_async(self, server, total):
+        cache.clear()
+        service = MpesaService(base_url=server.base_url)
+        service.pool_size = total
+
+        async def push(i):
+            started = time.perf_counter()
+            await service.ainitiate_stk_push('254708374149', 1, house_id=i, user_id=1)
+            return time.perf_counter() - started
+
+        async def run():
+            # Warm the token cache so the timed pushes measure STK push concurrency only
+            await service.aget_access_token()
+            started = time.perf_counter()
+            latencies = await asyncio.gather(*(push(i) for i in range(total)))
+            return time.perf_counter() - started, latencies
+
+        return asyncio.run(run())
@@ -0,0 +1,79 @@
+"""
+Hammer single houses with concurrent bookings and check exactly one wins each
+"""
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connection
+
+from housesApp.bookings import reserve_house
+from housesApp.models import House, Booking
+
+
+class Command(BaseCommand):
+    help = 'Race many threads to book the same house and verify a single winner per house'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=32, help='concurrent bookers per house')
+        parser.add_argument('--rounds', type=int, default=50, help='houses to race for')
+
+    def handle(self, *args, **options):
+        threads, rounds = options['threads'], options['rounds']
+        tenants = [
+            User.objects.get_or_create(username=f'bench_tenant_{i}')[0]
+            for i in range(threads)
+        ]
+        houses = House.objects.bulk_create([
+            House(title=f'Bench House {i}', price=10000, location='Bench', description='',
+                  image='house_images/bench.jpg')
+            for i in range(rounds)
+        ])
+
+        wins, errors, attempts = 0, 0, 0
+        started = time.perf_counter()
+        try:
+            for house in houses:
+                round_wins, round_errors = self.race(house, tenants)
+                if round_wins != 1:
+                    raise CommandError(f'{round_wins} bookings won house {house.pk}')
+                wins += round_wins
+                errors += round_errors
+                attempts += threads
+            elapsed = time.perf_counter() - started
+
+            booked = Booking.objects.filter(house__in=houses).count()
+            self.stdout.write(
+                f"{attempts} booking attempts on {rounds} houses in {elapsed:.2f}s "
+                f"({attempts / elapsed:.0f} attempts/s)\n"
+                f"winners: {wins}, bookings saved: {booked}, database errors: {errors}"
+            )
+            if booked != rounds:
+                raise CommandError(f'Expected {rounds} bookings, found {booked}')
+            self.stdout.write(self.style.SUCCESS('Exactly one booking won every house'))
+        finally:
+            House.objects.filter(pk__in=[house.pk for house in houses]).delete()
+            User.objects.filter(pk__in=[tenant.pk for tenant in tenants]).delete()
+
+    def race(self, house, tenants):
+        barrier = threading.Barrier(len(tenants))
+        results = []
+
+        def book(tenant):
+            try:
+                barrier.wait()
+                house_copy = House.objects.get(pk=house.pk)
+                booking = Booking(user=tenant, phone_number='0722000000')
+                results.append('won' if reserve_house(house_copy, booking) else 'lost')
+            except DatabaseError:
+                results.append('error')
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=book, args=(tenant,)) for tenant in tenants]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return results.count('won'), results.count('error')
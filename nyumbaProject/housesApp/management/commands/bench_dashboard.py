@@ -0,0 +1,90 @@
+"""
+Logged-in request benchmark for the SESSION_PROFILE settings
+
+Requests the landlord dashboard as one logged-in landlord, once per
+session/auth profile, and reports requests per second, latency and the
+queries each request spends finding its session and user:
+
+    python manage.py bench_dashboard --requests 1000
+"""
+import statistics
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from housesApp.models import House
+
+
+# Session and request.user lookups; landlord_stats also reads auth_user, so match the select list
+AUTH_QUERIES = ('FROM "django_session"', 'SELECT "auth_user"."id"')
+
+
+class Command(BaseCommand):
+    help = 'Measure logged-in dashboard requests per second for each SESSION_PROFILE'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500, help='dashboard requests per profile')
+        parser.add_argument('--houses', type=int, default=20, help="houses on the landlord's dashboard")
+        parser.add_argument('--profiles', nargs='+', default=list(settings.SESSION_PROFILES),
+                            metavar='PROFILE', help='SESSION_PROFILES to compare')
+
+    def handle(self, *args, **options):
+        unknown = set(options['profiles']) - set(settings.SESSION_PROFILES)
+        if unknown:
+            raise CommandError(f"Unknown profiles: {', '.join(sorted(unknown))}")
+
+        landlord = User.objects.create_user(username=f'bench_landlord_{time.time_ns()}')
+        House.objects.bulk_create(
+            House(title=f'Bench House {i}', price=10000, location='Bench', description='', image='', owner=landlord)
+            for i in range(options['houses'])
+        )
+        try:
+            self.stdout.write(f"{'profile':<8} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'queries':>8} {'auth queries':>13}")
+            for profile in options['profiles']:
+                r = self.measure(profile, landlord, options['requests'])
+                self.stdout.write(
+                    f"{profile:<8} {r['per_s']:>8.0f} {r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f} "
+                    f"{r['queries']:>8} {r['auth_queries']:>13}"
+                )
+        finally:
+            House.objects.filter(owner=landlord).delete()
+            landlord.delete()
+
+    def measure(self, profile, landlord, requests):
+        engine, backends = settings.SESSION_PROFILES[profile]
+        # The test client's host isn't in ALLOWED_HOSTS outside the test runner
+        with override_settings(SESSION_ENGINE=engine, AUTHENTICATION_BACKENDS=backends, ALLOWED_HOSTS=['*']):
+            client = Client()
+            client.force_login(landlord)
+            url = reverse('housesApp:dashboard')
+            client.get(url)  # warm the caches
+
+            with CaptureQueriesContext(connection) as captured:
+                response = client.get(url)
+            # Read them now; later requests reset the connection's query log
+            queries = [query['sql'] for query in captured]
+            if response.status_code != 200:
+                raise CommandError(f'{profile}: dashboard answered {response.status_code}')
+
+            latencies = []
+            started = time.perf_counter()
+            for _ in range(requests):
+                request_started = time.perf_counter()
+                client.get(url)
+                latencies.append(time.perf_counter() - request_started)
+            elapsed = time.perf_counter() - started
+            client.logout()
+
+        return {
+            'per_s': requests / elapsed,
+            'p50_ms': statistics.median(latencies) * 1000,
+            'p99_ms': statistics.quantiles(latencies, n=100, method='inclusive')[98] * 1000,
+            'queries': len(queries),
+            'auth_queries': sum(1 for query in queries if any(marker in query for marker in AUTH_QUERIES)),
+        }
@@ -0,0 +1,245 @@
+"""
+Concurrent write benchmark for the DATABASE_PROFILE settings
+
+Writer threads replay the app's hot write paths (payment_callback storing
+a callback, book_house claiming a house) while the callback worker applies
+the inbox and reader threads load the home page listing. Compare profiles
+on fresh databases with
+
+    python manage.py bench_db_writes --compare sqlite sqlite-wal postgres
+"""
+import argparse
+import json
+import os
+import queue
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connection
+
+from housesApp.bookings import reserve_house
+from housesApp.callbacks import drain_callbacks
+from housesApp.models import Booking, House, MpesaCallback, Payment
+
+
+CHECKOUT_PREFIX = 'ws_CO_bench_'
+
+
+class Command(BaseCommand):
+    help = 'Measure write throughput and read latency under concurrent callbacks and bookings'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=16, help='concurrent writer threads')
+        parser.add_argument('--readers', type=int, default=4, help='concurrent home page readers')
+        parser.add_argument('--bookings', type=int, default=1000, help='houses to book')
+        parser.add_argument('--callbacks', type=int, default=1000, help='payment callbacks to receive')
+        parser.add_argument('--compare', nargs='+', metavar='PROFILE',
+                            help='run once per DATABASE_PROFILE, SQLite ones on fresh databases')
+        parser.add_argument('--json', action='store_true', help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options['compare']:
+            return self.compare(options)
+
+        results = self.run(options)
+        if options['json']:
+            self.stdout.write(json.dumps(results))
+        else:
+            self.stdout.write(format_header())
+            self.stdout.write(format_row(results))
+
+    def compare(self, options):
+        child_args = [
+            '--writers', str(options['writers']), '--readers', str(options['readers']),
+            '--bookings', str(options['bookings']), '--callbacks', str(options['callbacks']), '--json',
+        ]
+        self.stdout.write(format_header())
+        with tempfile.TemporaryDirectory() as tmp:
+            for profile in options['compare']:
+                env = {**os.environ, 'DATABASE_PROFILE': profile,
+                       'SQLITE_PATH': os.path.join(tmp, f'{profile}.sqlite3')}
+                try:
+                    if profile.startswith('sqlite'):
+                        self.manage(['migrate', '-v0'], env)
+                    output = self.manage(['bench_db_writes', *child_args], env)
+                except CommandError as e:
+                    self.stderr.write(f'{profile}: {e}')
+                    continue
+                self.stdout.write(format_row(json.loads(output.strip().splitlines()[-1])))
+
+    def manage(self, args, env):
+        process = subprocess.run(
+            [sys.executable, '-m', 'django', *args], env=env, cwd=settings.BASE_DIR,
+            capture_output=True, text=True
+        )
+        if process.returncode:
+            raise CommandError(process.stderr.strip().splitlines()[-1] if process.stderr else 'failed')
+        return process.stdout
+
+    def run(self, options):
+        users, houses = self.seed(options)
+        try:
+            return self.measure(options, users, houses)
+        finally:
+            House.objects.filter(pk__in=[house.pk for house in houses]).delete()
+            User.objects.filter(pk__in=[user.pk for user in users]).delete()
+            MpesaCallback.objects.filter(payload__contains=CHECKOUT_PREFIX).delete()
+
+    def seed(self, options):
+        users = [
+            User.objects.get_or_create(username=f'bench_writer_{i}')[0]
+            for i in range(options['writers'])
+        ]
+        houses = House.objects.bulk_create(
+            House(title=f'Bench House {i}', price=10000, location='Bench', description='', image='')
+            for i in range(options['bookings'] + 1)
+        )
+        # Payments awaiting callbacks hang off bookings of one extra house
+        bookings = Booking.objects.bulk_create(
+            Booking(user=users[i % len(users)], house=houses[-1], phone_number='0722000000')
+            for i in range(options['callbacks'])
+        )
+        Payment.objects.bulk_create(
+            Payment(booking=booking, amount=10000, phone_number='254722000000',
+                    checkout_request_id=f'{CHECKOUT_PREFIX}{booking.pk}')
+            for booking in bookings
+        )
+        return users, houses
+
+    def measure(self, options, users, houses):
+        work = queue.Queue()
+        jobs = [('book', house) for house in houses[:-1]]
+        jobs += [('callback', f'{CHECKOUT_PREFIX}{booking_id}')
+                 for booking_id in Booking.objects.filter(house=houses[-1]).values_list('id', flat=True)]
+        random.shuffle(jobs)
+        for job in jobs:
+            work.put(job)
+
+        write_latencies, read_latencies, errors = [], [], []
+        lock = threading.Lock()
+        writing = threading.Event()
+        writing.set()
+
+        def writer(user):
+            try:
+                while True:
+                    try:
+                        kind, target = work.get_nowait()
+                    except queue.Empty:
+                        return
+                    started = time.perf_counter()
+                    try:
+                        if kind == 'book':
+                            reserve_house(target, Booking(user=user, phone_number='0722000000'))
+                        else:
+                            MpesaCallback.objects.create(payload=callback_payload(target))
+                    except DatabaseError as e:
+                        with lock:
+                            errors.append(str(e))
+                        continue
+                    with lock:
+                        write_latencies.append(time.perf_counter() - started)
+            finally:
+                connection.close()
+
+        def reader():
+            try:
+                while writing.is_set():
+                    started = time.perf_counter()
+                    try:
+                        list(House.objects.filter(status=House.STATUS_VACANT).order_by('-id')[:20])
+                    except DatabaseError as e:
+                        with lock:
+                            errors.append(str(e))
+                        continue
+                    with lock:
+                        read_latencies.append(time.perf_counter() - started)
+            finally:
+                connection.close()
+
+        def callback_worker():
+            # The inbox worker, as schedule_drain runs it
+            try:
+                while writing.is_set():
+                    try:
+                        if not drain_callbacks():
+                            time.sleep(0.01)
+                    except DatabaseError as e:
+                        with lock:
+                            errors.append(str(e))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=writer, args=(users[i],)) for i in range(options['writers'])]
+        background = [threading.Thread(target=reader) for _ in range(options['readers'])]
+        background.append(threading.Thread(target=callback_worker))
+
+        started = time.perf_counter()
+        for thread in threads + background:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        writing.clear()
+        for thread in background:
+            thread.join()
+        drain_callbacks()
+
+        settled = Payment.objects.filter(
+            checkout_request_id__startswith=CHECKOUT_PREFIX
+        ).exclude(status=Payment.STATUS_PENDING).count()
+        return {
+            'profile': settings.DATABASE_PROFILE,
+            'journal': journal_mode(),
+            'writes': len(write_latencies),
+            'writes_per_s': len(write_latencies) / elapsed,
+            'write_p50_ms': percentile(write_latencies, 50),
+            'write_p99_ms': percentile(write_latencies, 99),
+            'reads': len(read_latencies),
+            'read_p99_ms': percentile(read_latencies, 99),
+            'errors': len(errors),
+            'settled': settled,
+        }
+
+
+def callback_payload(checkout_request_id):
+    return json.dumps({'Body': {'stkCallback': {
+        'MerchantRequestID': 'bench', 'CheckoutRequestID': checkout_request_id,
+        'ResultCode': 0, 'ResultDesc': 'The service request is processed successfully.',
+        'CallbackMetadata': {'Item': [{'Name': 'MpesaReceiptNumber', 'Value': 'BENCH' + checkout_request_id.removeprefix(CHECKOUT_PREFIX)}]},
+    }}})
+
+
+def journal_mode():
+    if connection.vendor != 'sqlite':
+        return connection.vendor
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA journal_mode')
+        return cursor.fetchone()[0]
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    if len(values) == 1:
+        return values[0] * 1000
+    return statistics.quantiles(values, n=100, method='inclusive')[q - 1] * 1000
+
+
+def format_header():
+    return (f"{'profile':<12} {'journal':<10} {'writes':>7} {'writes/s':>9} {'p50 ms':>8} {'p99 ms':>8} "
+            f"{'reads':>7} {'read p99':>9} {'errors':>7} {'settled':>8}")
+
+
+def format_row(r):
+    return (f"{r['profile']:<12} {r['journal']:<10} {r['writes']:>7} {r['writes_per_s']:>9.0f} "
+            f"{r['write_p50_ms']:>8.1f} {r['write_p99_ms']:>8.1f} {r['reads']:>7} {r['read_p99_ms']:>9.1f} "
+            f"{r['errors']:>7} {r['settled']:>8}")
@@ -0,0 +1,67 @@
+"""
+Benchmark STK pushes against a local Daraja stub, with and without the pooled session
+"""
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+
+from housesApp.daraja_stub import DarajaStubServer
+from housesApp.mpesa_service import MpesaService
+
+
+class UnpooledMpesaService(MpesaService):
+    """The old behaviour: a bare requests call, and a new connection, per request"""
+
+    @property
+    def session(self):
+        return requests
+
+
+def percentile(latencies, pct):
+    return statistics.quantiles(latencies, n=100)[pct - 1] * 1000
+
+
+class Command(BaseCommand):
+    help = 'Measure p50/p99 STK push latency against a local Daraja stub server'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=1000, help='STK pushes per run')
+        parser.add_argument('--concurrency', type=int, default=20, help='threads for the concurrent runs')
+        parser.add_argument('--latency', type=float, default=0.0, help='seconds of simulated Daraja latency')
+
+    def handle(self, *args, **options):
+        server = DarajaStubServer(latency=options['latency']).start()
+        try:
+            self.stdout.write(f"{'mode':<10} {'run':<12} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'conns':>7}")
+            for label, service_class in (('before', UnpooledMpesaService), ('after', MpesaService)):
+                for run, concurrency in (('sequential', 1), ('concurrent', options['concurrency'])):
+                    self.run(server, label, run, service_class, options['requests'], concurrency)
+        finally:
+            server.stop()
+
+    def run(self, server, label, run, service_class, total, concurrency):
+        cache.clear()
+        service = service_class(base_url=server.base_url)
+        service.pool_size = max(service.pool_size, concurrency)
+        server.connections = 0
+
+        def push(i):
+            started = time.perf_counter()
+            result = service.initiate_stk_push('254708374149', 1, house_id=i, user_id=1)
+            if result['status'] != 'success':
+                raise RuntimeError(result['message'])
+            return time.perf_counter() - started
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            latencies = list(executor.map(push, range(total)))
+        elapsed = time.perf_counter() - started
+
+        self.stdout.write(
+            f"{label:<10} {run:<12} {total / elapsed:>9.0f} "
+            f"{percentile(latencies, 50):>9.2f} {percentile(latencies, 99):>9.2f} {server.connections:>7}"
+        )
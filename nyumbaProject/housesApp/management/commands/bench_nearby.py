@@ -0,0 +1,71 @@
+"""
+Benchmark nearby house search at growing catalog sizes
+"""
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_databases, teardown_databases
+
+from housesApp.geo import nearest, rebuild_locations, within_radius
+from housesApp.models import House
+
+
+# Rough extent of greater Nairobi
+LAT_RANGE = (-1.50, -1.00)
+LNG_RANGE = (36.60, 37.10)
+
+
+class Command(BaseCommand):
+    help = 'Time nearest-neighbour and radius queries (uses a throwaway test database)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+        parser.add_argument('--queries', type=int, default=200, help='random points per size')
+        parser.add_argument('--radius', type=float, default=2.0, help='radius query size in km')
+
+    def handle(self, *args, **options):
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            self.run(sorted(options['sizes']), options['queries'], options['radius'])
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+    def run(self, sizes, queries, radius):
+        self.stdout.write(f"{'houses':>10} {'query':<16} {'p50 ms':>8} {'p99 ms':>8} {'avg hits':>9}")
+        rng = random.Random(42)
+        for size in sizes:
+            self.seed(size - House.objects.count(), rng)
+            rebuild_locations()
+            points = [(rng.uniform(*LAT_RANGE), rng.uniform(*LNG_RANGE)) for _ in range(queries)]
+            self.report(size, 'nearest 20', points, lambda lat, lng: nearest(lat, lng, 20))
+            self.report(size, f'20 in {radius:g}km', points, lambda lat, lng: nearest(lat, lng, 20, radius))
+            self.report(size, f'all in {radius:g}km', points, lambda lat, lng: within_radius(lat, lng, radius))
+
+    def report(self, size, label, points, query):
+        timings, hits = [], 0
+        for lat, lng in points:
+            started = time.perf_counter()
+            hits += len(query(lat, lng))
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+        self.stdout.write(
+            f"{size:>10} {label:<16} {statistics.median(timings):>8.2f} {p99:>8.2f} {hits / len(points):>9.0f}"
+        )
+
+    def seed(self, count, rng, batch_size=10_000):
+        table = House._meta.db_table
+        sql = (
+            f'INSERT INTO "{table}" (title, price, location, description, image, status, image_variants, '
+            f"latitude, longitude) VALUES ('House', %s, 'Nairobi', '', '', 'vacant', '{{}}', %s, %s)"
+        )
+        with connection.cursor() as cursor:
+            for start in range(0, count, batch_size):
+                rows = [
+                    (rng.randrange(5000, 150000), rng.uniform(*LAT_RANGE), rng.uniform(*LNG_RANGE))
+                    for _ in range(min(batch_size, count - start))
+                ]
+                cursor.executemany(sql, rows)
@@ -0,0 +1,83 @@
+"""
+Benchmark full-text search against LIKE scans at growing catalog sizes
+"""
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_databases, teardown_databases
+
+from housesApp.models import House
+from housesApp.search import LikeSearchBackend, get_backend
+
+
+LOCATIONS = [
+    'Kilimani', 'Kileleshwa', 'Westlands', 'Lavington', 'Ruaka', 'Juja', 'Thika', 'Kitengela',
+    'Rongai', 'Syokimau', 'Embakasi', 'Kasarani', 'Roysambu', 'Ngong', 'Karen', 'Langata',
+]
+AMENITIES = [
+    'balcony', 'parking', 'borehole', 'gated', 'furnished', 'garden', 'pantry', 'rooftop',
+    'gym', 'pool', 'lift', 'generator', 'cctv', 'wifi', 'servant', 'ensuite',
+]
+SYLLABLES = ['ka', 'ri', 'mu', 'to', 'la', 'ne', 'sa', 'wa', 'ki', 'zo', 'pe', 'du']
+
+# Listing copy is mostly filler words from a large vocabulary with a few
+# amenities sprinkled in, so query terms match a realistic fraction of rows
+QUERIES = ['kilimani', 'furnished balcony', 'rooftop pool westlands', 'mutola']
+
+
+class Command(BaseCommand):
+    help = 'Compare search latency of the full-text backend and LIKE scans (uses a throwaway test database)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+        parser.add_argument('--repeat', type=int, default=10, help='runs per query')
+
+    def handle(self, *args, **options):
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            self.run(sorted(options['sizes']), options['repeat'])
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+    def run(self, sizes, repeat):
+        backend, like = get_backend(), LikeSearchBackend()
+        self.stdout.write(f"backend: {type(backend).__name__}")
+        self.stdout.write(f"{'houses':>10} {'query':<24} {'fts p50 ms':>11} {'like p50 ms':>12} {'speedup':>8}")
+
+        rng = random.Random(42)
+        for size in sizes:
+            self.seed(size - House.objects.count(), rng)
+            backend.rebuild()
+            for query in QUERIES:
+                fts = self.time(backend, query, repeat)
+                scan = self.time(like, query, max(1, repeat // 5))
+                self.stdout.write(f"{size:>10} {query:<24} {fts:>11.2f} {scan:>12.2f} {scan / fts:>7.0f}x")
+
+    def seed(self, count, rng, batch_size=10_000):
+        table = House._meta.db_table
+        sql = (
+            f'INSERT INTO "{table}" (title, price, location, description, image, status, image_variants) '
+            f"VALUES (%s, %s, %s, %s, '', 'vacant', '{{}}')"
+        )
+        filler = [''.join(rng.choices(SYLLABLES, k=3)) for _ in range(5000)]
+        with connection.cursor() as cursor:
+            for start in range(0, count, batch_size):
+                rows = []
+                for _ in range(min(batch_size, count - start)):
+                    location = rng.choice(LOCATIONS)
+                    title = f"{rng.choice(filler).title()} {rng.choice(['Apartments', 'Court', 'Heights', 'Villas'])}"
+                    words = rng.choices(filler, k=30) + rng.sample(AMENITIES, k=2)
+                    rng.shuffle(words)
+                    rows.append((title, rng.randrange(5000, 150000), location, ' '.join(words)))
+                cursor.executemany(sql, rows)
+
+    def time(self, backend, query, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            backend.search_ids(query, limit=20)
+            timings.append(time.perf_counter() - started)
+        return statistics.median(timings) * 1000
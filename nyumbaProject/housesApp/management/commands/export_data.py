@@ -0,0 +1,27 @@
+"""
+Stream houses, bookings or payments out as CSV or JSONL
+"""
+from django.core.management.base import BaseCommand
+
+from housesApp.transfer import EXPORT_COLUMNS, FORMATS, export_lines, format_for
+
+
+class Command(BaseCommand):
+    help = 'Export houses, bookings or payments as CSV or JSONL in constant memory'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=sorted(EXPORT_COLUMNS))
+        parser.add_argument('--output', '-o', help='file to write (default stdout)')
+        parser.add_argument('--format', choices=FORMATS, help='default from the --output extension, else csv')
+
+    def handle(self, *args, **options):
+        fmt = options['format'] or format_for(options['output'] or '')
+        if not options['output']:
+            for chunk in export_lines(options['kind'], fmt):
+                self.stdout.write(chunk, ending='')
+            return
+
+        with open(options['output'], 'w', newline='', encoding='utf-8') as f:
+            for chunk in export_lines(options['kind'], fmt):
+                f.write(chunk)
+        self.stderr.write(f"Wrote {options['kind']} to {options['output']}")
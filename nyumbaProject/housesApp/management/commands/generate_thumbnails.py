@@ -0,0 +1,66 @@
+"""
+Backfill resized image variants for existing houses using a process pool
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from housesApp.caching import invalidate_house
+from housesApp.images import generate_variants, needs_variants
+from housesApp.models import House
+
+
+# Houses read, resized and saved per round, so memory stays flat however many there are
+BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = 'Generate thumbnail/card/detail WebP and JPEG variants for house images'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None, help='worker processes (default: CPU count)')
+        parser.add_argument('--force', action='store_true', help='rebuild variants that already exist')
+
+    def handle(self, *args, **options):
+        candidates = House.objects.exclude(image='').only('id', 'image', 'image_variants').order_by('id')
+        updated, failed = 0, 0
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            for houses in self.batches(candidates, options['force']):
+                # Workers only resize files and fork on the first submit; close
+                # connections so no socket is shared across the fork
+                connections.close_all()
+                done, errors = self.resize(executor, houses)
+                House.objects.bulk_update(done, ['image_variants'])
+                # bulk_update skips post_save; retire pages still pointing at the originals
+                for house in done:
+                    invalidate_house(house.pk)
+                updated += len(done)
+                failed += errors
+
+        if not updated and not failed:
+            self.stdout.write('All house images already have variants')
+            return
+        self.stdout.write(self.style.SUCCESS(f"Generated variants for {updated} houses, {failed} failed"))
+
+    def batches(self, candidates, force):
+        """Houses needing variants, BATCH_SIZE rows at a time, seeking on id"""
+        last_id = 0
+        while batch := list(candidates.filter(id__gt=last_id)[:BATCH_SIZE]):
+            last_id = batch[-1].id
+            houses = [house for house in batch if force or needs_variants(house)]
+            if houses:
+                yield houses
+
+    def resize(self, executor, houses):
+        done, failed = [], 0
+        futures = {executor.submit(generate_variants, house.image.name): house for house in houses}
+        for future in as_completed(futures):
+            house = futures[future]
+            try:
+                house.image_variants = future.result()
+                done.append(house)
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f"House {house.pk} ({house.image.name}): {e}")
+        return done, failed
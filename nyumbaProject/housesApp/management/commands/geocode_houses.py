@@ -0,0 +1,102 @@
+"""
+Geocode house locations in bulk from a local gazetteer file
+"""
+import csv
+import re
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from housesApp.caching import bump_listings_version
+from housesApp.geo import index_points
+from housesApp.models import House
+
+
+DEFAULT_GAZETTEER = Path(__file__).resolve().parents[2] / 'data' / 'gazetteer.csv'
+
+
+def normalize(name):
+    return re.sub(r'\s+', ' ', name).strip().lower()
+
+
+def load_gazetteer(path):
+    """Read a name,latitude,longitude CSV into {normalized name: (lat, lng)}"""
+    places = {}
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            places[normalize(row['name'])] = (float(row['latitude']), float(row['longitude']))
+    return places
+
+
+def lookup(places, location):
+    """
+    Coordinates for a free-text location, or None
+
+    Tries the whole string first, then each comma-separated part, so
+    "Kilimani, Nairobi" resolves to Kilimani.
+    """
+    location = normalize(location)
+    if location in places:
+        return places[location]
+    for part in location.split(','):
+        part = part.strip()
+        if part in places:
+            return places[part]
+    return None
+
+
+class Command(BaseCommand):
+    help = 'Fill in House.latitude/longitude from location names using a gazetteer CSV'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--gazetteer', default=str(DEFAULT_GAZETTEER), help='CSV with name,latitude,longitude')
+        parser.add_argument('--overwrite', action='store_true', help='re-geocode houses that already have coordinates')
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        try:
+            places = load_gazetteer(options['gazetteer'])
+        except (OSError, KeyError, ValueError) as e:
+            raise CommandError(f"Could not read gazetteer {options['gazetteer']}: {e}")
+
+        houses = House.objects.all()
+        if not options['overwrite']:
+            houses = houses.filter(latitude__isnull=True)
+
+        batch_size = options['batch_size']
+        geocoded, unmatched, last_id = 0, {}, 0
+        while True:
+            # Seek on id rather than holding a cursor open across the writes
+            rows = list(
+                houses.filter(id__gt=last_id).order_by('id').values_list('id', 'location')[:batch_size]
+            )
+            if not rows:
+                break
+            last_id = rows[-1][0]
+
+            batch = []
+            for house_id, location in rows:
+                point = lookup(places, location)
+                if point is None:
+                    unmatched[location] = unmatched.get(location, 0) + 1
+                else:
+                    batch.append(House(id=house_id, latitude=point[0], longitude=point[1]))
+            geocoded += self.save(batch)
+
+        if geocoded:
+            bump_listings_version()
+        self.stdout.write(self.style.SUCCESS(f'Geocoded {geocoded} houses'))
+        if unmatched:
+            top = sorted(unmatched.items(), key=lambda item: -item[1])[:10]
+            self.stdout.write(
+                f"{sum(unmatched.values())} houses had no gazetteer match, e.g. "
+                + ', '.join(f'{location!r} ({count})' for location, count in top)
+            )
+
+    def save(self, houses):
+        # bulk_update skips post_save, so move the R-tree entries alongside it
+        with transaction.atomic():
+            House.objects.bulk_update(houses, ['latitude', 'longitude'])
+            index_points([(house.id, house.latitude, house.longitude) for house in houses])
+        return len(houses)
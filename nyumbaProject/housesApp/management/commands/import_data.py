@@ -0,0 +1,46 @@
+"""
+Load houses, bookings or payments from CSV or JSONL in batches
+"""
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from housesApp.transfer import FORMATS, IMPORTERS, HouseImporter, format_for, import_rows, read_rows
+
+
+class Command(BaseCommand):
+    help = 'Import houses, bookings or payments from a CSV or JSONL file with batched bulk_create'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=sorted(IMPORTERS))
+        parser.add_argument('path', help='CSV (with a header row) or JSONL file')
+        parser.add_argument('--format', choices=FORMATS, help='default from the file extension')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--owner', help='landlord username for every imported house')
+        parser.add_argument('--image-dir', help='directory the image column of a house import is relative to')
+
+    def handle(self, *args, **options):
+        if options['kind'] == 'houses':
+            owner = None
+            if options['owner']:
+                owner = User.objects.filter(username=options['owner']).first()
+                if owner is None:
+                    raise CommandError(f"No user named {options['owner']!r}")
+            importer = HouseImporter(owner=owner, image_dir=options['image_dir'])
+        else:
+            importer = IMPORTERS[options['kind']]()
+
+        fmt = options['format'] or format_for(options['path'])
+        started = time.perf_counter()
+        with open(options['path'], newline='', encoding='utf-8-sig') as f:
+            result = import_rows(importer, read_rows(f, fmt), options['batch_size'])
+        elapsed = time.perf_counter() - started
+
+        for row, message in result.errors:
+            self.stderr.write(f"row {row}: {message}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {result.created} {options['kind']} in {elapsed:.1f}s, skipped {len(result.errors)} rows"
+        ))
+        if options['kind'] == 'houses' and options['image_dir']:
+            self.stdout.write('Run `manage.py generate_thumbnails` to build the image variants')
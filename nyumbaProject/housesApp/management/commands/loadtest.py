@@ -0,0 +1,180 @@
+"""
+End-to-end load test of the tenant booking and payment flow
+
+Drives a running Nyumba-Hunt server over HTTP while a local Daraja stub
+answers its STK pushes and posts the payment callbacks back to it. Start
+the server against the stub and the same database, with rate limits off
+(every flow comes from this one address), e.g.
+
+    DISABLE_RATE_LIMITS=1 MPESA_BASE_URL=http://127.0.0.1:8765 uvicorn nyumbaProject.asgi:application
+    python manage.py loadtest --rps 5 --duration 30
+"""
+import random
+import re
+import statistics
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.core.management.base import BaseCommand, CommandError
+
+from housesApp.daraja_stub import DarajaStubServer
+from housesApp.models import Booking, House
+
+
+STEPS = ['register', 'login', 'browse', 'house_detail', 'book_house', 'initiate_payment', 'callback']
+
+HOUSE_LINK = re.compile(r'/house/(\d+)/')
+
+
+class StepFailed(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Run register -> login -> browse -> book -> pay -> callback flows at a target rate'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--base-url', default='http://127.0.0.1:8000', help='server under test')
+        parser.add_argument('--rps', type=float, default=5.0, help='new tenant flows started per second')
+        parser.add_argument('--duration', type=float, default=30.0, help='seconds to keep starting flows')
+        parser.add_argument('--concurrency', type=int, default=100, help='most flows in flight at once')
+        parser.add_argument('--seed-houses', type=int, default=0, help='create this many vacant houses first')
+        parser.add_argument('--stub-port', type=int, default=8765, help='port for the Daraja stub')
+        parser.add_argument('--latency', type=float, default=0.2, help='Daraja response latency in seconds')
+        parser.add_argument('--jitter', type=float, default=0.1, help='extra random Daraja latency in seconds')
+        parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of STK pushes Daraja rejects')
+        parser.add_argument('--callback-delay', type=float, default=2.0, help='seconds until the customer answers')
+        parser.add_argument('--decline-rate', type=float, default=0.1, help='fraction of customers who decline')
+
+    def handle(self, *args, **options):
+        self.base_url = options['base_url'].rstrip('/')
+        if options['seed_houses']:
+            House.objects.bulk_create(
+                House(title=f'Load Test House {uuid.uuid4().hex[:6]}', price=random.randrange(5000, 50000),
+                      location='Load Test', description='Seeded by loadtest', image='')
+                for _ in range(options['seed_houses'])
+            )
+
+        stub = DarajaStubServer(
+            port=options['stub_port'], latency=options['latency'], jitter=options['jitter'],
+            failure_rate=options['failure_rate'], callback_delay=options['callback_delay'],
+            decline_rate=options['decline_rate'], callback_url=f'{self.base_url}/payment/callback/'
+        ).start()
+        try:
+            requests.get(self.base_url, timeout=10)
+        except requests.RequestException as e:
+            stub.stop()
+            raise CommandError(f'Server under test is not reachable at {self.base_url}: {e}')
+
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.lock = threading.Lock()
+        try:
+            elapsed = self.run(options['rps'], options['duration'], options['concurrency'])
+            # Give the last customers time to answer
+            deadline = time.monotonic() + options['callback_delay'] + 10
+            while time.monotonic() < deadline and any(result is None for result in stub.transactions.values()):
+                time.sleep(0.2)
+            time.sleep(1)
+        finally:
+            stub.stop()
+
+        self.latencies['callback'] = stub.callback_latencies
+        self.errors['callback'] = stub.callbacks_failed
+        self.report(elapsed, stub)
+
+    def run(self, rps, duration, concurrency):
+        interval = 1 / rps
+        total = int(rps * duration)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for i in range(total):
+                # Open loop: keep to the schedule even when the server falls behind
+                delay = started + i * interval - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(self.flow)
+        return time.perf_counter() - started
+
+    def timed(self, step, func, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = func(*args, timeout=60, **kwargs)
+        except requests.RequestException as e:
+            with self.lock:
+                self.errors[step] += 1
+            raise StepFailed(f'{step}: {e}')
+        elapsed = time.perf_counter() - started
+        if response.status_code >= 400:
+            with self.lock:
+                self.errors[step] += 1
+            raise StepFailed(f'{step}: HTTP {response.status_code}')
+        with self.lock:
+            self.latencies[step].append(elapsed)
+        return response
+
+    def post_form(self, step, session, path, data):
+        """GET a form for its CSRF cookie, then submit it"""
+        url = f'{self.base_url}{path}'
+        session.get(url, timeout=60)
+        headers = {'X-CSRFToken': session.cookies.get('csrftoken', ''), 'Referer': url}
+        return self.timed(step, session.post, url, data=data, headers=headers)
+
+    def flow(self):
+        username = f'load_{uuid.uuid4().hex[:12]}'
+        password = f'Pw-{uuid.uuid4().hex}'
+        try:
+            with requests.Session() as session:
+                self.post_form('register', session, '/register/', {
+                    'username': username, 'email': f'{username}@example.com',
+                    'password1': password, 'password2': password,
+                })
+            with requests.Session() as session:
+                self.post_form('login', session, '/login/', {'username': username, 'password': password})
+
+                page = self.timed('browse', session.get, f'{self.base_url}/', params={'status': 'vacant'})
+                house_ids = HOUSE_LINK.findall(page.text)
+                if not house_ids:
+                    raise StepFailed('browse: no vacant houses left')
+                house_id = random.choice(house_ids)
+                self.timed('house_detail', session.get, f'{self.base_url}/house/{house_id}/')
+
+                self.post_form('book_house', session, f'/book/{house_id}/', {'phone_number': '0722000000'})
+                booking = Booking.objects.filter(user__username=username, house_id=house_id).first()
+                if booking is None:
+                    return  # another tenant won the house; a valid outcome, not an error
+
+                self.post_form('initiate_payment', session, f'/payment/{booking.pk}/', {'phone_number': '0722000000'})
+        except StepFailed as e:
+            print(f'Flow for {username} stopped at {e}')
+        except Exception as e:
+            print(f'Flow for {username} crashed: {e}')
+
+    def report(self, elapsed, stub):
+        self.stdout.write(f"{'step':<18} {'ok':>6} {'errors':>7} {'req/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+        for step in STEPS:
+            latencies = sorted(self.latencies[step])
+            if not latencies:
+                self.stdout.write(f"{step:<18} {0:>6} {self.errors[step]:>7}")
+                continue
+            p50, p95, p99 = (percentile(latencies, q) * 1000 for q in (50, 95, 99))
+            self.stdout.write(
+                f"{step:<18} {len(latencies):>6} {self.errors[step]:>7} {len(latencies) / elapsed:>7.1f} "
+                f"{p50:>8.1f} {p95:>8.1f} {p99:>8.1f}"
+            )
+        answered = [result for result in stub.transactions.values() if result is not None]
+        paid = sum(1 for result in answered if result['ResultCode'] == 0)
+        self.stdout.write(
+            f"STK pushes accepted: {len(stub.transactions)}, customers answered: {len(answered)} "
+            f"({paid} paid, {len(answered) - paid} declined)"
+        )
+
+
+def percentile(sorted_values, q):
+    if len(sorted_values) == 1:
+        return sorted_values[0]
+    return statistics.quantiles(sorted_values, n=100, method='inclusive')[q - 1]
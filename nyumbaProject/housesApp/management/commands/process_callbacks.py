@@ -0,0 +1,26 @@
+"""
+Apply stored M-Pesa callbacks to payments in batches
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from housesApp.callbacks import drain_callbacks
+
+
+class Command(BaseCommand):
+    help = 'Apply pending M-Pesa callbacks from the inbox to their payments'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--loop', action='store_true', help='keep polling the inbox')
+        parser.add_argument('--interval', type=float, default=1.0, help='seconds between polls with --loop')
+
+    def handle(self, *args, **options):
+        while True:
+            processed = drain_callbacks(options['batch_size'])
+            if processed:
+                self.stdout.write(f"Processed {processed} callbacks")
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,23 @@
+"""
+Recompute house and landlord rollups from bookings and payments
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from housesApp.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = 'Recompute per-house and per-landlord-per-month rollups from scratch, in chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='houses or landlords per transaction')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        houses, landlords = rebuild_rollups(options['chunk_size'])
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt rollups for {houses} houses and {landlords} landlords in {elapsed:.1f}s"
+        ))
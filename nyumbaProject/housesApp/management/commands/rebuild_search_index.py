@@ -0,0 +1,15 @@
+"""
+Rebuild the full-text search index from the house table
+"""
+from django.core.management.base import BaseCommand
+
+from housesApp.search import get_backend
+
+
+class Command(BaseCommand):
+    help = 'Re-index every house for full-text search (after bulk loads that skip signals)'
+
+    def handle(self, *args, **options):
+        backend = get_backend()
+        backend.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt search index with {type(backend).__name__}'))
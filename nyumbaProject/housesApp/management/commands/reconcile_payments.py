@@ -0,0 +1,45 @@
+"""
+Settle stale pending payments with M-Pesa STK Push Query
+"""
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from housesApp.reconcile import reconcile_payments
+
+
+class Command(BaseCommand):
+    help = 'Query Daraja for pending payments whose callback never arrived and record the outcome'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=float, default=None,
+                            help='minutes a payment must have been pending (default MPESA_RECONCILE_AFTER)')
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--workers', type=int, default=None, help='concurrent STK queries')
+        parser.add_argument('--rate', type=float, default=None, help='most STK queries per second')
+        parser.add_argument('--loop', action='store_true', help='keep reconciling on a schedule')
+        parser.add_argument('--interval', type=float, default=60.0, help='seconds between runs with --loop')
+
+    def handle(self, *args, **options):
+        older_than = None
+        if options['older_than'] is not None:
+            older_than = timedelta(minutes=options['older_than'])
+
+        while True:
+            started = time.perf_counter()
+            totals = reconcile_payments(
+                older_than=older_than,
+                batch_size=options['batch_size'],
+                workers=options['workers'],
+                rate=options['rate'],
+            )
+            if totals['checked'] or not options['loop']:
+                elapsed = time.perf_counter() - started
+                self.stdout.write(
+                    f"Checked {totals['checked']} payments in {elapsed:.1f}s: {totals['completed']} completed, "
+                    f"{totals['failed']} failed, {totals['pending']} still pending, {totals['errors']} errors"
+                )
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('housesApp', '0004_mpesacallback'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='house',
+            name='image_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
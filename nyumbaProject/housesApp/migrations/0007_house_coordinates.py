@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:32
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+RTREE_TABLE = 'housesApp_house_rtree'
+
+
+def create_rtree(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute(
+            f'CREATE VIRTUAL TABLE IF NOT EXISTS {RTREE_TABLE} '
+            f'USING rtree(id, min_lat, max_lat, min_lng, max_lng)'
+        )
+
+
+def drop_rtree(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute(f'DROP TABLE IF EXISTS {RTREE_TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('housesApp', '0006_house_search_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='house',
+            name='latitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='house',
+            name='longitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='house',
+            index=models.Index(fields=['latitude', 'longitude'], name='house_lat_lng_idx'),
+        ),
+        migrations.RunPython(create_rtree, drop_rtree),
+    ]
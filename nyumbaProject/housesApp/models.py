@@ -1,6 +1,9 @@
 # Create your models here.
+from datetime import timedelta
+
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 class House(models.Model):
     STATUS_VACANT = 'vacant'
@@ -17,10 +20,28 @@ class House(models.Model):
     image = models.ImageField(upload_to='house_images/')
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_VACANT)
     owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='houses', null=True, blank=True)
+    # Resized copies of image, filled in by housesApp.images in the background
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
+    # WGS84 coordinates for nearby search, see housesApp.geo
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
 
     def __str__(self):
         return self.title
 
+    class Meta:
+        indexes = [
+            # landlord_dashboard: houses for one owner, split by status
+            models.Index(fields=['owner', 'status'], name='house_owner_status_idx'),
+            # home/admin status filter, seeking on -id
+            models.Index(fields=['status', 'id'], name='house_status_id_idx'),
+            # home/admin location filter, seeking on -id
+            models.Index(fields=['location', 'id'], name='house_location_id_idx'),
+            models.Index(fields=['price'], name='house_price_idx'),
+            # nearby search bounding box where there is no R-tree
+            models.Index(fields=['latitude', 'longitude'], name='house_lat_lng_idx'),
+        ]
+
 
 class Booking(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='bookings')
@@ -31,6 +52,11 @@ class Booking(models.Model):
     def __str__(self):
         return f"{self.user.username} → {self.house.title}"
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['booking_date'], name='booking_date_idx'),
+        ]
+
 
 class Payment(models.Model):
     STATUS_PENDING = 'pending'
@@ -48,10 +74,10 @@ class Payment(models.Model):
     booking = models.OneToOneField(Booking, on_delete=models.CASCADE, related_name='payment')
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     phone_number = models.CharField(max_length=20)
-    checkout_request_id = models.CharField(max_length=255, null=True, blank=True)
+    checkout_request_id = models.CharField(max_length=255, null=True, blank=True, unique=True)
     merchant_request_id = models.CharField(max_length=255, null=True, blank=True)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING)
-    mpesa_receipt_number = models.CharField(max_length=100, null=True, blank=True)
+    mpesa_receipt_number = models.CharField(max_length=100, null=True, blank=True, unique=True)
     transaction_date = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -61,4 +87,77 @@ class Payment(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # reconcile_payments: stale pending payments, oldest first
+            models.Index(fields=['status', 'created_at'], name='payment_status_created_idx'),
+        ]
+
+
+
+class MpesaCallback(models.Model):
+    """Raw M-Pesa callback payload, stored on receipt and applied to Payment by a batch worker"""
+    payload = models.TextField()
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.CharField(max_length=255, blank=True)
+
+    def __str__(self):
+        return f"Callback {self.id} - {'processed' if self.processed_at else 'pending'}"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['processed_at', 'id'], name='mpesacallback_pending_idx'),
+        ]
 
+
+class HouseRollup(models.Model):
+    """Running booking, payment and vacancy totals for one house, kept by housesApp.rollups"""
+    house = models.OneToOneField(House, on_delete=models.CASCADE, primary_key=True, related_name='rollup')
+    bookings = models.IntegerField(default=0)
+    last_booked_at = models.DateTimeField(null=True, blank=True)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    payments_completed = models.IntegerField(default=0)
+    pending_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    pending_count = models.IntegerField(default=0)
+    # Vacancy is only known from when tracking started; the current stretch is in vacant_since
+    vacant_time = models.DurationField(default=timedelta)
+    vacant_since = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Rollup for house {self.house_id}"
+
+    def vacant_for(self, now):
+        """Total time vacant, including the stretch still running at `now`"""
+        if self.vacant_since is None:
+            return self.vacant_time
+        return self.vacant_time + (now - self.vacant_since)
+
+    @property
+    def vacant_days(self):
+        return self.vacant_for(timezone.now()).days
+
+
+class LandlordMonthRollup(models.Model):
+    """
+    One landlord's bookings and payments for one calendar month
+
+    Bookings count in the month they were made, revenue in the month the
+    payment completed, and pending payments in the month they were started.
+    """
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='month_rollups')
+    # First day of the month, in TIME_ZONE
+    month = models.DateField()
+    bookings = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    payments_completed = models.IntegerField(default=0)
+    pending_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    pending_count = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.owner_id} {self.month:%Y-%m}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'month'], name='landlord_month_unique'),
+        ]
@@ -2,43 +2,228 @@
 M-Pesa Daraja STK Push Service
 Handles all M-Pesa payment operations
 """
+import asyncio
 import json
+import threading
+import time
+import uuid
+import weakref
 import requests
 from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
 from django.contrib.auth.models import User
+from nyumbaProject.metrics import observe_daraja
 from .models import House
 import base64
 
+try:
+    import httpx
+except ImportError:  # async Daraja calls need httpx
+    httpx = None
+
+
+# Shared token cache keys - every worker process reads the same entry
+TOKEN_CACHE_KEY = 'mpesa:access_token'
+TOKEN_LOCK_KEY = 'mpesa:access_token:refresh_lock'
+
+# (connect, read) timeouts in seconds per Daraja endpoint
+DEFAULT_TIMEOUTS = {
+    'auth': (3.05, 10),
+    'stk_push': (3.05, 15),
+    'stk_query': (3.05, 15),
+}
+
+# STK query answers that mean the customer hasn't finished yet
+QUERY_PENDING_ERROR_CODES = {'500.001.1001'}
+QUERY_PENDING_RESULT_CODES = {'4999'}
+
+BASE_URLS = {
+    'sandbox': 'https://sandbox.safaricom.co.ke',
+    'production': 'https://api.safaricom.co.ke',
+}
+
 
 class MpesaService:
-    def __init__(self):
+    def __init__(self, base_url=None):
         self.consumer_key = settings.MPESA_CONSUMER_KEY
         self.consumer_secret = settings.MPESA_CONSUMER_SECRET
         self.business_short_code = settings.MPESA_BUSINESS_SHORT_CODE
         self.passkey = settings.MPESA_PASSKEY
         self.environment = settings.MPESA_ENVIRONMENT
-        
-        if self.environment == 'sandbox':
-            self.auth_url = 'https://sandbox.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials'
-            self.stk_push_url = 'https://sandbox.safaricom.co.ke/mpesa/stkpush/v1/processrequest'
-        else:
-            self.auth_url = 'https://api.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials'
-            self.stk_push_url = 'https://api.safaricom.co.ke/mpesa/stkpush/v1/processrequest'
+        # Refresh the token this many seconds before Daraja expires it
+        self.token_refresh_margin = getattr(settings, 'MPESA_TOKEN_REFRESH_MARGIN', 300)
+        self._refresh_lock = threading.Lock()
+
+        # Connection pool and retry policy shared by every Daraja call
+        self.pool_size = getattr(settings, 'MPESA_POOL_SIZE', 20)
+        self.max_retries = getattr(settings, 'MPESA_MAX_RETRIES', 3)
+        self.timeouts = {**DEFAULT_TIMEOUTS, **getattr(settings, 'MPESA_TIMEOUTS', {})}
+        self._session = None
+        self._session_lock = threading.Lock()
+        # httpx clients and asyncio locks are bound to the event loop that made them
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._async_refresh_locks = weakref.WeakKeyDictionary()
+
+        # MPESA_BASE_URL points the service at a local Daraja stub
+        if base_url is None:
+            base_url = getattr(settings, 'MPESA_BASE_URL', None)
+        if base_url is None:
+            base_url = BASE_URLS['sandbox' if self.environment == 'sandbox' else 'production']
+        self.base_url = base_url.rstrip('/')
+        self.auth_url = f'{self.base_url}/oauth/v1/generate?grant_type=client_credentials'
+        self.stk_push_url = f'{self.base_url}/mpesa/stkpush/v1/processrequest'
+        self.stk_query_url = f'{self.base_url}/mpesa/stkpushquery/v1/query'
+
+    @property
+    def session(self):
+        """
+        Persistent keep-alive session, created lazily so forked workers
+        never share sockets opened by the parent process
+        """
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = self._build_session()
+        return self._session
+
+    def _build_session(self):
+        """
+        Pooled session with bounded, jittered retries
+
+        Only GET (the OAuth call) is retried on read errors and 5xx/429
+        responses; an STK push is never re-sent once Daraja may have seen
+        it, but connection failures are retried for every method because
+        the request never left this host.
+        """
+        retry = Retry(
+            total=self.max_retries,
+            connect=self.max_retries,
+            read=self.max_retries,
+            status=self.max_retries,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset({'GET'}),
+            backoff_factor=0.3,
+            backoff_jitter=0.3,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.pool_size,
+            max_retries=retry,
+        )
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def _request(self, method, url, endpoint, **kwargs):
+        """Send a Daraja request over the pooled session with the endpoint's timeout"""
+        started = time.perf_counter()
+        try:
+            return self.session.request(method, url, timeout=self.timeouts[endpoint], **kwargs)
+        finally:
+            observe_daraja(endpoint, time.perf_counter() - started)
     
     def get_access_token(self):
-        """Get access token from M-Pesa Daraja API"""
+        """
+        Get a cached access token, fetching one from Daraja only when needed
+
+        A token inside its refresh margin is still returned immediately while
+        a background thread replaces it, so callers only ever wait on Daraja
+        when no usable token exists at all.
+        """
+        cached = cache.get(TOKEN_CACHE_KEY)
+        if cached and time.time() < cached['expires_at']:
+            if time.time() >= cached['refresh_at']:
+                self._refresh_in_background()
+            return cached['token']
+        return self._refresh_access_token()
+
+    def invalidate_access_token(self):
+        """Drop the cached token, e.g. after Daraja rejects it"""
+        cache.delete(TOKEN_CACHE_KEY)
+
+    def _fetch_access_token(self):
+        """Request a new access token from M-Pesa Daraja API"""
         try:
-            response = requests.get(
+            response = self._request(
+                'GET',
                 self.auth_url,
-                auth=(self.consumer_key, self.consumer_secret),
-                timeout=10
+                'auth',
+                auth=(self.consumer_key, self.consumer_secret)
             )
             response.raise_for_status()
-            return response.json().get('access_token')
-        except requests.exceptions.RequestException as e:
+            data = response.json()
+            return data.get('access_token'), int(data.get('expires_in', 3599))
+        except (requests.exceptions.RequestException, ValueError) as e:
             print(f"Error getting access token: {e}")
-            return None
+            return None, 0
+
+    def _refresh_access_token(self):
+        """
+        Single-flight token refresh
+
+        A thread lock serialises refreshes inside this process and a cache
+        lock (cache.add) serialises them across processes; whoever loses
+        either race waits for the winner's token instead of calling Daraja.
+        """
+        with self._refresh_lock:
+            cached = cache.get(TOKEN_CACHE_KEY)
+            if cached and time.time() < cached['refresh_at']:
+                return cached['token']
+
+            owner = uuid.uuid4().hex
+            acquired = cache.add(TOKEN_LOCK_KEY, owner, timeout=30)
+            if not acquired:
+                token = self._wait_for_refresh()
+                if token:
+                    return token
+
+            try:
+                token, expires_in = self._fetch_access_token()
+                if token:
+                    cache.set(TOKEN_CACHE_KEY, self._token_entry(token, expires_in), timeout=expires_in)
+                    return token
+                # Fall back to a still-valid token if the early refresh failed
+                if cached and time.time() < cached['expires_at']:
+                    return cached['token']
+                return None
+            finally:
+                # Only release our own lock; after a timed-out wait it is
+                # still the other process's, and may be mid-refresh
+                if acquired and cache.get(TOKEN_LOCK_KEY) == owner:
+                    cache.delete(TOKEN_LOCK_KEY)
+
+    def _token_entry(self, token, expires_in):
+        now = time.time()
+        margin = min(self.token_refresh_margin, expires_in // 2)
+        return {
+            'token': token,
+            'expires_at': now + expires_in,
+            'refresh_at': now + expires_in - margin,
+        }
+
+    def _wait_for_refresh(self, timeout=10, interval=0.1):
+        """Poll the shared cache while another process refreshes the token"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            cached = cache.get(TOKEN_CACHE_KEY)
+            if cached and time.time() < cached['refresh_at']:
+                return cached['token']
+            if not cache.get(TOKEN_LOCK_KEY):
+                break
+            time.sleep(interval)
+        return None
+
+    def _refresh_in_background(self):
+        """Start an early refresh unless one is already running"""
+        if self._refresh_lock.locked():
+            return
+        threading.Thread(target=self._refresh_access_token, daemon=True).start()
     
     def initiate_stk_push(self, phone_number, amount, house_id, user_id, account_reference='NYUMBA_HUNT'):
         """
@@ -60,27 +245,7 @@ class MpesaService:
         if not access_token:
             return {'status': 'error', 'message': 'Failed to get access token'}
         
-        # Generate timestamp
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-        
-        # Generate password: Base64(ShortCode + Passkey + Timestamp)
-        data_to_encode = f"{self.business_short_code}{self.passkey}{timestamp}"
-        password = base64.b64encode(data_to_encode.encode()).decode()
-        
-        # Prepare request body
-        payload = {
-            "BusinessShortCode": self.business_short_code,
-            "Password": password,
-            "Timestamp": timestamp,
-            "TransactionType": "CustomerPayBillOnline",
-            "Amount": int(amount),
-            "PartyA": phone_number,
-            "PartyB": self.business_short_code,
-            "PhoneNumber": phone_number,
-            "CallBackURL": settings.MPESA_CALLBACK_URL,
-            "AccountReference": f"{account_reference}_{house_id}_{user_id}",
-            "TransactionDesc": f"Booking payment for house {house_id}"
-        }
+        payload = self._build_stk_payload(phone_number, amount, house_id, user_id, account_reference)
         
         headers = {
             "Authorization": f"Bearer {access_token}",
@@ -88,30 +253,19 @@ class MpesaService:
         }
         
         try:
-            response = requests.post(
+            response = self._request(
+                'POST',
                 self.stk_push_url,
+                'stk_push',
                 json=payload,
-                headers=headers,
-                timeout=10
+                headers=headers
             )
+            if response.status_code == 401:
+                # Token was revoked before its expiry; make the next push fetch a new one
+                self.invalidate_access_token()
             response.raise_for_status()
             
-            result = response.json()
-            
-            if result.get('ResponseCode') == '0':
-                return {
-                    'status': 'success',
-                    'message': 'STK Push sent successfully',
-                    'checkout_request_id': result.get('CheckoutRequestID'),
-                    'response_code': result.get('ResponseCode'),
-                    'response_description': result.get('ResponseDescription')
-                }
-            else:
-                return {
-                    'status': 'error',
-                    'message': result.get('ResponseDescription', 'STK Push failed'),
-                    'response_code': result.get('ResponseCode')
-                }
+            return self._parse_stk_response(response.json())
         
         except requests.exceptions.RequestException as e:
             return {
@@ -119,6 +273,245 @@ class MpesaService:
                 'message': f'Request error: {str(e)}'
             }
     
+    def query_stk_status(self, checkout_request_id):
+        """
+        Ask Daraja how an STK push ended (STK Push Query)
+
+        Args:
+            checkout_request_id: CheckoutRequestID returned by the push
+
+        Returns:
+            dict whose 'status' is 'completed', 'failed', 'pending' (the
+            customer hasn't answered yet), 'rate_limited' or 'error'
+        """
+        access_token = self.get_access_token()
+        if not access_token:
+            return {'status': 'error', 'message': 'Failed to get access token'}
+
+        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        payload = {
+            "BusinessShortCode": self.business_short_code,
+            "Password": self._password(timestamp),
+            "Timestamp": timestamp,
+            "CheckoutRequestID": checkout_request_id,
+        }
+        headers = {
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json"
+        }
+
+        try:
+            response = self._request('POST', self.stk_query_url, 'stk_query', json=payload, headers=headers)
+        except requests.exceptions.RequestException as e:
+            return {'status': 'error', 'message': f'Request error: {str(e)}'}
+
+        if response.status_code == 401:
+            self.invalidate_access_token()
+        if response.status_code == 429:
+            return {
+                'status': 'rate_limited',
+                'message': 'Daraja rate limit hit',
+                'retry_after': float(response.headers.get('Retry-After') or 1),
+            }
+        try:
+            data = response.json()
+        except ValueError:
+            return {'status': 'error', 'message': f'HTTP {response.status_code} with no JSON body'}
+        return self._parse_query_response(data)
+
+    def _parse_query_response(self, result):
+        """Turn Daraja's STK query response into the service's result dict"""
+        if 'ResultCode' in result:
+            result_code = str(result['ResultCode'])
+            if result_code in QUERY_PENDING_RESULT_CODES:
+                status = 'pending'
+            else:
+                status = 'completed' if result_code == '0' else 'failed'
+            return {
+                'status': status,
+                'result_code': result_code,
+                'message': result.get('ResultDesc', ''),
+            }
+        if result.get('errorCode') in QUERY_PENDING_ERROR_CODES:
+            return {'status': 'pending', 'message': result.get('errorMessage', '')}
+        return {
+            'status': 'error',
+            'message': result.get('errorMessage') or result.get('ResponseDescription', 'STK query failed'),
+        }
+
+    # Async API (ASGI views and the async dispatcher)
+
+    def _async_client(self):
+        """Pooled keep-alive httpx client for the running event loop"""
+        if httpx is None:
+            raise ImproperlyConfigured('Async M-Pesa calls require the httpx package')
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            connect, read = self.timeouts['stk_push']
+            client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=self.pool_size,
+                    max_keepalive_connections=self.pool_size
+                ),
+                # httpx only retries failed connection attempts, never a sent request
+                transport=httpx.AsyncHTTPTransport(retries=self.max_retries),
+                timeout=httpx.Timeout(read, connect=connect)
+            )
+            self._async_clients[loop] = client
+        return client
+
+    async def _arequest(self, method, url, endpoint, **kwargs):
+        """Async counterpart of _request"""
+        connect, read = self.timeouts[endpoint]
+        timeout = httpx.Timeout(read, connect=connect)
+        started = time.perf_counter()
+        try:
+            return await self._async_client().request(method, url, timeout=timeout, **kwargs)
+        finally:
+            observe_daraja(endpoint, time.perf_counter() - started)
+
+    async def aget_access_token(self):
+        """Async counterpart of get_access_token, sharing the same cache entry"""
+        cached = await cache.aget(TOKEN_CACHE_KEY)
+        if cached and time.time() < cached['expires_at']:
+            if time.time() >= cached['refresh_at']:
+                self._refresh_in_background()
+            return cached['token']
+        return await self._arefresh_access_token()
+
+    async def _afetch_access_token(self):
+        try:
+            response = await self._arequest(
+                'GET',
+                self.auth_url,
+                'auth',
+                auth=(self.consumer_key, self.consumer_secret)
+            )
+            response.raise_for_status()
+            data = response.json()
+            return data.get('access_token'), int(data.get('expires_in', 3599))
+        except (httpx.HTTPError, ValueError) as e:
+            print(f"Error getting access token: {e}")
+            return None, 0
+
+    async def _arefresh_access_token(self):
+        """Single-flight refresh for coroutines; mirrors _refresh_access_token"""
+        loop = asyncio.get_running_loop()
+        lock = self._async_refresh_locks.setdefault(loop, asyncio.Lock())
+        async with lock:
+            cached = await cache.aget(TOKEN_CACHE_KEY)
+            if cached and time.time() < cached['refresh_at']:
+                return cached['token']
+
+            owner = uuid.uuid4().hex
+            acquired = await cache.aadd(TOKEN_LOCK_KEY, owner, timeout=30)
+            if not acquired:
+                token = await self._await_refresh()
+                if token:
+                    return token
+
+            try:
+                token, expires_in = await self._afetch_access_token()
+                if token:
+                    await cache.aset(TOKEN_CACHE_KEY, self._token_entry(token, expires_in), timeout=expires_in)
+                return token
+            finally:
+                if acquired and await cache.aget(TOKEN_LOCK_KEY) == owner:
+                    await cache.adelete(TOKEN_LOCK_KEY)
+
+    async def _await_refresh(self, timeout=10, interval=0.1):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            cached = await cache.aget(TOKEN_CACHE_KEY)
+            if cached and time.time() < cached['refresh_at']:
+                return cached['token']
+            if not await cache.aget(TOKEN_LOCK_KEY):
+                break
+            await asyncio.sleep(interval)
+        return None
+
+    async def ainitiate_stk_push(self, phone_number, amount, house_id, user_id, account_reference='NYUMBA_HUNT'):
+        """
+        Async counterpart of initiate_stk_push
+
+        Waiting on Daraja holds no thread, so one event loop can keep
+        thousands of STK pushes in flight.
+        """
+        access_token = await self.aget_access_token()
+        if not access_token:
+            return {'status': 'error', 'message': 'Failed to get access token'}
+
+        payload = self._build_stk_payload(phone_number, amount, house_id, user_id, account_reference)
+        headers = {
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json"
+        }
+
+        try:
+            response = await self._arequest(
+                'POST',
+                self.stk_push_url,
+                'stk_push',
+                json=payload,
+                headers=headers
+            )
+            if response.status_code == 401:
+                await cache.adelete(TOKEN_CACHE_KEY)
+            response.raise_for_status()
+
+            return self._parse_stk_response(response.json())
+
+        except httpx.HTTPError as e:
+            return {
+                'status': 'error',
+                'message': f'Request error: {str(e)}'
+            }
+
+    def _build_stk_payload(self, phone_number, amount, house_id, user_id, account_reference):
+        """Build the STK push request body"""
+        # Generate timestamp
+        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        
+        # Prepare request body
+        payload = {
+            "BusinessShortCode": self.business_short_code,
+            "Password": self._password(timestamp),
+            "Timestamp": timestamp,
+            "TransactionType": "CustomerPayBillOnline",
+            "Amount": int(amount),
+            "PartyA": phone_number,
+            "PartyB": self.business_short_code,
+            "PhoneNumber": phone_number,
+            "CallBackURL": settings.MPESA_CALLBACK_URL,
+            "AccountReference": f"{account_reference}_{house_id}_{user_id}",
+            "TransactionDesc": f"Booking payment for house {house_id}"
+        }
+        return payload
+
+    def _password(self, timestamp):
+        """Base64(ShortCode + Passkey + Timestamp), as Daraja expects"""
+        data_to_encode = f"{self.business_short_code}{self.passkey}{timestamp}"
+        return base64.b64encode(data_to_encode.encode()).decode()
+
+    def _parse_stk_response(self, result):
+        """Turn Daraja's STK push response into the service's result dict"""
+        if result.get('ResponseCode') == '0':
+            return {
+                'status': 'success',
+                'message': 'STK Push sent successfully',
+                'checkout_request_id': result.get('CheckoutRequestID'),
+                'merchant_request_id': result.get('MerchantRequestID'),
+                'response_code': result.get('ResponseCode'),
+                'response_description': result.get('ResponseDescription')
+            }
+        else:
+            return {
+                'status': 'error',
+                'message': result.get('ResponseDescription', 'STK Push failed'),
+                'response_code': result.get('ResponseCode')
+            }
+
     def format_phone_number(self, phone):
         """
         Format phone number to M-Pesa format (254XXXXXXXXX)
@@ -0,0 +1,163 @@
+"""
+Rate Limiting
+Token buckets keyed per user, IP address and phone number, so one client
+can't flood logins, sign-ups or M-Pesa prompts
+
+A rate of 'N/period' lets N requests through at once and refills the
+bucket evenly over the period. With the Redis cache the buckets live in
+Redis and each take is one Lua script, atomic across every worker
+process. Otherwise (or while Redis is unreachable) they live in this
+process's memory behind a lock.
+"""
+import math
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.redis import RedisCache
+from django.shortcuts import render
+
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+# KEYS[1] bucket hash; ARGV rate per second, burst, now. Returns the seconds
+# to wait as a string (Lua numbers come back truncated to integers), 0 if taken.
+TAKE_SCRIPT = """
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'stamp')
+local tokens = tonumber(state[1]) or burst
+local stamp = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - stamp) * rate)
+local wait = 0
+if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'stamp', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+return tostring(wait)
+"""
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def parse_rate(rate):
+    """'5/m' -> (5 tokens per second / 60, burst of 5)"""
+    count, period = rate.split('/')
+    return int(count) / PERIODS[period], int(count)
+
+
+class LocalBuckets:
+    """Buckets in this process's memory; a lock makes each take atomic"""
+    blocking = False
+
+    # Drop idle buckets every this many takes, so the dict can't grow forever
+    SWEEP_EVERY = 1000
+
+    def __init__(self):
+        self._buckets = {}  # key -> [tokens, stamp, full again at]
+        self._lock = threading.Lock()
+        self._takes = 0
+
+    def take(self, key, rate, burst, now=None):
+        """Take one token; returns 0, or the seconds until one is available"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            tokens, stamp, _ = self._buckets.get(key, (burst, now, now))
+            tokens = min(burst, tokens + max(0.0, now - stamp) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = [tokens, now, now + (burst - tokens) / rate]
+
+            self._takes += 1
+            if self._takes % self.SWEEP_EVERY == 0:
+                self._buckets = {k: v for k, v in self._buckets.items() if v[2] > now}
+        return wait
+
+
+class CacheBuckets:
+    """Buckets in the Redis cache, shared by every worker process"""
+    blocking = True
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.fallback = LocalBuckets()
+        self._script = None
+
+    def take(self, key, rate, burst, now=None):
+        key = self.cache.make_and_validate_key(key)
+        try:
+            client = self.cache._cache.get_client(key, write=True)
+            if self._script is None:
+                self._script = client.register_script(TAKE_SCRIPT)
+            wait = self._script(keys=[key], args=[rate, burst, time.time() if now is None else now], client=client)
+            return float(wait)
+        except Exception as e:
+            print(f"Rate limit check in Redis failed, using local buckets: {e}")
+            return self.fallback.take(key, rate, burst, now)
+
+
+def get_limiter():
+    """Process-wide buckets: in Redis when it is the cache, else in memory"""
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                default = caches['default']
+                _limiter = CacheBuckets(default) if isinstance(default, RedisCache) else LocalBuckets()
+    return _limiter
+
+
+def check(scope, **identities):
+    """
+    Take a token from each RATE_LIMITS[scope] bucket for the given identities
+
+    identities maps a key kind ('user', 'ip', 'phone', ...) to its value;
+    kinds without a configured rate, or with an empty value, are skipped.
+
+    Returns:
+        0 when the request may go ahead, else the seconds until it may retry
+    """
+    rates = getattr(settings, 'RATE_LIMITS', {}).get(scope, {})
+    limiter = get_limiter()
+    for kind, value in identities.items():
+        if kind not in rates or value in (None, ''):
+            continue
+        rate, burst = parse_rate(rates[kind])
+        wait = limiter.take(f'ratelimit:{scope}:{kind}:{value}', rate, burst)
+        if wait:
+            return wait
+    return 0
+
+
+async def acheck(scope, **identities):
+    """check() for async views; Redis round trips run off the event loop"""
+    if get_limiter().blocking:
+        return await sync_to_async(check)(scope, **identities)
+    return check(scope, **identities)
+
+
+def client_ip(request):
+    """
+    The client's address
+
+    Behind a reverse proxy set RATE_LIMIT_IP_HEADER (e.g.
+    'HTTP_X_FORWARDED_FOR'); the last address in it is the one the proxy
+    saw, earlier ones are whatever the client chose to send.
+    """
+    header = getattr(settings, 'RATE_LIMIT_IP_HEADER', None)
+    if header and request.META.get(header):
+        return request.META[header].split(',')[-1].strip()
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def too_many_requests(request, retry_after, message):
+    """429 page telling the client how long to wait"""
+    retry_after = max(1, math.ceil(retry_after))
+    response = render(request, 'housesApp/too_many_requests.html',
+                      {'message': message, 'retry_after': retry_after}, status=429)
+    response['Retry-After'] = str(retry_after)
+    return response
@@ -0,0 +1,135 @@
+"""
+M-Pesa Payment Reconciliation
+Settles payments whose callback never arrived by asking Daraja directly
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .callbacks import drain_callbacks
+from .events import publish_payments
+from .models import Payment
+from .mpesa_service import mpesa_service
+from .rollups import record_settled_payments
+
+
+class RateLimiter:
+    """Spaces calls at least 1/rate seconds apart across threads"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def pause(self, seconds):
+        """Push every later call back, e.g. after Daraja answers 429"""
+        with self._lock:
+            self._next = max(self._next, time.monotonic() + seconds)
+
+
+def stale_pending_payments(cutoff, batch_size, after=None):
+    """
+    One batch of pending payments created before cutoff, oldest first
+
+    Walks (created_at, id) with a keyset so payments Daraja still reports
+    as pending are not fetched again in the same run; served by
+    payment_status_created_idx.
+    """
+    payments = Payment.objects.filter(status=Payment.STATUS_PENDING, created_at__lt=cutoff)
+    if after is not None:
+        created_at, payment_id = after
+        payments = payments.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=payment_id))
+    return list(
+        payments.order_by('created_at', 'id')
+        .only('id', 'checkout_request_id', 'created_at')[:batch_size]
+    )
+
+
+def reconcile_payments(older_than=None, batch_size=None, workers=None, rate=None, service=None):
+    """
+    Query Daraja for every stale pending payment and record the outcomes
+
+    Queued callbacks are applied first so only real stragglers are
+    queried. Queries run on a bounded thread pool at no more than `rate`
+    per second, and each batch's outcomes are written with one
+    bulk_update. A payment a callback settled meanwhile is left alone.
+
+    Returns:
+        dict of counts: checked, completed, failed, pending, errors
+    """
+    older_than = older_than or timedelta(seconds=getattr(settings, 'MPESA_RECONCILE_AFTER', 300))
+    batch_size = batch_size or getattr(settings, 'MPESA_RECONCILE_BATCH_SIZE', 200)
+    workers = workers or getattr(settings, 'MPESA_RECONCILE_WORKERS', 8)
+    rate = getattr(settings, 'MPESA_QUERY_RATE', 5) if rate is None else rate
+    service = service or mpesa_service
+
+    drain_callbacks()
+    cutoff = timezone.now() - older_than
+    limiter = RateLimiter(rate)
+    totals = {'checked': 0, 'completed': 0, 'failed': 0, 'pending': 0, 'errors': 0}
+
+    def query(payment):
+        if not payment.checkout_request_id:
+            # The push was never recorded as sent, so Daraja has nothing to report
+            return {'status': 'failed', 'message': 'STK push was never sent'}
+        limiter.wait()
+        result = service.query_stk_status(payment.checkout_request_id)
+        if result['status'] == 'rate_limited':
+            limiter.pause(result['retry_after'])
+        return result
+
+    after = None
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='reconcile') as executor:
+        while True:
+            payments = stale_pending_payments(cutoff, batch_size, after)
+            if not payments:
+                break
+            after = (payments[-1].created_at, payments[-1].id)
+
+            outcomes = {}
+            for payment, result in zip(payments, executor.map(query, payments)):
+                totals['checked'] += 1
+                if result['status'] in ('completed', 'failed'):
+                    outcomes[payment.id] = result['status']
+                    totals[result['status']] += 1
+                elif result['status'] == 'pending':
+                    totals['pending'] += 1
+                else:
+                    totals['errors'] += 1
+            _record_outcomes(outcomes)
+
+    return totals
+
+
+def _record_outcomes(outcomes):
+    if not outcomes:
+        return
+    now = timezone.now()
+    with transaction.atomic():
+        payments = list(
+            Payment.objects.select_for_update()
+            .filter(id__in=outcomes, status=Payment.STATUS_PENDING)
+            .only('id', 'status', 'mpesa_receipt_number', 'updated_at')
+        )
+        for payment in payments:
+            payment.status = outcomes[payment.id]
+            payment.updated_at = now
+        Payment.objects.bulk_update(payments, ['status', 'updated_at'], batch_size=500)
+        record_settled_payments([payment.id for payment in payments])
+        transaction.on_commit(lambda: publish_payments(payments))
@@ -0,0 +1,259 @@
+"""
+House and Landlord Rollups
+Keeps per-house and per-landlord-per-month totals current as bookings and
+payments happen, so reports read a few rollup rows instead of joining
+House -> Booking -> Payment
+
+Every record_* function runs inside the writer's transaction and adds
+deltas with UPDATE ... SET col = col + n, so concurrent writers never
+overwrite each other. Changes made behind these hooks (admin edits to a
+payment's status, raw SQL) drift until `manage.py rebuild_rollups`.
+"""
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count, DateField, Exists, F, Max, OuterRef, Q, Sum, Value
+from django.db.models.functions import Coalesce, Greatest, TruncMonth
+from django.utils import timezone
+
+from .models import Booking, House, HouseRollup, LandlordMonthRollup, Payment
+
+
+MONEY_FIELDS = ['bookings', 'revenue', 'payments_completed', 'pending_amount', 'pending_count']
+
+
+def month_of(moment):
+    """First day of the month `moment` falls in, in TIME_ZONE like TruncMonth"""
+    return timezone.localtime(moment).date().replace(day=1)
+
+
+def _add(model, key_fields, deltas):
+    """
+    Add {key: {field: amount}} to rollup rows, creating missing rows first
+
+    One UPDATE per key; amounts of zero are left out.
+    """
+    if not deltas:
+        return
+    model.objects.bulk_create(
+        [model(**dict(zip(key_fields, key))) for key in deltas], ignore_conflicts=True
+    )
+    for key, changes in deltas.items():
+        changes = {name: F(name) + amount for name, amount in changes.items() if amount}
+        if changes:
+            model.objects.filter(**dict(zip(key_fields, key))).update(**changes)
+
+
+def _deltas():
+    return defaultdict(lambda: defaultdict(int))
+
+
+def record_new_houses(houses):
+    """Start rollups for houses just inserted; a vacant house starts its vacancy now"""
+    now = timezone.now()
+    HouseRollup.objects.bulk_create([
+        HouseRollup(house_id=house.pk, vacant_since=now if house.status == House.STATUS_VACANT else None)
+        for house in houses
+    ], ignore_conflicts=True)
+
+
+def record_house_status(house_id, status):
+    """Open or close the house's running vacancy when its status changes"""
+    now = timezone.now()
+    with transaction.atomic():
+        rollup, _ = HouseRollup.objects.select_for_update().get_or_create(house_id=house_id)
+        if status == House.STATUS_VACANT and rollup.vacant_since is None:
+            rollup.vacant_since = now
+        elif status == House.STATUS_OCCUPIED and rollup.vacant_since is not None:
+            rollup.vacant_time += max(now - rollup.vacant_since, timedelta(0))
+            rollup.vacant_since = None
+        else:
+            return
+        rollup.save(update_fields=['vacant_time', 'vacant_since'])
+
+
+def record_bookings(booking_ids):
+    """Count bookings just created"""
+    bookings = Booking.objects.filter(id__in=booking_ids).values_list('house_id', 'house__owner_id', 'booking_date')
+    houses, landlords = _deltas(), _deltas()
+    last_booked = {}
+    for house_id, owner_id, booked_at in bookings:
+        houses[(house_id,)]['bookings'] += 1
+        last_booked[house_id] = max(booked_at, last_booked.get(house_id, booked_at))
+        if owner_id:
+            landlords[(owner_id, month_of(booked_at))]['bookings'] += 1
+
+    _add(HouseRollup, ['house_id'], houses)
+    _add(LandlordMonthRollup, ['owner_id', 'month'], landlords)
+    for house_id, booked_at in last_booked.items():
+        HouseRollup.objects.filter(house_id=house_id).update(
+            last_booked_at=Greatest(Coalesce('last_booked_at', Value(booked_at)), Value(booked_at))
+        )
+
+
+def _payment_rows(payment_ids):
+    return Payment.objects.filter(id__in=payment_ids).values_list(
+        'amount', 'status', 'created_at', 'transaction_date', 'updated_at',
+        'booking__house_id', 'booking__house__owner_id',
+    )
+
+
+def _add_payment(houses, landlords, sign, amount, status, month, house_id, owner_id):
+    if status == Payment.STATUS_COMPLETED:
+        changes = {'revenue': sign * amount, 'payments_completed': sign}
+    elif status == Payment.STATUS_PENDING:
+        changes = {'pending_amount': sign * amount, 'pending_count': sign}
+    else:
+        return
+    for name, value in changes.items():
+        houses[(house_id,)][name] += value
+        if owner_id:
+            landlords[(owner_id, month)][name] += value
+
+
+def record_new_payments(payment_ids):
+    """Count payments just created, pending or (for imports) already settled"""
+    houses, landlords = _deltas(), _deltas()
+    for amount, status, created_at, transaction_date, updated_at, house_id, owner_id in _payment_rows(payment_ids):
+        settled_at = created_at if status == Payment.STATUS_PENDING else transaction_date or updated_at
+        _add_payment(houses, landlords, 1, amount, status, month_of(settled_at), house_id, owner_id)
+    _add(HouseRollup, ['house_id'], houses)
+    _add(LandlordMonthRollup, ['owner_id', 'month'], landlords)
+
+
+def record_settled_payments(payment_ids):
+    """
+    Move payments that just left pending out of the pending totals
+
+    Call after the status update, in the same transaction, with only the
+    payments that were pending before it.
+    """
+    houses, landlords = _deltas(), _deltas()
+    for amount, status, created_at, transaction_date, updated_at, house_id, owner_id in _payment_rows(payment_ids):
+        started, settled = month_of(created_at), month_of(transaction_date or updated_at)
+        _add_payment(houses, landlords, -1, amount, Payment.STATUS_PENDING, started, house_id, owner_id)
+        _add_payment(houses, landlords, 1, amount, status, settled, house_id, owner_id)
+    _add(HouseRollup, ['house_id'], houses)
+    _add(LandlordMonthRollup, ['owner_id', 'month'], landlords)
+
+
+def rebuild_rollups(chunk_size=1000):
+    """
+    Recompute every rollup from bookings and payments
+
+    Houses, then landlords, are processed chunk_size at a time, each chunk
+    with a few grouped queries in its own transaction. Vacancy can't be
+    recomputed (status history isn't kept), so existing vacancy totals
+    are left as they are.
+
+    Returns:
+        (houses rebuilt, landlords rebuilt)
+    """
+    houses = landlords = 0
+    after = 0
+    while True:
+        chunk = list(
+            House.objects.filter(id__gt=after).order_by('id').values_list('id', 'status')[:chunk_size]
+        )
+        if not chunk:
+            break
+        after = chunk[-1][0]
+        with transaction.atomic():
+            _rebuild_houses(chunk)
+        houses += len(chunk)
+
+    owners = (
+        House.objects.filter(owner__isnull=False)
+        .order_by('owner_id').values_list('owner_id', flat=True).distinct()
+    )
+    after = 0
+    while True:
+        chunk = list(owners.filter(owner_id__gt=after)[:chunk_size])
+        if not chunk:
+            break
+        after = chunk[-1]
+        with transaction.atomic():
+            _rebuild_landlords(chunk)
+        landlords += len(chunk)
+
+    # Landlords with no houses left
+    LandlordMonthRollup.objects.filter(~Exists(House.objects.filter(owner=OuterRef('owner')))).delete()
+    return houses, landlords
+
+
+def _rebuild_houses(chunk):
+    now = timezone.now()
+    ids = [house_id for house_id, _ in chunk]
+    bookings = {
+        row['house_id']: row for row in
+        Booking.objects.filter(house_id__in=ids).values('house_id')
+        .annotate(count=Count('id'), last=Max('booking_date'))
+    }
+    payments = {
+        row['booking__house_id']: row for row in
+        Payment.objects.filter(booking__house_id__in=ids).values('booking__house_id').annotate(**_payment_totals())
+    }
+
+    rollups = []
+    for house_id, status in chunk:
+        booked = bookings.get(house_id, {})
+        paid = payments.get(house_id, {})
+        rollups.append(HouseRollup(
+            house_id=house_id,
+            bookings=booked.get('count', 0),
+            last_booked_at=booked.get('last'),
+            revenue=paid.get('revenue') or Decimal('0'),
+            payments_completed=paid.get('payments_completed', 0),
+            pending_amount=paid.get('pending_amount') or Decimal('0'),
+            pending_count=paid.get('pending_count', 0),
+            # Only used when the row is new
+            vacant_since=now if status == House.STATUS_VACANT else None,
+        ))
+    HouseRollup.objects.bulk_create(
+        rollups, update_conflicts=True, unique_fields=['house'],
+        update_fields=MONEY_FIELDS + ['last_booked_at'],
+    )
+
+
+def _rebuild_landlords(owner_ids):
+    totals = defaultdict(lambda: defaultdict(int))
+    bookings = (
+        Booking.objects.filter(house__owner_id__in=owner_ids)
+        .values(owner=F('house__owner_id'), month=TruncMonth('booking_date', output_field=DateField()))
+        .annotate(bookings=Count('id'))
+    )
+    completed = (
+        Payment.objects.filter(booking__house__owner_id__in=owner_ids, status=Payment.STATUS_COMPLETED)
+        .values(owner=F('booking__house__owner_id'), month=TruncMonth(
+            Coalesce('transaction_date', 'updated_at'), output_field=DateField()
+        ))
+        .annotate(revenue=Sum('amount'), payments_completed=Count('id'))
+    )
+    pending = (
+        Payment.objects.filter(booking__house__owner_id__in=owner_ids, status=Payment.STATUS_PENDING)
+        .values(owner=F('booking__house__owner_id'), month=TruncMonth('created_at', output_field=DateField()))
+        .annotate(pending_amount=Sum('amount'), pending_count=Count('id'))
+    )
+    for rows in (bookings, completed, pending):
+        for row in rows:
+            key = (row.pop('owner'), row.pop('month'))
+            totals[key].update(row)
+
+    LandlordMonthRollup.objects.filter(owner_id__in=owner_ids).delete()
+    LandlordMonthRollup.objects.bulk_create(
+        LandlordMonthRollup(owner_id=owner_id, month=month, **values)
+        for (owner_id, month), values in totals.items()
+    )
+
+
+def _payment_totals():
+    completed = Q(status=Payment.STATUS_COMPLETED)
+    pending = Q(status=Payment.STATUS_PENDING)
+    return {
+        'revenue': Sum('amount', filter=completed),
+        'payments_completed': Count('id', filter=completed),
+        'pending_amount': Sum('amount', filter=pending),
+        'pending_count': Count('id', filter=pending),
+    }
@@ -0,0 +1,161 @@
+"""
+House Full-Text Search
+Ranked search over House.title, description and location
+
+SQLite uses an FTS5 virtual table kept in sync by model signals;
+PostgreSQL uses a GIN-indexed tsvector expression on the house table.
+Both sit behind the same interface, picked by get_backend().
+"""
+import re
+from dataclasses import dataclass
+
+from django.db import connection
+from django.db.models import Q
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from .models import House
+
+
+FTS_TABLE = 'housesApp_house_fts'
+
+# Weighted document shared by the search query and the index in migration
+# 0006; PostgreSQL only uses the index when both expressions are identical
+PG_DOCUMENT = (
+    "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(location, '')), 'B') || "
+    "setweight(to_tsvector('english', coalesce(description, '')), 'C')"
+)
+
+# Snippet highlight markers, swapped for <mark> after the text is escaped
+MARK_START, MARK_END = '\x02', '\x03'
+
+
+@dataclass
+class SearchResult:
+    house: House
+    rank: float
+    snippet: str
+
+
+def highlight(snippet):
+    """Escape a snippet and turn the highlight markers into <mark> tags"""
+    html = escape(snippet).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>')
+    return mark_safe(html)
+
+
+def query_terms(query):
+    return re.findall(r'\w+', query.lower())
+
+
+class BaseSearchBackend:
+    def index(self, house):
+        """Add or refresh one house in the index"""
+
+    def remove(self, house_id):
+        """Drop one house from the index"""
+
+    def rebuild(self):
+        """Re-index every house"""
+
+    def search_ids(self, query, limit=20):
+        """Return [(house_id, rank, snippet)] best match first; limit None returns every match"""
+        raise NotImplementedError
+
+    def search(self, query, limit=20):
+        """Ranked SearchResults for a free-text query"""
+        if not query_terms(query):
+            return []
+        hits = self.search_ids(query, limit)
+        houses = House.objects.in_bulk([house_id for house_id, _, _ in hits])
+        return [
+            SearchResult(house=houses[house_id], rank=rank, snippet=highlight(snippet))
+            for house_id, rank, snippet in hits if house_id in houses
+        ]
+
+
+class SQLiteFTSBackend(BaseSearchBackend):
+    """FTS5 virtual table keyed by house id, ranked with bm25"""
+
+    # bm25 column weights: title, description, location
+    rank_function = f'bm25({FTS_TABLE}, 10.0, 1.0, 5.0)'
+
+    def index(self, house):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [house.pk])
+            cursor.execute(
+                f'INSERT INTO {FTS_TABLE} (rowid, title, description, location) VALUES (%s, %s, %s, %s)',
+                [house.pk, house.title, house.description, house.location]
+            )
+
+    def remove(self, house_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [house_id])
+
+    def rebuild(self):
+        table = House._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE}')
+            cursor.execute(
+                f'INSERT INTO {FTS_TABLE} (rowid, title, description, location) '
+                f'SELECT id, title, description, location FROM "{table}"'
+            )
+            cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')")
+
+    def search_ids(self, query, limit=20):
+        # Quote every term so user input can't inject FTS5 syntax; prefix-match each
+        match = ' '.join(f'"{term}"*' for term in query_terms(query))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT rowid, {self.rank_function} AS rank, "
+                f"snippet({FTS_TABLE}, 1, %s, %s, '…', 16) "
+                f"FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s ORDER BY rank LIMIT %s",
+                # SQLite reads a negative LIMIT as no limit
+                [MARK_START, MARK_END, match, -1 if limit is None else limit]
+            )
+            # bm25 is lower-is-better; flip it so every backend ranks higher-is-better
+            return [(house_id, -rank, snippet) for house_id, rank, snippet in cursor.fetchall()]
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    """tsvector over the house row itself; the GIN index keeps it in sync"""
+
+    def search_ids(self, query, limit=20):
+        table = House._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT id, ts_rank({PG_DOCUMENT}, query) AS rank, "
+                f"ts_headline('english', description, query, %s) "
+                f"FROM \"{table}\", websearch_to_tsquery('english', %s) query "
+                f"WHERE {PG_DOCUMENT} @@ query ORDER BY rank DESC LIMIT %s",
+                [f'StartSel={MARK_START}, StopSel={MARK_END}, MaxWords=20, MinWords=8', query, limit]
+            )
+            return cursor.fetchall()
+
+
+class LikeSearchBackend(BaseSearchBackend):
+    """
+    Unindexed LIKE '%term%' scan, the same thing the admin's search_fields does
+
+    Used on other databases and as the baseline in bench_search.
+    """
+
+    def search_ids(self, query, limit=20):
+        queryset = House.objects.all()
+        for term in query_terms(query):
+            queryset = queryset.filter(
+                Q(title__icontains=term) | Q(description__icontains=term) | Q(location__icontains=term)
+            )
+        return [
+            (house_id, 0.0, description[:120])
+            for house_id, description in queryset.order_by('-id').values_list('id', 'description')[:limit]
+        ]
+
+
+def get_backend():
+    """Search backend for the default database"""
+    if connection.vendor == 'sqlite':
+        return SQLiteFTSBackend()
+    if connection.vendor == 'postgresql':
+        return PostgresSearchBackend()
+    return LikeSearchBackend()
@@ -0,0 +1,88 @@
+"""
+Model signal handlers for housesApp
+"""
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .auth_backends import forget_user
+from .caching import invalidate_house
+from .dispatch import submit
+from .geo import index_location, remove_location
+from .images import generate_house_variants, needs_variants
+from .models import Booking, House, Payment
+from .rollups import record_bookings, record_house_status, record_new_houses, record_new_payments
+from .search import get_backend
+
+
+@receiver(post_save, sender=House)
+def queue_image_variants(sender, instance, raw=False, **kwargs):
+    """Resize a new or replaced house image in the background"""
+    if not raw and needs_variants(instance):
+        submit(generate_house_variants, instance.pk)
+
+
+@receiver(post_save, sender=House)
+def index_house(sender, instance, raw=False, **kwargs):
+    """Keep the full-text index in step with the house row, in the same transaction"""
+    if not raw:
+        get_backend().index(instance)
+
+
+@receiver(post_delete, sender=House)
+def unindex_house(sender, instance, **kwargs):
+    get_backend().remove(instance.pk)
+    remove_location(instance.pk)
+
+
+@receiver(post_save, sender=House)
+def index_house_location(sender, instance, raw=False, **kwargs):
+    """Keep the nearby-search R-tree in step with the house coordinates"""
+    if not raw:
+        index_location(instance)
+
+
+@receiver(post_save, sender=House)
+@receiver(post_delete, sender=House)
+def invalidate_cached_pages(sender, instance, raw=False, **kwargs):
+    """
+    Retire cached pages and facet counts whenever a house changes
+
+    Only after commit: a request that saw the new version while the old
+    row was still visible would cache the old page under it.
+    """
+    if not raw:
+        house_id = instance.pk
+        transaction.on_commit(lambda: invalidate_house(house_id))
+
+
+@receiver(post_save, sender=House)
+def track_vacancy(sender, instance, created, raw=False, **kwargs):
+    """Start or stop the house's vacancy clock in its rollup"""
+    if raw:
+        return
+    if created:
+        record_new_houses([instance])
+    else:
+        record_house_status(instance.pk, instance.status)
+
+
+@receiver(post_save, sender=Booking)
+def count_booking(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        record_bookings([instance.pk])
+
+
+@receiver(post_save, sender=Payment)
+def count_payment(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        record_new_payments([instance.pk])
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def forget_cached_user(sender, instance, **kwargs):
+    """Drop the cached request.user once the change is visible to other requests"""
+    user_id = instance.pk
+    transaction.on_commit(lambda: forget_user(user_id))
@@ -0,0 +1,48 @@
+"""
+Landlord Dashboard Statistics
+Computes every dashboard figure for a landlord in a single query
+"""
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.db.models import Count, OuterRef, Q, Subquery, Sum
+
+from .models import House, LandlordMonthRollup
+
+
+def _per_owner(queryset, aggregate):
+    """Correlated subquery computing one aggregate over queryset for the outer user"""
+    return Subquery(queryset.filter(owner=OuterRef('pk')).values('owner').annotate(value=aggregate).values('value'))
+
+
+def landlord_stats(owner):
+    """
+    House counts and payment totals for one landlord
+
+    Counts come from the (owner, status) index on House; money comes from
+    the landlord's monthly rollups (see housesApp.rollups), a row per month
+    rather than a scan of their payment history. Both are scalar
+    subqueries of one statement.
+
+    Returns:
+        dict with total, vacant, occupied, occupancy_rate, revenue,
+        pending_amount and pending_count
+    """
+    stats = User.objects.filter(pk=owner.pk).values(
+        total=_per_owner(House.objects, Count('id')),
+        vacant=_per_owner(House.objects, Count('id', filter=Q(status=House.STATUS_VACANT))),
+        occupied=_per_owner(House.objects, Count('id', filter=Q(status=House.STATUS_OCCUPIED))),
+        revenue=_per_owner(LandlordMonthRollup.objects, Sum('revenue')),
+        pending_amount=_per_owner(LandlordMonthRollup.objects, Sum('pending_amount')),
+        pending_count=_per_owner(LandlordMonthRollup.objects, Sum('pending_count')),
+    ).first() or {}
+
+    for name in ('total', 'vacant', 'occupied', 'pending_count'):
+        stats[name] = stats.get(name) or 0
+    for name in ('revenue', 'pending_amount'):
+        stats[name] = stats.get(name) or Decimal('0')
+    if stats['total']:
+        stats['occupancy_rate'] = round(stats['occupied'] * 100 / stats['total'], 1)
+    else:
+        stats['occupancy_rate'] = 0
+    return stats
@@ -0,0 +1,23 @@
+from django import template
+
+from ..images import srcset, variant_url
+
+register = template.Library()
+
+
+@register.inclusion_tag('housesApp/includes/house_picture.html')
+def house_picture(house, variant='card', sizes='100vw', css_class='img-fluid rounded', loading='lazy'):
+    """
+    Responsive <picture> for a house image
+
+    Usage: {% house_picture house 'card' '(max-width: 768px) 100vw, 33vw' %}
+    """
+    return {
+        'house': house,
+        'src': variant_url(house, variant),
+        'webp_srcset': srcset(house, 'webp'),
+        'jpeg_srcset': srcset(house, 'jpeg'),
+        'sizes': sizes,
+        'css_class': css_class,
+        'loading': loading,
+    }
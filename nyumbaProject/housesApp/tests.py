@@ -1,3 +1,1525 @@
-from django.test import TestCase
+import asyncio
+import csv
+import http.server
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import unittest
+from datetime import timedelta
+from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+import requests
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from . import dispatch
+from nyumbaProject import metrics, replicas
+from nyumbaProject.nplusone import NPlusOneDetector
+from .bookings import reserve_house
+from .caching import get_listings_version
+from .callbacks import apply_pending_callbacks, drain_callbacks, parse_callback
+from .daraja_stub import STK_QUERY_PATH, DarajaStubServer
+from .events import payment_event_stream
+from .facets import get_facets
+from .geo import haversine_km, nearby, nearest, rebuild_locations, within_radius
+from .images import generate_variants
+from .models import House, Booking, Payment, MpesaCallback, HouseRollup, LandlordMonthRollup
+from .mpesa_service import MpesaService, TOKEN_CACHE_KEY, TOKEN_LOCK_KEY
+from . import callbacks, ratelimit, reconcile
+from .search import get_backend
+from .rollups import rebuild_rollups
+from .stats import landlord_stats
+from .transfer import BookingImporter, HouseImporter, PaymentImporter, import_rows, read_rows
+
+
+class KeysetPaginationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.houses = [
+            House.objects.create(
+                title=f'House {i}', price=5000 * (i + 1), location='Kilimani' if i % 2 else 'Ruaka',
+                description='', image='', status=House.STATUS_OCCUPIED if i % 3 == 0 else House.STATUS_VACANT
+            )
+            for i in range(7)
+        ]
+
+    def fetch_all(self, **params):
+        """Follow next cursors to the end; returns the ids in order and the pages read"""
+        ids, pages, after = [], 0, None
+        while True:
+            query = {**params, **({'after': after} if after else {})}
+            response = self.client.get(reverse('housesApp:houses_api'), query)
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            ids += [house['id'] for house in data['results']]
+            pages += 1
+            after = data['next']
+            if after is None:
+                return ids, pages
+
+    def test_cursors_walk_every_house_once_newest_first(self):
+        ids, pages = self.fetch_all(limit=3)
+        self.assertEqual(ids, sorted((house.id for house in self.houses), reverse=True))
+        self.assertEqual(pages, 3)
+
+    def test_last_page_has_no_next_cursor(self):
+        data = self.client.get(reverse('housesApp:houses_api'), {'limit': 7}).json()
+        self.assertEqual(len(data['results']), 7)
+        self.assertIsNone(data['next'])
+
+    def test_filters_apply_across_pages(self):
+        ids, _ = self.fetch_all(limit=1, status='vacant', location='Kilimani', min_price=10000, max_price=30000)
+        expected = [
+            house.id for house in reversed(self.houses)
+            if house.status == 'vacant' and house.location == 'Kilimani' and 10000 <= house.price <= 30000
+        ]
+        self.assertEqual(ids, expected)
+        self.assertTrue(expected)
+
+    def test_invalid_filters_or_cursor_are_rejected(self):
+        url = reverse('housesApp:houses_api')
+        for params in ({'after': 'abc'}, {'after': 0}, {'limit': -1}, {'status': 'sold'},
+                       {'min_price': 20000, 'max_price': 10000}):
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 400, params)
+            self.assertIn('errors', response.json())
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN output is SQLite specific')
+class HotQueryIndexTests(TestCase):
+    """Every hot query must be answered from an index, never a full table scan"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(username='landlord', password='pass12345')
+        cls.house = House.objects.create(
+            title='Test House', price=20000, location='Kilimani',
+            description='Two bedroom', image='house_images/test.jpg', owner=cls.owner
+        )
+
+    def assertNoFullScan(self, queryset):
+        plan = queryset.explain()
+        table = queryset.model._meta.db_table
+        full_scan = re.compile(rf'\bSCAN {table}\b(?! USING (COVERING )?INDEX)')
+        self.assertIsNone(full_scan.search(plan), f"Full table scan on {table}:\n{plan}")
+
+    def test_dashboard_owner_status(self):
+        self.assertNoFullScan(House.objects.filter(owner=self.owner, status=House.STATUS_VACANT))
+
+    def test_callback_checkout_request_id(self):
+        self.assertNoFullScan(Payment.objects.filter(checkout_request_id='ws_CO_123'))
+
+    def test_status_filter(self):
+        self.assertNoFullScan(House.objects.filter(status=House.STATUS_VACANT).order_by('-id'))
+
+    def test_location_filter(self):
+        self.assertNoFullScan(House.objects.filter(location='Kilimani').order_by('-id'))
+
+    def test_price_range(self):
+        self.assertNoFullScan(House.objects.filter(price__gte=10000, price__lte=20000))
+
+    def test_booking_date_range(self):
+        since = timezone.now() - timedelta(days=30)
+        self.assertNoFullScan(Booking.objects.filter(booking_date__gte=since))
+
+
+class LandlordStatsTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(username='landlord', password='pass12345')
+        cls.tenant = User.objects.create_user(username='tenant', password='pass12345')
+        statuses = [House.STATUS_OCCUPIED, House.STATUS_OCCUPIED, House.STATUS_OCCUPIED, House.STATUS_VACANT]
+        payment_statuses = [Payment.STATUS_COMPLETED, Payment.STATUS_COMPLETED, Payment.STATUS_PENDING, None]
+        for i, (status, payment_status) in enumerate(zip(statuses, payment_statuses)):
+            house = House.objects.create(
+                title=f'House {i}', price=10000, location='Kilimani', description='',
+                image='house_images/test.jpg', owner=cls.owner, status=status
+            )
+            booking = Booking.objects.create(user=cls.tenant, house=house, phone_number='0722000000')
+            if payment_status:
+                Payment.objects.create(
+                    booking=booking, amount=house.price, phone_number='254722000000', status=payment_status
+                )
+
+    def test_stats_in_one_query(self):
+        with self.assertNumQueries(1):
+            stats = landlord_stats(self.owner)
+
+        self.assertEqual(stats['total'], 4)
+        self.assertEqual(stats['vacant'], 1)
+        self.assertEqual(stats['occupied'], 3)
+        self.assertEqual(stats['occupancy_rate'], 75.0)
+        self.assertEqual(stats['revenue'], 20000)
+        self.assertEqual(stats['pending_amount'], 10000)
+        self.assertEqual(stats['pending_count'], 1)
+
+    def test_no_houses(self):
+        stats = landlord_stats(self.tenant)
+        self.assertEqual(stats['total'], 0)
+        self.assertEqual(stats['occupancy_rate'], 0)
+        self.assertEqual(stats['revenue'], 0)
+
+
+class MpesaTokenCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.service = MpesaService()
+        self.fetches = 0
+
+    def fake_fetch(self, expires_in=3599):
+        def fetch():
+            self.fetches += 1
+            time.sleep(0.05)
+            return f'token-{self.fetches}', expires_in
+        return fetch
+
+    def test_token_is_reused(self):
+        with mock.patch.object(self.service, '_fetch_access_token', self.fake_fetch()):
+            self.assertEqual(self.service.get_access_token(), 'token-1')
+            self.assertEqual(self.service.get_access_token(), 'token-1')
+        self.assertEqual(self.fetches, 1)
+
+    def test_single_flight_under_concurrency(self):
+        tokens = []
+        with mock.patch.object(self.service, '_fetch_access_token', self.fake_fetch()):
+            threads = [
+                threading.Thread(target=lambda: tokens.append(self.service.get_access_token()))
+                for _ in range(20)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(self.fetches, 1)
+        self.assertEqual(set(tokens), {'token-1'})
+
+    def test_timed_out_waiter_keeps_others_lock(self):
+        cache.add(TOKEN_LOCK_KEY, 'other-process', timeout=30)
+        with mock.patch.object(self.service, '_fetch_access_token', self.fake_fetch()), \
+                mock.patch.object(self.service, '_wait_for_refresh', return_value=None):
+            self.assertEqual(self.service.get_access_token(), 'token-1')
+        self.assertEqual(cache.get(TOKEN_LOCK_KEY), 'other-process')
+
+    def test_async_timed_out_waiter_keeps_others_lock(self):
+        cache.add(TOKEN_LOCK_KEY, 'other-process', timeout=30)
+        with mock.patch.object(self.service, '_afetch_access_token', mock.AsyncMock(return_value=('token-1', 3599))), \
+                mock.patch.object(self.service, '_await_refresh', mock.AsyncMock(return_value=None)):
+            self.assertEqual(async_to_sync(self.service._arefresh_access_token)(), 'token-1')
+        self.assertEqual(cache.get(TOKEN_LOCK_KEY), 'other-process')
+
+    def test_early_refresh_serves_current_token(self):
+        cache.set(TOKEN_CACHE_KEY, {
+            'token': 'old', 'expires_at': time.time() + 60, 'refresh_at': time.time() - 1,
+        })
+        with mock.patch.object(self.service, '_fetch_access_token', self.fake_fetch()):
+            self.assertEqual(self.service.get_access_token(), 'old')
+            deadline = time.time() + 2
+            while cache.get(TOKEN_CACHE_KEY)['token'] == 'old' and time.time() < deadline:
+                time.sleep(0.01)
+        self.assertEqual(cache.get(TOKEN_CACHE_KEY)['token'], 'token-1')
+
+
+@override_settings(MPESA_MAX_RETRIES=2)
+class MpesaSessionTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.statuses = []  # answered in order, then 200
+        self.hits = []
+        test = self
+
+        class Flaky(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def answer(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                test.hits.append(self.command)
+                status = test.statuses.pop(0) if test.statuses else 200
+                body = json.dumps({'access_token': 'token', 'expires_in': '3599', 'ResponseCode': '0',
+                                   'CheckoutRequestID': 'ws_CO_1', 'MerchantRequestID': 'm-1'}).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST = answer
+
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Flaky)
+        threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.service = MpesaService(base_url='http://%s:%d' % server.server_address[:2])
+        # No backoff sleeps between retries
+        patcher = mock.patch('urllib3.util.retry.Retry.get_backoff_time', return_value=0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_get_is_retried_on_5xx_and_429_up_to_the_limit(self):
+        self.statuses = [503, 429]
+        self.assertEqual(self.service._fetch_access_token(), ('token', 3599))
+        self.assertEqual(self.hits, ['GET'] * 3)
+
+        self.hits, self.statuses = [], [500] * 5
+        self.assertEqual(self.service._fetch_access_token(), (None, 0))
+        self.assertEqual(self.hits, ['GET'] * 3)
+
+    def test_post_is_not_resent_after_daraja_answers(self):
+        cache.set(TOKEN_CACHE_KEY, {'token': 'token', 'expires_at': time.time() + 3600,
+                                    'refresh_at': time.time() + 3000})
+        self.statuses = [503]
+        result = self.service.initiate_stk_push('0722000000', 100, house_id=1, user_id=1)
+        self.assertEqual(result['status'], 'error')
+        self.assertEqual(self.hits, ['POST'])
+
+    def test_post_is_retried_when_the_connection_fails(self):
+        with mock.patch('urllib3.util.connection.create_connection', side_effect=ConnectionRefusedError) as connect:
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                self.service._request('POST', self.service.stk_push_url, 'stk_push', json={})
+        self.assertEqual(connect.call_count, 3)
+        self.assertEqual(self.hits, [])
+
+    @override_settings(MPESA_TIMEOUTS={'stk_push': (1, 2)})
+    def test_each_endpoint_uses_its_timeout(self):
+        service = MpesaService(base_url=self.service.base_url)
+        with mock.patch.object(service.session, 'request', wraps=service.session.request) as request:
+            service.get_access_token()
+            service.initiate_stk_push('0722000000', 100, house_id=1, user_id=1)
+            service.query_stk_status('ws_CO_1')
+        timeouts = {call.args[1]: call.kwargs['timeout'] for call in request.call_args_list}
+        self.assertEqual(timeouts, {
+            service.auth_url: (3.05, 10), service.stk_push_url: (1, 2), service.stk_query_url: (3.05, 15),
+        })
+
+    def test_one_session_and_connection_are_reused(self):
+        session = self.service.session
+        for _ in range(3):
+            self.service._request('GET', self.service.auth_url, 'auth')
+        self.assertIs(self.service.session, session)
+        pools = list(session.get_adapter(self.service.base_url).poolmanager.pools._container.values())
+        self.assertEqual(len(pools), 1)
+        self.assertEqual(pools[0].num_connections, 1)
+
+
+class InitiatePaymentDispatchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.tenant = User.objects.create_user(username='tenant', password='pass12345')
+        house = House.objects.create(
+            title='House', price=15000, location='Kilimani', description='', image='house_images/test.jpg'
+        )
+        cls.booking = Booking.objects.create(user=cls.tenant, house=house, phone_number='0722000000')
+
+    def setUp(self):
+        self.client.force_login(self.tenant)
+
+    @mock.patch('housesApp.views.adispatch_stk_push', new_callable=mock.AsyncMock)
+    @mock.patch('housesApp.dispatch.mpesa_service.ainitiate_stk_push', new_callable=mock.AsyncMock)
+    def test_view_returns_before_push(self, stk_push, adispatch):
+        url = reverse('housesApp:initiate_payment', args=[self.booking.id])
+        response = self.client.post(url, {'phone_number': '0722000000'})
+
+        payment = Payment.objects.get()
+        self.assertRedirects(
+            response, f"{reverse('housesApp:dashboard')}?payment={payment.pk}", fetch_redirect_response=False
+        )
+        self.assertEqual(payment.status, Payment.STATUS_PENDING)
+        adispatch.assert_awaited_once_with(payment)
+        stk_push.assert_not_called()
+
+    @mock.patch('housesApp.dispatch.mpesa_service.ainitiate_stk_push', new_callable=mock.AsyncMock)
+    def test_push_records_checkout_request_id(self, stk_push):
+        stk_push.return_value = {
+            'status': 'success', 'checkout_request_id': 'ws_CO_1', 'merchant_request_id': 'm-1'
+        }
+        payment = Payment.objects.create(booking=self.booking, amount=15000, phone_number='254722000000')
+
+        async_to_sync(dispatch.asend_stk_push)(payment.pk)
+
+        payment.refresh_from_db()
+        self.assertEqual(payment.checkout_request_id, 'ws_CO_1')
+        self.assertEqual(payment.status, Payment.STATUS_PENDING)
+
+    @mock.patch('housesApp.dispatch.mpesa_service.initiate_stk_push')
+    def test_failed_push_marks_payment_failed(self, stk_push):
+        stk_push.return_value = {'status': 'error', 'message': 'Failed to get access token'}
+        payment = Payment.objects.create(booking=self.booking, amount=15000, phone_number='254722000000')
+
+        dispatch.send_stk_push(payment.pk)
+
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, Payment.STATUS_FAILED)
+
+
+def stk_callback(checkout_request_id, result_code=0, receipt='QKA1234XYZ'):
+    result = {
+        'MerchantRequestID': 'm-1',
+        'CheckoutRequestID': checkout_request_id,
+        'ResultCode': result_code,
+        'ResultDesc': 'The service request is processed successfully.',
+    }
+    if result_code == 0:
+        result['CallbackMetadata'] = {'Item': [
+            {'Name': 'Amount', 'Value': 15000},
+            {'Name': 'MpesaReceiptNumber', 'Value': receipt},
+            {'Name': 'TransactionDate', 'Value': 20251209103015},
+            {'Name': 'PhoneNumber', 'Value': 254722000000},
+        ]}
+    return json.dumps({'Body': {'stkCallback': result}})
+
+
+@override_settings(MPESA_CALLBACK_AUTO_APPLY=False)
+class PaymentCallbackInboxTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        tenant = User.objects.create_user(username='tenant', password='pass12345')
+        cls.payments = []
+        for i in range(3):
+            house = House.objects.create(
+                title=f'House {i}', price=15000, location='Kilimani', description='', image='house_images/test.jpg'
+            )
+            booking = Booking.objects.create(user=tenant, house=house, phone_number='0722000000')
+            cls.payments.append(Payment.objects.create(
+                booking=booking, amount=15000, phone_number='254722000000', checkout_request_id=f'ws_CO_{i}'
+            ))
+
+    def post_callback(self, payload):
+        return self.client.post(reverse('housesApp:payment_callback'), payload, content_type='application/json')
+
+    def test_callback_is_stored_not_applied(self):
+        response = self.post_callback(stk_callback('ws_CO_0'))
+
+        self.assertEqual(response.json()['ResultCode'], 0)
+        self.assertEqual(MpesaCallback.objects.count(), 1)
+        self.assertEqual(Payment.objects.get(checkout_request_id='ws_CO_0').status, Payment.STATUS_PENDING)
+
+    def test_invalid_payload_is_rejected(self):
+        response = self.post_callback('not json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(MpesaCallback.objects.exists())
+
+    def test_batch_apply_is_idempotent(self):
+        self.post_callback(stk_callback('ws_CO_0', receipt='R0'))
+        self.post_callback(stk_callback('ws_CO_0', receipt='R0'))
+        self.post_callback(stk_callback('ws_CO_1', result_code=1032))
+        self.post_callback(stk_callback('ws_CO_2', receipt='R0'))
+
+        self.assertEqual(drain_callbacks(), 4)
+        self.assertEqual(drain_callbacks(), 0)
+
+        statuses = dict(Payment.objects.values_list('checkout_request_id', 'status'))
+        self.assertEqual(statuses, {
+            'ws_CO_0': Payment.STATUS_COMPLETED,
+            'ws_CO_1': Payment.STATUS_FAILED,
+            'ws_CO_2': Payment.STATUS_PENDING,
+        })
+        payment = Payment.objects.get(checkout_request_id='ws_CO_0')
+        self.assertEqual(payment.mpesa_receipt_number, 'R0')
+        self.assertIsNotNone(payment.transaction_date)
+        self.assertFalse(MpesaCallback.objects.filter(processed_at__isnull=True).exists())
+
+    def test_duplicate_in_concurrent_batch_settles_once(self):
+        # Declined, so there is no receipt number to catch the duplicate
+        self.post_callback(stk_callback('ws_CO_0', result_code=1032))
+        self.post_callback(stk_callback('ws_CO_0', result_code=1032))
+        first = MpesaCallback.objects.order_by('id').first()
+        read_pending = callbacks._pending_payments
+        raced = []
+
+        def read_then_race(checkout_ids):
+            snapshot = read_pending(checkout_ids)
+            if not raced:
+                raced.append(True)
+                # The duplicate, in another worker's batch, commits before this one writes
+                apply_pending_callbacks(batch_size=1, after_id=first.id)
+            return snapshot
+
+        with mock.patch('housesApp.callbacks._pending_payments', side_effect=read_then_race), \
+                mock.patch('housesApp.callbacks.publish_payments') as publish, \
+                self.captureOnCommitCallbacks(execute=True):
+            apply_pending_callbacks(batch_size=1)
+
+        rollup = HouseRollup.objects.get(house=self.payments[0].booking.house)
+        self.assertEqual((rollup.pending_amount, rollup.pending_count), (0, 0))
+        published = [payment.id for call in publish.call_args_list for payment in call.args[0]]
+        self.assertEqual(published, [self.payments[0].id])
+
+    def test_unknown_checkout_request_is_retried(self):
+        self.post_callback(stk_callback('ws_CO_late'))
+        drain_callbacks()
+
+        callback = MpesaCallback.objects.get()
+        self.assertIsNone(callback.processed_at)
+        self.assertEqual(callback.attempts, 1)
+
+    @override_settings(MPESA_CALLBACK_AUTO_APPLY=True)
+    def test_callback_before_push_result_is_redrained(self):
+        payment = self.payments[0]
+        Payment.objects.filter(pk=payment.pk).update(checkout_request_id=None)
+        MpesaCallback.objects.create(payload=stk_callback('ws_CO_new'))
+        executor = mock.Mock(submit=lambda job, func: func())
+
+        with mock.patch.object(callbacks, 'get_executor', return_value=executor), \
+                mock.patch.object(callbacks.threading, 'Timer') as timer:
+            callbacks.schedule_drain()
+            self.assertEqual(timer.call_args.args[0], 2)
+            self.assertTrue(timer.return_value.start.called)
+
+            # The push result lands; only the timer drains again
+            Payment.objects.filter(pk=payment.pk).update(checkout_request_id='ws_CO_new')
+            timer.call_args.args[1]()
+
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, Payment.STATUS_COMPLETED)
+        self.assertIsNotNone(MpesaCallback.objects.get().processed_at)
+        self.assertEqual(timer.call_count, 1)
+
+
+class ReserveHouseTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.tenants = [User.objects.create_user(username=f'tenant{i}', password='pass12345') for i in range(2)]
+        cls.house = House.objects.create(
+            title='House', price=15000, location='Kilimani', description='', image='house_images/test.jpg'
+        )
+
+    def test_only_first_booking_wins(self):
+        first = Booking(user=self.tenants[0], phone_number='0722000000')
+        second = Booking(user=self.tenants[1], phone_number='0722000001')
+
+        self.assertTrue(reserve_house(House.objects.get(pk=self.house.pk), first))
+        self.assertFalse(reserve_house(House.objects.get(pk=self.house.pk), second))
+
+        self.assertEqual(Booking.objects.get().user, self.tenants[0])
+        self.assertEqual(House.objects.get(pk=self.house.pk).status, House.STATUS_OCCUPIED)
+
+    def test_claim_writes_only_status(self):
+        with CaptureQueriesContext(connection) as queries:
+            reserve_house(self.house, Booking(user=self.tenants[0], phone_number='0722000000'))
+
+        updates = [q['sql'] for q in queries if q['sql'].startswith('UPDATE "housesApp_house"')]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('SET "status"', updates[0])
+        self.assertNotIn('"title"', updates[0])
+
+
+class ImageVariantTests(TestCase):
+
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.storage = FileSystemStorage(location=self.media.name, base_url='/media/')
+        buffer = BytesIO()
+        Image.new('RGB', (1000, 600), 'blue').save(buffer, format='JPEG')
+        self.image_name = self.storage.save('house_images/big.jpg', ContentFile(buffer.getvalue()))
+
+    def tearDown(self):
+        self.media.cleanup()
+
+    def test_variants_are_resized_and_never_upscaled(self):
+        data = generate_variants(self.image_name, storage=self.storage)
+
+        self.assertEqual(data['source'], self.image_name)
+        self.assertEqual(set(data['variants']), {'thumb', 'card'})
+        self.assertEqual(data['variants']['thumb']['width'], 320)
+        with self.storage.open(data['variants']['card']['webp']) as f:
+            self.assertEqual(Image.open(f).size, (640, 384))
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', 'FTS5 index is SQLite specific')
+class HouseSearchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.kilimani = House.objects.create(
+            title='Kilimani Heights', price=30000, location='Kilimani',
+            description='Furnished two bedroom with a <b>balcony</b>', image='house_images/test.jpg'
+        )
+        cls.juja = House.objects.create(
+            title='Juja Court', price=12000, location='Juja', description='Bedsitter near Kilimani shops',
+            image='house_images/test.jpg'
+        )
+
+    def test_ranks_title_matches_first(self):
+        results = get_backend().search('kilimani')
+        self.assertEqual([r.house for r in results], [self.kilimani, self.juja])
+
+    def test_snippet_is_escaped_and_highlighted(self):
+        result = get_backend().search('balcony')[0]
+        self.assertIn('<mark>balcony</mark>', result.snippet)
+        self.assertIn('&lt;b&gt;', result.snippet)
+
+    def test_admin_search_uses_index_without_a_cap(self):
+        self.client.force_login(User.objects.create_superuser(username='admin', password='pass12345'))
+        url = reverse('admin:housesApp_house_changelist')
+
+        response = self.client.get(url, {'q': 'kilimani'})
+        self.assertEqual(response.context['cl'].result_count, 2)
+        response = self.client.get(url, {'q': '!!'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['cl'].result_count, 0)
+
+    def test_index_follows_saves_and_deletes(self):
+        self.juja.title = 'Thika Road Villas'
+        self.juja.save()
+        self.assertEqual([r.house for r in get_backend().search('thika')], [self.juja])
+
+        self.juja.delete()
+        self.assertEqual(get_backend().search('thika'), [])
+
+    def test_fts_syntax_in_query_is_ignored(self):
+        results = get_backend().search('"bedsitter" OR NEAR(')
+        self.assertEqual(results, get_backend().search('bedsitter or near'))
+
+
+class FacetCountTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        for location, price, status in [
+            ('Kilimani', 8000, 'vacant'),
+            ('Kilimani', 15000, 'vacant'),
+            ('Kilimani', 18000, 'occupied'),
+            ('Ruaka', 12000, 'vacant'),
+            ('Westlands', 120000, 'vacant'),
+        ]:
+            House.objects.create(
+                title=location, price=price, location=location, description='', image='', status=status
+            )
+
+    def setUp(self):
+        cache.clear()
+
+    def counts(self, facets, name):
+        return {facet.value: facet.count for facet in facets[name]}
+
+    def test_counts_every_facet_in_one_cached_query(self):
+        with self.assertNumQueries(1):
+            facets = get_facets({})
+        with self.assertNumQueries(0):
+            self.assertEqual(get_facets({}), facets)
+
+        self.assertEqual(self.counts(facets, 'location'), {'Kilimani': 3, 'Ruaka': 1, 'Westlands': 1})
+        self.assertEqual(self.counts(facets, 'status'), {'vacant': 4, 'occupied': 1})
+        self.assertEqual(self.counts(facets, 'price'), {'0-10k': 1, '10k-20k': 3, '100k+': 1})
+
+    def test_selected_facet_keeps_its_other_values(self):
+        facets = get_facets({'location': 'Kilimani', 'status': 'vacant'})
+
+        # Location counts ignore the location filter, status counts ignore status
+        self.assertEqual(self.counts(facets, 'location'), {'Kilimani': 2, 'Ruaka': 1, 'Westlands': 1})
+        self.assertEqual(self.counts(facets, 'status'), {'vacant': 2, 'occupied': 1})
+        self.assertEqual(self.counts(facets, 'price'), {'0-10k': 1, '10k-20k': 1})
+
+    def test_price_facet_ignores_price_range(self):
+        facets = get_facets({'min_price': Decimal('10000'), 'max_price': Decimal('19999.99')})
+
+        self.assertEqual(self.counts(facets, 'location'), {'Kilimani': 2, 'Ruaka': 1})
+        self.assertEqual(self.counts(facets, 'status'), {'vacant': 2, 'occupied': 1})
+        self.assertEqual(self.counts(facets, 'price'), {'0-10k': 1, '10k-20k': 3, '100k+': 1})
+
+    def test_house_changes_invalidate_cached_counts(self):
+        get_facets({})
+        with self.captureOnCommitCallbacks(execute=True):
+            House.objects.create(title='New', price=30000, location='Ruaka', description='', image='')
+        self.assertEqual(self.counts(get_facets({}), 'location')['Ruaka'], 2)
+
+        tenant = User.objects.create_user(username='tenant', password='pass12345')
+        house = House.objects.get(location='Ruaka', price=12000)
+        with self.captureOnCommitCallbacks(execute=True):
+            reserve_house(house, Booking(user=tenant, phone_number='0722000000'))
+        self.assertEqual(self.counts(get_facets({}), 'status'), {'vacant': 4, 'occupied': 2})
+
+    def test_home_renders_facet_links(self):
+        response = self.client.get(reverse('housesApp:home'), {'status': 'vacant'})
+        self.assertContains(response, 'Kilimani</a> (2)')
+        self.assertContains(response, 'max_price=19999.99')
+
+
+class NearbySearchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.kilimani = House.objects.create(
+            title='Kilimani', price=20000, location='Kilimani', description='', image='',
+            latitude=-1.2921, longitude=36.7872
+        )
+        cls.westlands = House.objects.create(
+            title='Westlands', price=30000, location='Westlands', description='', image='',
+            latitude=-1.2676, longitude=36.8108
+        )
+        cls.thika = House.objects.create(
+            title='Thika', price=9000, location='Thika, Kiambu', description='', image='',
+            latitude=-1.0333, longitude=37.0693
+        )
+        cls.unplaced = House.objects.create(
+            title='Unplaced', price=9000, location='Kilimani, Nairobi', description='', image=''
+        )
+
+    def test_haversine(self):
+        self.assertAlmostEqual(haversine_km(-1.2921, 36.7872, -1.2676, 36.8108), 3.78, places=1)
+
+    def test_radius_and_nearest(self):
+        hits = within_radius(-1.2921, 36.7872, 5)
+        self.assertEqual([house_id for house_id, _ in hits], [self.kilimani.pk, self.westlands.pk])
+
+        ids = [house_id for house_id, _ in nearest(-1.2921, 36.7872, limit=3)]
+        self.assertEqual(ids, [self.kilimani.pk, self.westlands.pk, self.thika.pk])
+
+    def test_admin_search_uses_index_without_a_cap(self):
+        self.client.force_login(User.objects.create_superuser(username='admin', password='pass12345'))
+        url = reverse('admin:housesApp_house_changelist')
+
+        response = self.client.get(url, {'q': 'kilimani'})
+        self.assertEqual(response.context['cl'].result_count, 2)
+        response = self.client.get(url, {'q': '!!'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['cl'].result_count, 0)
+
+    def test_index_follows_saves_and_deletes(self):
+        self.westlands.latitude, self.westlands.longitude = -1.03, 37.07
+        self.westlands.save()
+        self.thika.delete()
+
+        results = nearby(-1.0333, 37.0693, radius_km=5)
+        self.assertEqual([result.house for result in results], [self.westlands])
+
+    def test_nearby_api(self):
+        response = self.client.get(reverse('housesApp:nearby_api'), {'lat': -1.2921, 'lng': 36.7872, 'radius': 5})
+        results = response.json()['results']
+        self.assertEqual([result['id'] for result in results], [self.kilimani.pk, self.westlands.pk])
+        self.assertEqual(results[0]['distance_km'], 0)
+
+        self.assertEqual(self.client.get(reverse('housesApp:nearby_api'), {'lat': 200, 'lng': 0}).status_code, 400)
+
+    def test_geocode_houses_from_gazetteer(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = f'{tmp}/gazetteer.csv'
+            with open(path, 'w') as f:
+                f.write('name,latitude,longitude\nKilimani,-1.2921,36.7872\n')
+            call_command('geocode_houses', gazetteer=path, stdout=StringIO())
+
+        self.unplaced.refresh_from_db()
+        self.assertEqual((self.unplaced.latitude, self.unplaced.longitude), (-1.2921, 36.7872))
+        ids = [house_id for house_id, _ in within_radius(-1.2921, 36.7872, 0.1)]
+        self.assertEqual(sorted(ids), [self.kilimani.pk, self.unplaced.pk])
+
+
+class PageCacheTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.house = House.objects.create(
+            title='Kilimani Flat', price=20000, location='Kilimani', description='Two bedrooms', image=''
+        )
+        cls.tenant = User.objects.create_user(username='tenant', password='pass12345')
+
+    def setUp(self):
+        cache.clear()
+
+    def test_repeat_requests_skip_the_database(self):
+        url = reverse('housesApp:house_detail', args=[self.house.pk])
+        first = self.client.get(url)
+        with self.assertNumQueries(0):
+            second = self.client.get(url)
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second['ETag'], first['ETag'])
+        self.assertIn('Last-Modified', second)
+
+        self.client.get(reverse('housesApp:home'), {'location': 'Kilimani'})
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('housesApp:home'), {'location': 'Kilimani'})
+        self.assertContains(response, 'Kilimani Flat')
+
+    def test_revalidation_returns_304(self):
+        url = reverse('housesApp:house_detail', args=[self.house.pk])
+        etag = self.client.get(url)['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_save_and_booking_invalidate(self):
+        detail = reverse('housesApp:house_detail', args=[self.house.pk])
+        home = reverse('housesApp:home')
+        detail_etag = self.client.get(detail)['ETag']
+        self.client.get(home)
+
+        self.house.title = 'Renamed Flat'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.house.save()
+        response = self.client.get(detail, HTTP_IF_NONE_MATCH=detail_etag)
+        self.assertContains(response, 'Renamed Flat')
+        self.assertContains(self.client.get(home), 'Renamed Flat')
+
+        # Another house's detail page survives the booking below
+        other = House.objects.create(title='Other', price=1, location='Ruaka', description='', image='')
+        other_etag = self.client.get(reverse('housesApp:house_detail', args=[other.pk]))['ETag']
+        home_etag = self.client.get(home)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            reserve_house(self.house, Booking(user=self.tenant, phone_number='0722000000'))
+        self.assertEqual(self.client.get(home, HTTP_IF_NONE_MATCH=home_etag).status_code, 200)
+        response = self.client.get(reverse('housesApp:house_detail', args=[other.pk]), HTTP_IF_NONE_MATCH=other_etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_versions_move_only_after_commit(self):
+        before = get_listings_version()
+        with self.captureOnCommitCallbacks() as on_commit, transaction.atomic():
+            self.house.title = 'Renamed Flat'
+            self.house.save()
+            self.assertEqual(get_listings_version(), before)
+        self.assertEqual(get_listings_version(), before)
+
+        for callback in on_commit:
+            callback()
+        self.assertGreater(get_listings_version(), before)
+
+    def test_pending_messages_bypass_cache(self):
+        url = reverse('housesApp:house_detail', args=[self.house.pk])
+        self.client.get(url)
+        self.client.cookies['messages'] = 'pending'
+        response = self.client.get(url)
+        self.assertNotIn('ETag', response)
+        self.assertIn('private', response['Cache-Control'])
+
+
+@override_settings(METRICS_SAMPLE_RATE=1.0)
+class PerformanceMetricsTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        House.objects.create(title='Flat', price=20000, location='Kilimani', description='', image='')
+
+    def setUp(self):
+        cache.clear()
+
+    def test_server_timing_and_prometheus_output(self):
+        self.client.force_login(User.objects.create_user(username='staff', password='pass12345', is_staff=True))
+        response = self.client.get(reverse('housesApp:home'))
+        timing = response['Server-Timing']
+        self.assertRegex(timing, r'db;dur=[\d.]+;desc="[1-9]\d* queries"')
+        self.assertRegex(timing, r'tpl;dur=[\d.]+')
+        self.assertRegex(timing, r'total;dur=[\d.]+$')
+
+        body = self.client.get('/metrics').content.decode()
+        self.assertIn('http_request_duration_seconds_bucket{view="housesApp:home",method="GET",status="200",le="+Inf"}', body)
+        self.assertRegex(body, r'http_request_sql_queries_count\{view="housesApp:home"\} [1-9]')
+
+    def test_daraja_calls_are_charged_to_the_request(self):
+        service = MpesaService(base_url='http://daraja.test')
+        timings, token = metrics.start_request()
+        try:
+            with mock.patch.object(service.session, 'request', return_value=mock.Mock(status_code=200)):
+                service._request('GET', service.auth_url, 'auth')
+        finally:
+            metrics.end_request(token)
+        self.assertEqual(timings.daraja_count, 1)
+        self.assertIn('daraja_request_duration_seconds_count{endpoint="auth"}', metrics.render_prometheus())
+
+    def test_metrics_are_hidden_from_the_public(self):
+        response = self.client.get(reverse('housesApp:home'))
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+
+        with override_settings(METRICS_ALLOWED_IPS=['127.0.0.1'], SERVER_TIMING_PUBLIC=True):
+            self.assertEqual(self.client.get('/metrics').status_code, 200)
+            self.assertIn('Server-Timing', self.client.get(reverse('housesApp:home')))
+
+    async def test_async_requests_check_staff_too(self):
+        response = await self.async_client.get(reverse('housesApp:home'))
+        self.assertNotIn('Server-Timing', response)
+
+        staff = await User.objects.acreate(username='staff', is_staff=True)
+        await self.async_client.aforce_login(staff)
+        response = await self.async_client.get(reverse('housesApp:home'))
+        self.assertIn('Server-Timing', response)
+
+    @override_settings(METRICS_SAMPLE_RATE=0)
+    def test_sampling_off_adds_no_header(self):
+        response = self.client.get(reverse('housesApp:home'))
+        self.assertNotIn('Server-Timing', response)
+
+
+class QueryBudgetTests(TestCase):
+    """
+    Every page runs a fixed number of queries however many rows it shows
+
+    Seeds a few thousand rows with bulk_create, then checks each view
+    against its budget and that no statement repeats per row.
+    """
+    HOUSES = 3000
+    BOOKINGS = 1500
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.landlord = User.objects.create_user(username='landlord', password='pass12345')
+        cls.admin = User.objects.create_superuser(username='admin', password='pass12345')
+        tenants = User.objects.bulk_create(
+            User(username=f'tenant{i}', password='!') for i in range(cls.BOOKINGS)
+        )
+        houses = House.objects.bulk_create(
+            House(
+                title=f'House {i}', price=5000 + i * 10, location=['Kilimani', 'Ruaka', 'Juja'][i % 3],
+                description='Spacious furnished flat with balcony', image='',
+                status=House.STATUS_OCCUPIED if i < cls.BOOKINGS else House.STATUS_VACANT,
+                owner=cls.landlord if i % 2 else None,
+                latitude=-1.29 + (i % 50) * 0.001, longitude=36.78 + (i // 50) * 0.001,
+            )
+            for i in range(cls.HOUSES)
+        )
+        bookings = Booking.objects.bulk_create(
+            Booking(user=tenant, house=house, phone_number='0722000000')
+            for tenant, house in zip(tenants, houses)
+        )
+        Payment.objects.bulk_create(
+            Payment(
+                booking=booking, amount=booking.house.price, phone_number='254722000000',
+                status=[Payment.STATUS_COMPLETED, Payment.STATUS_PENDING][i % 2]
+            )
+            for i, booking in enumerate(bookings)
+        )
+        MpesaCallback.objects.bulk_create(MpesaCallback(payload='{}') for _ in range(200))
+        get_backend().rebuild()
+        rebuild_locations()
+        cls.house = houses[0]
+
+    def setUp(self):
+        cache.clear()
+
+    def assertWithinBudget(self, budget, url, data=None):
+        with NPlusOneDetector(threshold=3) as detector, self.assertNumQueries(budget):
+            response = self.client.get(url, data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(detector.repeats(), [])
+
+    def test_public_views(self):
+        self.assertWithinBudget(2, reverse('housesApp:home'))  # page + facets
+        self.assertWithinBudget(1, reverse('housesApp:houses_api'), {'limit': 100})
+        self.assertWithinBudget(2, reverse('housesApp:search'), {'q': 'furnished'})  # index + rows
+        self.assertWithinBudget(2, reverse('housesApp:search_api'), {'q': 'balcony'})
+        self.assertWithinBudget(2, reverse('housesApp:nearby_api'), {'lat': -1.27, 'lng': 36.80, 'limit': 20})
+        self.assertWithinBudget(1, reverse('housesApp:house_detail', args=[self.house.pk]))
+
+    def test_dashboard(self):
+        self.client.force_login(self.landlord)
+        # session, user, stats, houses
+        self.assertWithinBudget(4, reverse('housesApp:dashboard'))
+
+    def test_admin_changelists(self):
+        self.client.force_login(self.admin)
+        for model in ('house', 'booking', 'payment', 'mpesacallback'):
+            with self.subTest(model=model):
+                # session, user, count, filtered count, page of rows (+ list_filter choices for house)
+                budget = 6 if model == 'house' else 5
+                self.assertWithinBudget(budget, reverse(f'admin:housesApp_{model}_changelist'))
+
+    def test_detector_flags_a_query_per_row(self):
+        with NPlusOneDetector(threshold=3) as detector:
+            for booking in Booking.objects.all()[:10]:
+                booking.user.username
+        [(sql, site, count)] = detector.repeats()
+        self.assertEqual(count, 10)
+        self.assertIn('auth_user', sql)
+        self.assertIn('test_detector_flags_a_query_per_row', site)
+
+
+class DarajaStubTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.received = []
+        test = self
+
+        class Receiver(http.server.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                test.received.append(self.rfile.read(int(self.headers['Content-Length'])).decode())
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+        self.receiver = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Receiver)
+        threading.Thread(target=self.receiver.serve_forever, daemon=True).start()
+        self.addCleanup(self.receiver.server_close)
+        self.addCleanup(self.receiver.shutdown)
+
+    def start_stub(self, **kwargs):
+        host, port = self.receiver.server_address[:2]
+        stub = DarajaStubServer(callback_url=f'http://{host}:{port}/payment/callback/', seed=1, **kwargs).start()
+        self.addCleanup(stub.stop)
+        return stub, MpesaService(base_url=stub.base_url)
+
+    def test_push_is_answered_by_a_callback_and_queryable(self):
+        stub, service = self.start_stub(callback_delay=0.05)
+        result = service.initiate_stk_push('0722000000', 1500, house_id=1, user_id=1)
+        self.assertEqual(result['status'], 'success')
+
+        deadline = time.time() + 5
+        while not self.received and time.time() < deadline:
+            time.sleep(0.01)
+        data = parse_callback(self.received[0])
+        self.assertEqual(data['checkout_request_id'], result['checkout_request_id'])
+        self.assertEqual(data['result_code'], 0)
+        self.assertTrue(data['mpesa_receipt_number'])
+
+        response = service.session.post(
+            f'{stub.base_url}{STK_QUERY_PATH}', json={'CheckoutRequestID': result['checkout_request_id']}
+        )
+        self.assertEqual(response.json()['ResultCode'], '0')
+
+    def test_failure_and_decline_rates(self):
+        stub, service = self.start_stub(failure_rate=1.0)
+        self.assertEqual(service.initiate_stk_push('0722000000', 1, house_id=1, user_id=1)['status'], 'error')
+
+        stub, service = self.start_stub(callback_delay=0, decline_rate=1.0)
+        service.initiate_stk_push('0722000000', 1, house_id=1, user_id=1)
+        deadline = time.time() + 5
+        while not self.received and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertNotEqual(parse_callback(self.received[0])['result_code'], 0)
+
+
+class ReconcilePaymentsTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        tenant = User.objects.create_user(username='tenant', password='pass12345')
+        cls.payments = {}
+        for name in ('paid', 'declined', 'waiting', 'never_sent', 'recent'):
+            house = House.objects.create(title=name, price=1000, location='Juja', description='', image='')
+            booking = Booking.objects.create(user=tenant, house=house, phone_number='0722000000')
+            cls.payments[name] = Payment.objects.create(
+                booking=booking, amount=1000, phone_number='254722000000',
+                checkout_request_id=None if name == 'never_sent' else f'ws_CO_{name}'
+            )
+        stale = timezone.now() - timedelta(minutes=30)
+        Payment.objects.exclude(pk=cls.payments['recent'].pk).update(created_at=stale)
+
+    def setUp(self):
+        cache.clear()
+        self.stub = DarajaStubServer().start()
+        self.addCleanup(self.stub.stop)
+        result = {'MerchantRequestID': 'm'}
+        self.stub.transactions.update({
+            'ws_CO_paid': {**result, 'ResultCode': 0, 'ResultDesc': 'Processed'},
+            'ws_CO_declined': {**result, 'ResultCode': 1032, 'ResultDesc': 'Request cancelled by user'},
+            'ws_CO_waiting': None,
+            'ws_CO_recent': {**result, 'ResultCode': 0, 'ResultDesc': 'Processed'},
+        })
+
+    def status(self, name):
+        return Payment.objects.get(pk=self.payments[name].pk).status
+
+    def test_stale_payments_are_settled(self):
+        service = MpesaService(base_url=self.stub.base_url)
+        totals = reconcile.reconcile_payments(batch_size=2, workers=4, rate=0, service=service)
+
+        self.assertEqual(totals, {'checked': 4, 'completed': 1, 'failed': 2, 'pending': 1, 'errors': 0})
+        self.assertEqual(self.status('paid'), Payment.STATUS_COMPLETED)
+        self.assertEqual(self.status('declined'), Payment.STATUS_FAILED)
+        self.assertEqual(self.status('never_sent'), Payment.STATUS_FAILED)
+        self.assertEqual(self.status('waiting'), Payment.STATUS_PENDING)
+        self.assertEqual(self.status('recent'), Payment.STATUS_PENDING)
+
+    def test_callback_settled_payment_is_not_overwritten(self):
+        record_outcomes = reconcile._record_outcomes
+
+        def callback_lands_first(outcomes):
+            # The callback is applied while Daraja is being asked
+            Payment.objects.filter(checkout_request_id='ws_CO_declined').update(status=Payment.STATUS_COMPLETED)
+            record_outcomes(outcomes)
+
+        service = MpesaService(base_url=self.stub.base_url)
+        with mock.patch.object(reconcile, '_record_outcomes', side_effect=callback_lands_first):
+            totals = reconcile.reconcile_payments(workers=1, rate=0, service=service)
+        self.assertEqual(totals['failed'], 2)
+        self.assertEqual(self.status('declined'), Payment.STATUS_COMPLETED)
+
+
+class PaymentEventsTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.tenant = User.objects.create_user(username='tenant', password='pass12345')
+        house = House.objects.create(title='House', price=15000, location='Kilimani', description='', image='')
+        booking = Booking.objects.create(user=cls.tenant, house=house, phone_number='0722000000')
+        cls.payment = Payment.objects.create(
+            booking=booking, amount=15000, phone_number='254722000000', checkout_request_id='ws_CO_live'
+        )
+        cls.url = reverse('housesApp:payment_events', args=[cls.payment.pk])
+
+    def receive_callback(self):
+        payload = {'Body': {'stkCallback': {
+            'CheckoutRequestID': 'ws_CO_live', 'ResultCode': 0, 'ResultDesc': 'Processed',
+            'CallbackMetadata': {'Item': [{'Name': 'MpesaReceiptNumber', 'Value': 'RCPT123'}]},
+        }}}
+        MpesaCallback.objects.create(payload=json.dumps(payload))
+        with self.captureOnCommitCallbacks(execute=True):
+            apply_pending_callbacks()
+
+    async def open_stream(self):
+        await self.async_client.aforce_login(self.tenant)
+        response = await self.async_client.get(self.url)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        return aiter(response.streaming_content)
+
+    async def next_event(self, stream):
+        chunk = await asyncio.wait_for(anext(stream), 5)
+        chunk = chunk.decode() if isinstance(chunk, bytes) else chunk
+        return json.loads(chunk.split('data: ', 1)[1]) if 'data: ' in chunk else chunk
+
+    async def test_stream_follows_payment_until_settled(self):
+        stream = await self.open_stream()
+        self.assertEqual((await self.next_event(stream))['status'], Payment.STATUS_PENDING)
+
+        await sync_to_async(self.receive_callback)()
+
+        event = await self.next_event(stream)
+        self.assertEqual(event, {'id': self.payment.pk, 'status': Payment.STATUS_COMPLETED, 'receipt': 'RCPT123'})
+        with self.assertRaises(StopAsyncIteration):
+            await anext(stream)
+
+    async def test_idle_stream_sends_keepalives(self):
+        stream = payment_event_stream(self.payment.pk, keepalive=0.05)
+        await self.next_event(stream)
+        self.assertEqual(await self.next_event(stream), ': keepalive\n\n')
+        await stream.aclose()
+
+    async def test_stream_ends_after_max_age(self):
+        stream = payment_event_stream(self.payment.pk, keepalive=0.05, max_age=0.12)
+        chunks = [chunk async for chunk in stream]
+        self.assertIn('retry: 5000', chunks[0])
+        self.assertEqual(set(chunks[1:]), {': keepalive\n\n'})
+
+    def test_wsgi_request_is_refused(self):
+        self.client.force_login(self.tenant)
+        self.assertEqual(self.client.get(self.url).status_code, 501)
+
+    def test_other_users_payment_is_hidden(self):
+        self.client.force_login(User.objects.create_user(username='other', password='pass12345'))
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+
+class BulkTransferTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.landlord = User.objects.create_user(username='landlord', password='pass12345')
+        cls.finance = User.objects.create_user(username='finance', password='pass12345', is_staff=True)
+        tenant = User.objects.create_user(username='tenant', password='pass12345')
+        cls.own = House.objects.create(title='Own', price=9000, location='Juja', description='', image='', owner=cls.landlord)
+        other = House.objects.create(title='Other', price=8000, location='Juja', description='', image='')
+        for house in (cls.own, other):
+            booking = Booking.objects.create(user=tenant, house=house, phone_number='0722000000')
+            Payment.objects.create(booking=booking, amount=house.price, phone_number='254722000000',
+                                   status=Payment.STATUS_COMPLETED, mpesa_receipt_number=f'R{house.pk}')
+
+    def setUp(self):
+        cache.clear()
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+
+    def export(self, user, path):
+        self.client.force_login(user)
+        response = self.client.get(path)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode()
+
+    def test_payment_export_is_scoped_to_landlord(self):
+        url = reverse('housesApp:export_data', args=['payments', 'csv'])
+
+        rows = list(csv.DictReader(StringIO(self.export(self.finance, url))))
+        self.assertEqual([row['mpesa_receipt_number'] for row in rows], [f'R{self.own.pk}', f'R{self.own.pk + 1}'])
+
+        rows = list(csv.DictReader(StringIO(self.export(self.landlord, url))))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['amount'], '9000.00')
+
+    async def test_asgi_export_streams_asynchronously(self):
+        await self.async_client.aforce_login(self.finance)
+        response = await self.async_client.get(reverse('housesApp:export_data', args=['houses', 'jsonl']))
+
+        self.assertTrue(response.is_async)
+        lines = [json.loads(chunk) async for part in response.streaming_content for chunk in part.splitlines()]
+        self.assertEqual([line['title'] for line in lines], ['Own', 'Other'])
+        self.assertEqual(lines[0]['owner'], 'landlord')
+
+    def test_import_command_copies_images_and_indexes_houses(self):
+        image_dir = os.path.join(self.media.name, 'incoming')
+        os.makedirs(image_dir)
+        Image.new('RGB', (40, 30), 'green').save(os.path.join(image_dir, 'villa.jpg'))
+        path = os.path.join(self.media.name, 'houses.csv')
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['title', 'price', 'location', 'description', 'latitude', 'longitude', 'image'])
+            writer.writerow(['Garden Villa', '45000', 'Karen', 'Quiet villa', '-1.32', '36.70', 'villa.jpg'])
+            writer.writerow(['No Price', 'abc', 'Karen', 'Bedsitter', '', '', ''])
+            writer.writerow(['Lost Photo', '30000', 'Karen', 'Bungalow', '', '', 'missing.jpg'])
+
+        version = get_listings_version()
+        err = StringIO()
+        with override_settings(MEDIA_ROOT=os.path.join(self.media.name, 'media')):
+            call_command('import_data', 'houses', path, '--owner', 'landlord', '--image-dir', image_dir,
+                         stdout=StringIO(), stderr=err)
+            house = House.objects.get(title='Garden Villa')
+            self.assertTrue(house.image.storage.exists(house.image.name))
+
+        self.assertEqual(house.owner, self.landlord)
+        self.assertEqual(house.price, 45000)
+        self.assertIn('row 2: price: “abc” value must be a decimal number.', err.getvalue())
+        self.assertIn('row 3: Image', err.getvalue())
+        self.assertFalse(House.objects.filter(title__in=['No Price', 'Lost Photo']).exists())
+        self.assertEqual([hit[0] for hit in get_backend().search_ids('villa')], [house.pk])
+        self.assertEqual(nearest(-1.32, 36.70, limit=1)[0][0], house.pk)
+        self.assertGreater(get_listings_version(), version)
+
+    def test_import_endpoint_assigns_houses_to_landlord(self):
+        self.client.force_login(self.landlord)
+        upload = ContentFile(b'{"title": "Studio", "price": 12000, "location": "Ruaka", "description": "Studio flat", '
+                             b'"owner": "finance"}\n[]\n', name='houses.jsonl')
+
+        response = self.client.post(reverse('housesApp:import_data', args=['houses']), {'file': upload})
+
+        self.assertEqual(response.json()['created'], 1)
+        self.assertEqual(response.json()['errors'], [{'row': 2, 'message': 'Not a JSON object'}])
+        self.assertEqual(House.objects.get(title='Studio').owner, self.landlord)
+        upload.seek(0)
+        response = self.client.post(reverse('housesApp:import_data', args=['payments']), {'file': upload})
+        self.assertEqual(response.status_code, 403)
+
+    def test_booking_import_claims_vacant_houses(self):
+        vacant = House.objects.create(title='Vacant', price=7000, location='Juja', description='', image='')
+        House.objects.filter(pk=self.own.pk).update(status=House.STATUS_OCCUPIED)
+        version = get_listings_version()
+        rows = [{'user': 'tenant', 'house': str(house.pk), 'phone_number': '0722000000'}
+                for house in (vacant, vacant, self.own)]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            result = import_rows(BookingImporter(), rows)
+
+        self.assertEqual(result.created, 3)
+        vacant.refresh_from_db()
+        self.assertEqual(vacant.status, House.STATUS_OCCUPIED)
+        self.assertIsNone(HouseRollup.objects.get(house=vacant).vacant_since)
+        self.assertEqual(HouseRollup.objects.get(house=vacant).bookings, 2)
+        self.assertGreater(get_listings_version(), version)
+
+    def test_malformed_jsonl_values_are_row_errors(self):
+        rows = read_rows(StringIO(
+            '{"user": ["tenant"], "house": "%d"}\n'
+            '{"user": "tenant", "house": "%d", "phone_number": {"n": 1}}\n'
+            '{"user": "tenant", "house": "%d", "phone_number": "0722000000"}\n' % ((self.own.pk,) * 3)
+        ), 'jsonl')
+
+        result = import_rows(BookingImporter(), rows)
+
+        self.assertEqual(result.created, 1)
+        self.assertEqual(result.errors, [
+            (1, 'user: expected a single value, got list'),
+            (2, 'phone_number: expected a single value, got dict'),
+        ])
+        result = import_rows(HouseImporter(), [{'title': 'Bad', 'price': '1', 'owner': ['landlord']}])
+        self.assertEqual(result.errors, [(1, 'owner: expected a single value, got list')])
+
+    def test_payment_import_rejects_duplicates(self):
+        tenant = User.objects.get(username='tenant')
+        bookings = [Booking.objects.create(user=tenant, house=self.own, phone_number='0722000000') for _ in range(2)]
+        rows = [
+            {'booking': str(bookings[0].pk), 'amount': '9000', 'phone_number': '254722000000',
+             'status': 'completed', 'mpesa_receipt_number': 'NEW1'},
+            {'booking': str(bookings[1].pk), 'amount': '9000', 'phone_number': '254722000000',
+             'status': 'completed', 'mpesa_receipt_number': f'R{self.own.pk}'},
+            {'booking': str(bookings[0].pk), 'amount': '9000', 'phone_number': '254722000000'},
+        ]
+
+        result = import_rows(PaymentImporter(), rows)
+
+        self.assertEqual(result.created, 1)
+        self.assertEqual([number for number, _ in result.errors], [2, 3])
+        self.assertEqual(Payment.objects.get(mpesa_receipt_number='NEW1').booking, bookings[0])
+
+
+class RollupTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(username='landlord', password='pass12345')
+        cls.tenant = User.objects.create_user(username='tenant', password='pass12345')
+        cls.house = House.objects.create(
+            title='House', price=20000, location='Kilimani', description='', image='', owner=cls.owner
+        )
+
+    def book_and_pay(self, checkout_id):
+        booking = Booking(user=self.tenant, phone_number='0722000000')
+        House.objects.filter(pk=self.house.pk).update(status=House.STATUS_VACANT)
+        self.assertTrue(reserve_house(self.house, booking))
+        return Payment.objects.create(booking=booking, amount=20000, phone_number='254722000000',
+                                      checkout_request_id=checkout_id)
+
+    def settle(self, checkout_id, result_code):
+        payload = {'Body': {'stkCallback': {'CheckoutRequestID': checkout_id, 'ResultCode': result_code,
+                                            'ResultDesc': '', 'CallbackMetadata': {'Item': [
+                                                {'Name': 'MpesaReceiptNumber', 'Value': f'R{checkout_id}'}]}}}}
+        MpesaCallback.objects.create(payload=json.dumps(payload))
+        drain_callbacks()
+
+    def test_bookings_and_callbacks_update_rollups(self):
+        self.book_and_pay('ws_CO_1')
+        self.book_and_pay('ws_CO_2')
+        self.book_and_pay('ws_CO_3')
+        self.settle('ws_CO_1', 0)
+        self.settle('ws_CO_2', 1032)
+
+        rollup = HouseRollup.objects.get(house=self.house)
+        self.assertEqual((rollup.bookings, rollup.revenue, rollup.payments_completed), (3, 20000, 1))
+        self.assertEqual((rollup.pending_amount, rollup.pending_count), (20000, 1))
+        self.assertIsNone(rollup.vacant_since)
+        self.assertGreater(rollup.vacant_time, timedelta(0))
+
+        month = LandlordMonthRollup.objects.get(owner=self.owner)
+        self.assertEqual((month.bookings, month.revenue, month.pending_count), (3, 20000, 1))
+        with self.assertNumQueries(1):
+            stats = landlord_stats(self.owner)
+        self.assertEqual((stats['revenue'], stats['pending_amount'], stats['pending_count']), (20000, 20000, 1))
+
+    def test_rebuild_matches_incremental_totals(self):
+        self.book_and_pay('ws_CO_1')
+        self.book_and_pay('ws_CO_2')
+        self.settle('ws_CO_1', 0)
+        incremental = list(HouseRollup.objects.values()) + list(LandlordMonthRollup.objects.values('month', 'revenue'))
+
+        HouseRollup.objects.update(revenue=0, bookings=0)
+        LandlordMonthRollup.objects.all().delete()
+        self.assertEqual(rebuild_rollups(chunk_size=1), (1, 1))
+
+        rebuilt = list(HouseRollup.objects.values()) + list(LandlordMonthRollup.objects.values('month', 'revenue'))
+        self.assertEqual(rebuilt, incremental)
+
+
+class RateLimitTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.tenant = User.objects.create_user(username='tenant', password='pass12345')
+        house = House.objects.create(
+            title='House', price=15000, location='Kilimani', description='', image='house_images/test.jpg'
+        )
+        cls.booking = Booking.objects.create(user=cls.tenant, house=house, phone_number='0722000000')
+
+    def setUp(self):
+        ratelimit._limiter = None
+        dispatch._slots = None
+
+    def tearDown(self):
+        ratelimit._limiter = None
+        dispatch._slots = None
+
+    def redis_cache(self, script_result=None, error=None):
+        """Stand-in RedisCache whose client runs a mocked Lua script, or fails"""
+        client = mock.Mock()
+        client.register_script.return_value = mock.Mock(return_value=script_result)
+        redis = mock.Mock()
+        redis.make_and_validate_key = lambda key: f':1:{key}'
+        redis._cache.get_client.return_value = client
+        redis._cache.get_client.side_effect = error
+        return redis, client
+
+    def test_bucket_allows_burst_then_refills(self):
+        buckets = ratelimit.LocalBuckets()
+        rate, burst = ratelimit.parse_rate('3/m')
+        self.assertEqual([buckets.take('k', rate, burst, now=0) for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(buckets.take('k', rate, burst, now=0), 20)
+        self.assertEqual(buckets.take('k', rate, burst, now=20), 0)
+        self.assertEqual(buckets.take('other', rate, burst, now=20), 0)
+
+    @override_settings(RATE_LIMITS={'login': {'ip': '5/m', 'username': '2/m'}})
+    def test_login_limited_per_username(self):
+        url = reverse('housesApp:login')
+        for _ in range(2):
+            self.assertEqual(self.client.post(url, {'username': 'Tenant', 'password': 'wrong'}).status_code, 200)
+
+        response = self.client.post(url, {'username': 'tenant', 'password': 'pass12345'})
+        self.assertEqual(response.status_code, 429)
+        self.assertIn(int(response['Retry-After']), range(25, 31))
+        self.assertNotIn('_auth_user_id', self.client.session)
+        # Another account from the same address still has its own bucket
+        self.assertEqual(self.client.post(url, {'username': 'other', 'password': 'x'}).status_code, 200)
+
+    @override_settings(RATE_LIMITS={'payment': {'phone': '1/m'}}, MPESA_MAX_INFLIGHT_PUSHES=10)
+    @mock.patch('housesApp.views.adispatch_stk_push', new_callable=mock.AsyncMock)
+    def test_payment_limited_per_phone(self, adispatch):
+        self.client.force_login(self.tenant)
+        url = reverse('housesApp:initiate_payment', args=[self.booking.id])
+        self.assertEqual(self.client.post(url, {'phone_number': '0722000000'}).status_code, 302)
+        # Same number written another way
+        response = self.client.post(url, {'phone_number': '254722000000'})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(Payment.objects.count(), 1)
+
+    @override_settings(RATE_LIMITS={}, MPESA_MAX_INFLIGHT_PUSHES=1, MPESA_BUSY_RETRY_AFTER=7)
+    @mock.patch('housesApp.dispatch.mpesa_service.ainitiate_stk_push', new_callable=mock.AsyncMock)
+    def test_push_cap_sheds_load(self, stk_push):
+        self.client.force_login(self.tenant)
+        url = reverse('housesApp:initiate_payment', args=[self.booking.id])
+        self.assertTrue(dispatch.reserve_push())
+
+        response = self.client.post(url, {'phone_number': '0722000000'})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '7')
+        self.assertFalse(Payment.objects.exists())
+
+        # The slot frees once the push in flight has its answer
+        dispatch.release_push()
+        stk_push.return_value = {'status': 'success', 'checkout_request_id': 'ws_CO_1', 'merchant_request_id': 'm-1'}
+        with override_settings(DISPATCH_EAGER=True):
+            self.assertEqual(self.client.post(url, {'phone_number': '0722000000'}).status_code, 302)
+        self.assertEqual(dispatch.get_push_slots().count, 0)
+
+    def test_redis_buckets_run_the_script_and_fall_back(self):
+        redis, client = self.redis_cache(script_result=b'2.5')
+        buckets = ratelimit.CacheBuckets(redis)
+        self.assertEqual(buckets.take('k', 1, 3, now=100), 2.5)
+        script = client.register_script.return_value
+        self.assertEqual(script.call_args.kwargs['keys'], [':1:k'])
+        self.assertEqual(script.call_args.kwargs['args'], [1, 3, 100])
+
+        redis, _ = self.redis_cache(error=ConnectionError('down'))
+        buckets = ratelimit.CacheBuckets(redis)
+        self.assertEqual([buckets.take('k', 1, 1, now=0) for _ in range(2)], [0, 1.0])
+
+    @override_settings(MPESA_PUSH_SLOT_TIMEOUT=30)
+    def test_redis_push_slots_are_shared_and_fall_back(self):
+        redis, client = self.redis_cache(script_result=1)
+        slots = dispatch.CacheSlots(redis)
+        self.assertTrue(slots.reserve(5))
+        args = client.register_script.return_value.call_args.kwargs['args']
+        self.assertEqual((args[0], args[2]), (5, 30))
+        slots.release()
+        client.zpopmin.assert_called_once_with(':1:dispatch:push_slots')
+        client.register_script.return_value.return_value = 0
+        self.assertFalse(slots.reserve(5))
+
+        redis, _ = self.redis_cache(error=ConnectionError('down'))
+        slots = dispatch.CacheSlots(redis)
+        self.assertEqual([slots.reserve(1), slots.reserve(1)], [True, False])
+        slots.release()
+        self.assertEqual(slots.fallback.count, 0)
+
+
+def separate_replica_database():
+    replica = settings.DATABASES.get('replica1')
+    return replica is not None and not replica.get('TEST', {}).get('MIRROR')
+
+
+@unittest.skipUnless(separate_replica_database(), 'run with --settings=nyumbaProject.test_settings')
+@override_settings(DATABASE_REPLICAS=['replica1'])
+class ReplicaRoutingTests(TestCase):
+    # replica1 is a second test database; nothing replicates into it, so
+    # rows created on one side only show which database a page read
+    databases = {'default', 'replica1'} if separate_replica_database() else {'default'}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.landlord = User.objects.create_user(username='landlord', password='pass12345')
+        cls.house = House.objects.create(
+            title='Primary House', price=15000, location='Kilimani', description='', image='', owner=cls.landlord
+        )
+        User.objects.using('replica1').create(pk=cls.landlord.pk, username='landlord')
+        House.objects.using('replica1').create(
+            pk=cls.house.pk, title='Replica House', price=15000, location='Kilimani',
+            description='', image='', owner_id=cls.landlord.pk
+        )
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.landlord)
+
+    def test_read_only_views_use_replica(self):
+        response = self.client.get(reverse('housesApp:dashboard'))
+        self.assertContains(response, 'Replica House')
+        self.assertNotContains(response, 'Primary House')
+        self.assertNotIn(replicas.PIN_COOKIE, response.cookies)
+
+        # Any other view stays on the primary
+        response = self.client.get(reverse('housesApp:book_house', args=[self.house.pk]))
+        self.assertContains(response, 'Primary House')
+
+    def test_write_pins_browser_to_primary(self):
+        other = House.objects.create(title='Other', price=9000, location='Kileleshwa', description='', image='')
+        response = self.client.post(reverse('housesApp:book_house', args=[other.pk]), {'phone_number': '0722000000'})
+        self.assertEqual(response.cookies[replicas.PIN_COOKIE]['max-age'], 5)
+
+        self.assertContains(self.client.get(reverse('housesApp:dashboard')), 'Primary House')
+        del self.client.cookies[replicas.PIN_COOKIE]
+        self.assertContains(self.client.get(reverse('housesApp:dashboard')), 'Replica House')
+
+    def test_admin_changelist_uses_replica(self):
+        User.objects.filter(pk=self.landlord.pk).update(is_staff=True, is_superuser=True)
+        response = self.client.get(reverse('admin:housesApp_house_changelist'))
+        self.assertContains(response, 'Replica House')
+        self.assertNotContains(response, 'Primary House')
+
+    def test_recently_changed_page_not_cached_from_replica(self):
+        url = reverse('housesApp:house_detail', args=[self.house.pk])
+        response = self.client.get(url)
+        self.assertContains(response, 'Replica House')
+        self.assertNotIn('ETag', response)
+
+        # Once the change is older than any replication lag, caching resumes
+        with override_settings(REPLICA_PIN_SECONDS=0):
+            self.assertIn('ETag', self.client.get(url))
+
+
+@override_settings(
+    SESSION_ENGINE='django.contrib.sessions.backends.cached_db',
+    AUTHENTICATION_BACKENDS=['housesApp.auth_backends.CachedModelBackend', 'django.contrib.auth.backends.ModelBackend'],
+)
+class CachedAuthTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.landlord = User.objects.create_user(username='landlord', password='pass12345')
+        self.client.force_login(self.landlord)
+
+    def auth_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('housesApp:dashboard'))
+        self.assertEqual(response.status_code, 200)
+        return [q['sql'] for q in queries if 'FROM "django_session"' in q['sql'] or 'SELECT "auth_user"."id"' in q['sql']]
+
+    def test_session_and_user_come_from_cache(self):
+        self.auth_queries()
+        self.assertEqual(self.auth_queries(), [])
+
+    def test_saving_user_forgets_cached_copy(self):
+        self.auth_queries()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.landlord.is_active = False
+            self.landlord.save()
+
+        response = self.client.get(reverse('housesApp:dashboard'))
+        self.assertEqual(response.status_code, 302)
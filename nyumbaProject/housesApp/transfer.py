@@ -0,0 +1,380 @@
+"""
+Bulk Import and Export
+Streams houses, bookings and payments as CSV or JSONL in both directions
+
+Exports walk the table with QuerySet.iterator(), so memory stays flat no
+matter how many rows there are. Imports validate each row, then insert
+valid rows with one bulk_create per batch; bad rows are reported by row
+number and skipped.
+"""
+import csv
+import io
+import itertools
+import json
+import os
+from dataclasses import dataclass, field
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.exceptions import SuspiciousFileOperation, ValidationError
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+from .caching import bump_listings_version, invalidate_house
+from .geo import index_points
+from .models import Booking, House, Payment
+from .rollups import record_bookings, record_house_status, record_new_houses, record_new_payments
+from .search import get_backend
+
+
+FORMATS = ('csv', 'jsonl')
+
+# kind -> [(column, field path)]; imports read the same columns back
+EXPORT_COLUMNS = {
+    'houses': [
+        ('id', 'id'), ('title', 'title'), ('price', 'price'), ('location', 'location'),
+        ('description', 'description'), ('status', 'status'), ('latitude', 'latitude'),
+        ('longitude', 'longitude'), ('image', 'image'), ('owner', 'owner__username'),
+    ],
+    'bookings': [
+        ('id', 'id'), ('user', 'user__username'), ('house', 'house_id'),
+        ('phone_number', 'phone_number'), ('booking_date', 'booking_date'),
+    ],
+    'payments': [
+        ('id', 'id'), ('booking', 'booking_id'), ('amount', 'amount'), ('phone_number', 'phone_number'),
+        ('status', 'status'), ('checkout_request_id', 'checkout_request_id'),
+        ('merchant_request_id', 'merchant_request_id'), ('mpesa_receipt_number', 'mpesa_receipt_number'),
+        ('transaction_date', 'transaction_date'), ('created_at', 'created_at'),
+    ],
+}
+
+MODELS = {'houses': House, 'bookings': Booking, 'payments': Payment}
+
+# Rows fetched per round trip (and per server-side cursor fetch on PostgreSQL)
+EXPORT_CHUNK_SIZE = 2000
+
+
+def export_queryset(kind, user=None):
+    """Rows of `kind` visible to user: staff see everything, landlords their own houses"""
+    queryset = MODELS[kind].objects.order_by('id')
+    if user is not None and not user.is_staff:
+        owner_field = {'houses': 'owner', 'bookings': 'house__owner', 'payments': 'booking__house__owner'}[kind]
+        queryset = queryset.filter(**{owner_field: user})
+    return queryset
+
+
+def export_lines(kind, fmt, queryset=None):
+    """
+    Yield the export of `kind` as CSV or JSONL text, a chunk of rows at a time
+
+    Rows come from values_list().iterator(), so no model instances are
+    built and only EXPORT_CHUNK_SIZE rows are held at once.
+    """
+    columns = [column for column, _ in EXPORT_COLUMNS[kind]]
+    paths = [path for _, path in EXPORT_COLUMNS[kind]]
+    if queryset is None:
+        queryset = export_queryset(kind)
+    rows = queryset.values_list(*paths).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        for chunk in _chunks(rows, EXPORT_CHUNK_SIZE):
+            writer.writerows(chunk)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
+    else:
+        encoder = DjangoJSONEncoder()
+        for chunk in _chunks(rows, EXPORT_CHUNK_SIZE):
+            yield ''.join(encoder.encode(dict(zip(columns, row))) + '\n' for row in chunk)
+
+
+async def aexport_lines(kind, fmt, queryset=None):
+    """export_lines for ASGI; each chunk is fetched on the request's sync thread"""
+    lines = export_lines(kind, fmt, queryset)
+    next_chunk = sync_to_async(lambda: next(lines, None))
+    while (chunk := await next_chunk()) is not None:
+        yield chunk
+
+
+def read_rows(stream, fmt):
+    """Yield dicts from a CSV (with a header row) or JSONL text stream"""
+    if fmt == 'csv':
+        yield from csv.DictReader(stream)
+        return
+    for line in stream:
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+
+
+def format_for(filename, default='csv'):
+    extension = os.path.splitext(filename)[1].lstrip('.').lower()
+    return extension if extension in FORMATS else default
+
+
+@dataclass
+class ImportResult:
+    created: int = 0
+    errors: list = field(default_factory=list)  # [(row number, message)]
+
+
+class BaseImporter:
+    model = None
+
+    def prepare(self, rows):
+        """Look up whatever a batch of rows refers to, in bulk"""
+
+    def build(self, row):
+        """Unsaved model instance for one row; raise ValidationError if it's bad"""
+        raise NotImplementedError
+
+    def finish(self, objects):
+        """Runs after a batch is inserted"""
+
+    def complete(self):
+        """Runs once after the last batch"""
+
+
+class HouseImporter(BaseImporter):
+    """
+    Houses for one landlord, or for the landlord named in an owner column
+
+    With image_dir, the image column is a file path relative to it and
+    the file is copied into storage. Without one it must name a file
+    already in storage, or be left empty.
+    """
+    model = House
+
+    def __init__(self, owner=None, image_dir=None):
+        self.owner = owner
+        self.image_dir = image_dir
+        self.owners = {}
+        self.created = False
+
+    def prepare(self, rows):
+        if self.owner is None:
+            self.owners = User.objects.in_bulk(_strings(rows, 'owner'), field_name='username')
+
+    def build(self, row):
+        house = House(
+            title=row.get('title') or '',
+            price=_value(row, 'price'),
+            location=row.get('location') or '',
+            description=row.get('description') or '',
+            status=row.get('status') or House.STATUS_VACANT,
+            latitude=_value(row, 'latitude'),
+            longitude=_value(row, 'longitude'),
+            owner=self.owner or self.owners.get(row.get('owner')),
+        )
+        if house.owner is None and row.get('owner'):
+            raise ValidationError(f"Unknown owner {row['owner']!r}")
+        house.full_clean(exclude=['image', 'owner'], validate_unique=False, validate_constraints=False)
+        house.image = self.store_image(row.get('image') or '')
+        return house
+
+    def store_image(self, name):
+        if not name:
+            return ''
+        if self.image_dir is None:
+            try:
+                stored = default_storage.exists(name)
+            except SuspiciousFileOperation:
+                stored = False
+            if not stored:
+                raise ValidationError(f'Image {name!r} is not in storage')
+            return name
+
+        path = os.path.realpath(os.path.join(self.image_dir, name))
+        if not path.startswith(os.path.realpath(self.image_dir) + os.sep) or not os.path.isfile(path):
+            raise ValidationError(f'Image {name!r} not found in {self.image_dir}')
+        with open(path, 'rb') as f:
+            return default_storage.save(f'house_images/{os.path.basename(path)}', File(f))
+
+    def finish(self, houses):
+        # bulk_create skips post_save, so index the batch and start its rollups here
+        record_new_houses(houses)
+        backend = get_backend()
+        for house in houses:
+            backend.index(house)
+        index_points([
+            (house.pk, house.latitude, house.longitude)
+            for house in houses if house.latitude is not None and house.longitude is not None
+        ])
+        self.created = self.created or bool(houses)
+
+    def complete(self):
+        if self.created:
+            bump_listings_version()
+
+
+class BookingImporter(BaseImporter):
+    """
+    Bookings by username and house id; booking_date is set to the import time
+
+    Like reserve_house, a booking takes its house: vacant houses become
+    occupied. Houses already occupied keep their status, so past bookings
+    can still be loaded for them.
+    """
+    model = Booking
+
+    def prepare(self, rows):
+        self.users = User.objects.in_bulk(_strings(rows, 'user'), field_name='username')
+        self.houses = set(
+            House.objects.filter(pk__in={_int(row.get('house')) for row in rows} - {None})
+            .values_list('id', flat=True)
+        )
+
+    def build(self, row):
+        user = self.users.get(row.get('user'))
+        house_id = _int(row.get('house'))
+        if user is None:
+            raise ValidationError(f"Unknown user {row.get('user')!r}")
+        if house_id not in self.houses:
+            raise ValidationError(f"Unknown house {row.get('house')!r}")
+        booking = Booking(user=user, house_id=house_id, phone_number=row.get('phone_number') or '')
+        booking.full_clean(exclude=['user', 'house'], validate_unique=False, validate_constraints=False)
+        return booking
+
+    def finish(self, bookings):
+        record_bookings([booking.pk for booking in bookings])
+        vacant = House.objects.select_for_update().filter(
+            pk__in={booking.house_id for booking in bookings}, status=House.STATUS_VACANT
+        )
+        claimed = list(vacant.values_list('id', flat=True))
+        # One UPDATE for the batch; it skips post_save, so do the signal's work here
+        House.objects.filter(pk__in=claimed).update(status=House.STATUS_OCCUPIED)
+        for house_id in claimed:
+            record_house_status(house_id, House.STATUS_OCCUPIED)
+            transaction.on_commit(lambda house_id=house_id: invalidate_house(house_id))
+
+
+class PaymentImporter(BaseImporter):
+    """Payments by booking id; created_at is set to the import time"""
+    model = Payment
+
+    def prepare(self, rows):
+        booking_ids = {_int(row.get('booking')) for row in rows} - {None}
+        self.bookings = set(Booking.objects.filter(pk__in=booking_ids).values_list('id', flat=True))
+        self.paid = set(Payment.objects.filter(booking_id__in=booking_ids).values_list('booking_id', flat=True))
+        self.checkout_ids = set(Payment.objects.filter(
+            checkout_request_id__in=_strings(rows, 'checkout_request_id')
+        ).values_list('checkout_request_id', flat=True))
+        self.receipts = set(Payment.objects.filter(
+            mpesa_receipt_number__in=_strings(rows, 'mpesa_receipt_number')
+        ).values_list('mpesa_receipt_number', flat=True))
+
+    def build(self, row):
+        booking_id = _int(row.get('booking'))
+        if booking_id not in self.bookings:
+            raise ValidationError(f"Unknown booking {row.get('booking')!r}")
+        if booking_id in self.paid:
+            raise ValidationError(f'Booking {booking_id} already has a payment')
+
+        payment = Payment(
+            booking_id=booking_id,
+            amount=_value(row, 'amount'),
+            phone_number=row.get('phone_number') or '',
+            status=row.get('status') or Payment.STATUS_PENDING,
+            checkout_request_id=row.get('checkout_request_id') or None,
+            merchant_request_id=row.get('merchant_request_id') or None,
+            mpesa_receipt_number=row.get('mpesa_receipt_number') or None,
+            transaction_date=_value(row, 'transaction_date'),
+        )
+        payment.full_clean(exclude=['booking'], validate_unique=False, validate_constraints=False)
+        # Unique columns are checked against the table in prepare() and within the file here
+        checkout_id, receipt = payment.checkout_request_id, payment.mpesa_receipt_number
+        if checkout_id in self.checkout_ids:
+            raise ValidationError(f'Duplicate checkout_request_id {checkout_id!r}')
+        if receipt in self.receipts:
+            raise ValidationError(f'Duplicate mpesa_receipt_number {receipt!r}')
+        self.paid.add(booking_id)
+        if checkout_id:
+            self.checkout_ids.add(checkout_id)
+        if receipt:
+            self.receipts.add(receipt)
+        return payment
+
+    def finish(self, payments):
+        record_new_payments([payment.pk for payment in payments])
+
+
+IMPORTERS = {'houses': HouseImporter, 'bookings': BookingImporter, 'payments': PaymentImporter}
+
+
+def import_rows(importer, rows, batch_size=1000):
+    """
+    Validate and insert rows batch by batch
+
+    Each batch is validated in full and then inserted with one
+    bulk_create in its own transaction, so a failure part way through
+    keeps the batches already loaded.
+
+    Returns:
+        ImportResult with the number created and (row, message) errors
+    """
+    result = ImportResult()
+    numbered = enumerate(rows, start=1)
+    for batch in _chunks(numbered, batch_size):
+        importer.prepare([row for _, row in batch if isinstance(row, dict)])
+        objects = []
+        for number, row in batch:
+            if not isinstance(row, dict):
+                result.errors.append((number, 'Not a JSON object'))
+                continue
+            try:
+                _check_values(row)
+                objects.append(importer.build(row))
+            except ValidationError as e:
+                result.errors.append((number, '; '.join(_messages(e))))
+        with transaction.atomic():
+            created = importer.model.objects.bulk_create(objects)
+            importer.finish(created)
+        result.created += len(created)
+    importer.complete()
+    return result
+
+
+def _messages(error):
+    if hasattr(error, 'error_dict'):
+        return [f'{name}: {message}' for name, messages in error.message_dict.items() for message in messages]
+    return error.messages
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+
+def _strings(rows, column):
+    # For bulk lookups in prepare(); build() rejects rows with other types
+    return {row[column] for row in rows if isinstance(row.get(column), str) and row[column]}
+
+
+def _check_values(row):
+    # JSONL can nest lists and objects where a column expects one value
+    for column, value in row.items():
+        if value is not None and not isinstance(value, (str, int, float)):
+            raise ValidationError(f'{column}: expected a single value, got {type(value).__name__}')
+
+
+def _value(row, column):
+    # CSV has no null; an empty cell means no value
+    value = row.get(column)
+    return None if value == '' else value
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
@@ -5,6 +5,12 @@ app_name='housesApp'
 
 urlpatterns = [
     path('', views.home, name='home'),
+    path('api/houses/', views.houses_api, name='houses_api'),
+    path('api/houses/nearby/', views.nearby_api, name='nearby_api'),
+    path('api/export/<str:kind>.<str:fmt>', views.export_data, name='export_data'),
+    path('api/import/<str:kind>/', views.import_data, name='import_data'),
+    path('search/', views.search, name='search'),
+    path('api/search/', views.search_api, name='search_api'),
     path('house/<int:pk>/', views.house_detail, name='house_detail'),
     path('book/<int:pk>/', views.book_house, name='book_house'),
     path('login/', login_user, name='login'),
@@ -12,6 +18,7 @@ urlpatterns = [
     path('dashboard/', views.landlord_dashboard, name='dashboard'),
     path('payment/<int:booking_id>/', initiate_payment, name='initiate_payment'),
     path('payment/callback/', payment_callback, name='payment_callback'),
+    path('payment/<int:payment_id>/events/', views.payment_events, name='payment_events'),
 ]
 
 
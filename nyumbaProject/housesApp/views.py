@@ -1,27 +1,122 @@
-from django.shortcuts import render, get_object_or_404,redirect # type: ignore
+import io
+
+from django.shortcuts import render, get_object_or_404, aget_object_or_404, redirect # type: ignore
 from django.contrib.auth import login, authenticate # type: ignore
 from django.contrib.auth.forms import AuthenticationForm
 from django.contrib.auth.decorators import login_required # pyright: ignore[reportMissingModuleSource]
 from django.contrib import messages # type: ignore
-from django.http import JsonResponse
-from django.views.decorators.http import require_POST
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.views.decorators.http import require_GET, require_POST
 from django.views.decorators.csrf import csrf_exempt
 from django.db import models
-from .models import House, Booking, Payment
-from .forms import BookingForm, UserRegistrationForm, PaymentForm
+from .models import House, Booking, Payment, MpesaCallback
+from .forms import BookingForm, UserRegistrationForm, PaymentForm, ListingFilterForm, NearbyForm
+from .caching import house_version_key, query_signature, versioned_page, LISTINGS_VERSION_KEY
+from .facets import aget_facets, facet_links
+from .geo import nearby
+from .listings import aget_page, serialize_house
+from .stats import landlord_stats
+from .bookings import reserve_house
+from .callbacks import parse_callback, schedule_drain
+from .dispatch import adispatch_stk_push, arelease_push, areserve_push
+from .events import payment_event_stream
 from .mpesa_service import mpesa_service
-import json  
+from .ratelimit import acheck, check, client_ip, too_many_requests
+from .search import get_backend
+from .transfer import (
+    EXPORT_COLUMNS, FORMATS, IMPORTERS, HouseImporter,
+    aexport_lines, export_lines, export_queryset, format_for, import_rows, read_rows,
+)
 
 """
-shows a list of vacant houses
+shows one page of houses matching the tenant's filters
 """
-def home(request):
-    houses = House.objects.all().order_by('-id')
-    context = {'houses': houses}
+@versioned_page(lambda request: (f'home:{query_signature(request.GET)}', LISTINGS_VERSION_KEY))
+async def home(request):
+    filter_form = ListingFilterForm(request.GET)
+    filters = filter_form.cleaned_data if filter_form.is_valid() else {}
+    page = await aget_page(filters)
+    facets = await aget_facets(filters)
+
+    params = request.GET.copy()
+    params.pop('after', None)
+    first_query = params.urlencode() if filters.get('after') else None
+
+    next_query = None
+    if page.has_next:
+        params['after'] = page.next_cursor
+        next_query = params.urlencode()
+
+    context = {
+        'houses': page.houses,
+        'filter_form': filter_form,
+        'first_query': first_query,
+        'next_query': next_query,
+        'facets': facet_links(facets, request.GET),
+    }
     return render(request, 'housesApp/home.html', context)
 
-def house_detail(request, pk):
-    house = get_object_or_404(House, pk=pk)
+
+@require_GET
+async def houses_api(request):
+    """JSON listings endpoint backed by the same engine as the home page"""
+    filter_form = ListingFilterForm(request.GET)
+    if not filter_form.is_valid():
+        return JsonResponse({'errors': filter_form.errors}, status=400)
+
+    page = await aget_page(filter_form.cleaned_data)
+    results = []
+    for house in page.houses:
+        data = serialize_house(house, request)
+        data['url'] = reverse('housesApp:house_detail', args=[house.pk])
+        results.append(data)
+
+    return JsonResponse({'results': results, 'next': page.next_cursor})
+
+def search(request):
+    """Ranked full-text search over house titles, descriptions and locations"""
+    query = request.GET.get('q', '').strip()
+    results = get_backend().search(query) if query else []
+    context = {'query': query, 'results': results}
+    return render(request, 'housesApp/search.html', context)
+
+
+@require_GET
+def search_api(request):
+    """JSON version of search with ranks and highlighted snippets"""
+    query = request.GET.get('q', '').strip()
+    results = []
+    for result in get_backend().search(query):
+        data = serialize_house(result.house, request)
+        data['url'] = reverse('housesApp:house_detail', args=[result.house.pk])
+        data['rank'] = result.rank
+        data['snippet'] = result.snippet
+        results.append(data)
+    return JsonResponse({'query': query, 'results': results})
+
+
+@require_GET
+def nearby_api(request):
+    """Houses around ?lat=&lng=, nearest first, optionally within ?radius= km"""
+    form = NearbyForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+
+    data = form.cleaned_data
+    results = []
+    for result in nearby(data['lat'], data['lng'], data['radius'], data['limit'] or 20):
+        house = serialize_house(result.house, request)
+        house['url'] = reverse('housesApp:house_detail', args=[result.house.pk])
+        house['distance_km'] = round(result.distance_km, 3)
+        results.append(house)
+    return JsonResponse({'results': results})
+
+@versioned_page(lambda request, pk: (f'house:{pk}', house_version_key(pk)))
+async def house_detail(request, pk):
+    house = await aget_object_or_404(House, pk=pk)
     context = {'house': house}
     return render(request, 'housesApp/houses_details.html', context)
 
@@ -32,17 +127,16 @@ On successful booking, change house.status to 'occupied'.
 @login_required
 def book_house(request, pk):
     house = get_object_or_404(House, pk=pk)
-    if house.status != 'vacant':
-     return redirect('housesApp:home')
+    if house.status != House.STATUS_VACANT:
+        return redirect('housesApp:home')
     if request.method == 'POST':
         form = BookingForm(request.POST)
         if form.is_valid():
             booking = form.save(commit=False)
             booking.user = request.user
-            booking.house = house
-            booking.save()
-            house.status = 'occupied'
-            house.save()
+            if not reserve_house(house, booking):
+                messages.error(request, f'Sorry, {house.title} was just booked by someone else.')
+                return redirect('housesApp:home')
             messages.success(request, f'Successfully booked {house.title}!')
             return redirect('housesApp:dashboard')  
     else:
@@ -54,6 +148,9 @@ def book_house(request, pk):
 
 def login_user(request):
     if request.method == 'POST':
+        retry_after = check('login', ip=client_ip(request), username=request.POST.get('username', '').lower())
+        if retry_after:
+            return too_many_requests(request, retry_after, 'Too many sign-in attempts.')
         form = AuthenticationForm(request, data=request.POST)
         if form.is_valid():
             user = form.get_user()
@@ -69,6 +166,9 @@ def login_user(request):
 
 def register_user(request):
     if request.method == 'POST':
+        retry_after = check('register', ip=client_ip(request))
+        if retry_after:
+            return too_many_requests(request, retry_after, 'Too many accounts created from your network.')
         form = UserRegistrationForm(request.POST)  
         if form.is_valid():
             user = form.save()
@@ -89,54 +189,54 @@ def register_user(request):
 """
 @login_required
 def landlord_dashboard(request):
-    houses_qs = House.objects.filter(owner=request.user).order_by('-id')
+    houses_qs = House.objects.filter(owner=request.user).select_related('rollup').order_by('-id')
+    stats = landlord_stats(request.user)
 
-    stats = {
-        'total': houses_qs.count(),
-        'vacant': houses_qs.filter(status=House.STATUS_VACANT).count(),
-        'occupied': houses_qs.filter(status=House.STATUS_OCCUPIED).count(),
-    }
+    # A payment just initiated; the page follows it through payment_events
+    watch_payment = request.GET.get('payment', '')
+    if not watch_payment.isdigit():
+        watch_payment = None
 
-    context = {'houses': houses_qs, 'stats': stats}
+    context = {'houses': houses_qs, 'stats': stats, 'watch_payment': watch_payment}
     return render(request, 'housesApp/dashboard.html', context)
 
 
 @login_required
-def initiate_payment(request, booking_id):
-    """Initiate M-Pesa STK Push payment for a booking"""
-    booking = get_object_or_404(Booking, id=booking_id, user=request.user)
+async def initiate_payment(request, booking_id):
+    """Create a pending payment for a booking and queue its M-Pesa STK Push"""
+    user = await request.auser()
+    booking = await aget_object_or_404(Booking.objects.select_related('house'), id=booking_id, user=user)
     
     if request.method == 'POST':
         form = PaymentForm(request.POST)
         if form.is_valid():
             phone_number = form.cleaned_data['phone_number']
             phone_number = mpesa_service.format_phone_number(phone_number)
-            
-            # Create payment record
-            payment = Payment.objects.create(
-                booking=booking,
-                amount=booking.house.price,
-                phone_number=phone_number,
-                status=Payment.STATUS_PENDING
-            )
-            
-            # Initiate STK Push
-            result = mpesa_service.initiate_stk_push(
-                phone_number=phone_number,
-                amount=booking.house.price,
-                house_id=booking.house.id,
-                user_id=request.user.id
-            )
-            
-            if result['status'] == 'success':
-                payment.checkout_request_id = result.get('checkout_request_id')
-                payment.save()
-                messages.success(request, 'STK Push sent! Check your M-Pesa prompt')
-                return redirect('housesApp:dashboard')
-            else:
-                payment.status = Payment.STATUS_FAILED
-                payment.save()
-                messages.error(request, f"Payment failed: {result.get('message', 'Unknown error')}")
+
+            retry_after = await acheck('payment', user=user.pk, phone=phone_number, ip=client_ip(request))
+            if retry_after:
+                return too_many_requests(request, retry_after, 'Too many payment requests.')
+            # Shed load while Daraja is backed up instead of queueing pushes that would time out
+            if not await areserve_push():
+                return too_many_requests(
+                    request, settings.MPESA_BUSY_RETRY_AFTER, 'M-Pesa is busy right now.'
+                )
+
+            # Create payment record; the STK push is sent in the background
+            try:
+                payment = await Payment.objects.acreate(
+                    booking=booking,
+                    amount=booking.house.price,
+                    phone_number=phone_number,
+                    status=Payment.STATUS_PENDING
+                )
+            except Exception:
+                await arelease_push()
+                raise
+            await adispatch_stk_push(payment)
+
+            messages.success(request, 'Sending STK Push... Check your phone for the M-Pesa prompt')
+            return redirect(f"{reverse('housesApp:dashboard')}?payment={payment.pk}")
     else:
         form = PaymentForm()
     
@@ -148,60 +248,110 @@ def initiate_payment(request, booking_id):
     return render(request, 'housesApp/payment.html', context)
 
 
-@csrf_exempt
+@login_required
+@require_GET
+async def payment_events(request, payment_id):
+    """
+    Stream a payment's status as server-sent events until it settles
+
+    Replaces refreshing the dashboard; the stream waits on the events
+    broker, so it holds no thread or database connection while idle.
+    Needs ASGI: under WSGI Django would collect the whole stream before
+    sending any of it, holding a worker thread until the payment settles.
+    """
+    user = await request.auser()
+    if not await Payment.objects.filter(pk=payment_id, booking__user=user).aexists():
+        raise Http404('Payment not found')
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse('Live payment status needs the ASGI server', status=501)
+
+    return StreamingHttpResponse(
+        payment_event_stream(payment_id),
+        content_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
+@login_required
+@require_GET
+def export_data(request, kind, fmt):
+    """
+    Download houses, bookings or payments as CSV or JSONL
+
+    Staff get every row, landlords the rows for their own houses. Rows
+    are streamed a chunk at a time, so any size export runs in constant
+    memory under WSGI and ASGI alike.
+    """
+    if kind not in EXPORT_COLUMNS or fmt not in FORMATS:
+        raise Http404('Unknown export')
+
+    queryset = export_queryset(kind, request.user)
+    if isinstance(request, ASGIRequest):
+        content = aexport_lines(kind, fmt, queryset)
+    else:
+        content = export_lines(kind, fmt, queryset)
+    content_type = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return StreamingHttpResponse(content, content_type=f'{content_type}; charset=utf-8', headers={
+        'Content-Disposition': f'attachment; filename="{kind}.{fmt}"',
+    })
+
+
+@login_required
 @require_POST
-def payment_callback(request):
-    """M-Pesa payment callback endpoint"""
+def import_data(request, kind):
+    """
+    Load houses, bookings or payments from an uploaded CSV or JSONL `file`
+
+    Landlords may import houses, which become theirs; bookings, payments
+    and houses for other landlords need a staff account.
+    """
+    if kind not in IMPORTERS:
+        raise Http404('Unknown import')
+    upload = request.FILES.get('file')
+    if upload is None:
+        return JsonResponse({'error': 'Upload the rows as "file"'}, status=400)
+    if not request.user.is_staff and kind != 'houses':
+        return JsonResponse({'error': 'Only staff can import bookings and payments'}, status=403)
+
+    if kind == 'houses':
+        importer = HouseImporter(owner=None if request.user.is_staff else request.user)
+    else:
+        importer = IMPORTERS[kind]()
+    fmt = request.POST.get('format') or format_for(upload.name)
+    rows = read_rows(io.TextIOWrapper(upload.file, encoding='utf-8-sig', newline=''), fmt)
     try:
-        data = json.loads(request.body)
-        
-        # Extract callback data
-        result = data.get('Body', {}).get('stkCallback', {})
-        checkout_request_id = result.get('CheckoutRequestID')
-        result_code = result.get('ResultCode')
-        result_desc = result.get('ResultDesc')
-        
-        # Find payment
-        payment = Payment.objects.get(checkout_request_id=checkout_request_id)
-        
-        if result_code == 0:  # Success
-            # Extract M-Pesa receipt
-            callback_metadata = result.get('CallbackMetadata', {}).get('Item', [])
-            mpesa_receipt = None
-            for item in callback_metadata:
-                if item.get('Name') == 'MpesaReceiptNumber':
-                    mpesa_receipt = item.get('Value')
-                    break
-            
-            payment.status = Payment.STATUS_COMPLETED
-            payment.mpesa_receipt_number = mpesa_receipt
-            payment.save()
-            
-            # Mark booking as confirmed
-            booking = payment.booking
-            booking.save()
-            
-        else:  # Failed
-            payment.status = Payment.STATUS_FAILED
-            payment.save()
-        
-        # Return success response to Safaricom
-        return JsonResponse({
-            'ResultCode': 0,
-            'ResultDesc': 'Received successfully'
-        })
-    
-    except Payment.DoesNotExist:
-        return JsonResponse({
-            'ResultCode': 1,
-            'ResultDesc': 'Payment not found'
-        }, status=404)
-    except Exception as e:
-        print(f"Callback error: {e}")
+        result = import_rows(importer, rows)
+    except UnicodeDecodeError:
+        return JsonResponse({'error': 'File is not UTF-8 text'}, status=400)
+
+    return JsonResponse({
+        'created': result.created,
+        'error_count': len(result.errors),
+        'errors': [{'row': row, 'message': message} for row, message in result.errors[:100]],
+    })
+
+
+@csrf_exempt
+@require_POST
+async def payment_callback(request):
+    """
+    M-Pesa payment callback endpoint
+
+    Only stores the raw payload and acknowledges; the inbox worker in
+    callbacks.py applies it to the payment in batches.
+    """
+    payload = request.body.decode('utf-8', errors='replace')
+    if parse_callback(payload) is None:
         return JsonResponse({
             'ResultCode': 1,
-            'ResultDesc': str(e)
-        }, status=500)
-
+            'ResultDesc': 'Invalid callback payload'
+        }, status=400)
 
+    await MpesaCallback.objects.acreate(payload=payload)
+    schedule_drain()
 
+    # Return success response to Safaricom
+    return JsonResponse({
+        'ResultCode': 0,
+        'ResultDesc': 'Received successfully'
+    })
@@ -0,0 +1,199 @@
+"""
+Request Performance Metrics
+Per-request timings (SQL, templates, Daraja) and process-wide Prometheus
+histograms
+
+Timings for the request being handled live in a context variable, so they
+follow async views into sync_to_async threads. Everything is per process;
+scrape each worker separately.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.http import HttpResponse
+from django.template.backends.django import DjangoTemplates, Template
+from django.views.decorators.http import require_GET
+
+from housesApp.ratelimit import client_ip
+
+
+# Upper bounds in seconds, Prometheus client defaults
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_current = ContextVar('request_timings', default=None)
+
+
+@dataclass
+class RequestTimings:
+    sql_count: int = 0
+    sql_time: float = 0.0
+    template_time: float = 0.0
+    daraja_count: int = 0
+    daraja_time: float = 0.0
+
+
+def current_timings():
+    """Timings of the request being sampled, or None"""
+    return _current.get()
+
+
+def start_request():
+    timings = RequestTimings()
+    return timings, _current.set(timings)
+
+
+def end_request(token):
+    _current.reset(token)
+
+
+def metrics_enabled():
+    return getattr(settings, 'METRICS_SAMPLE_RATE', 0) > 0
+
+
+class Histogram:
+    """Cumulative-bucket histogram keyed by a tuple of label values"""
+
+    def __init__(self, name, documentation, labels, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # one counter per bucket plus +Inf, then the running sum
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def collect(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            snapshot = {labels: list(series) for labels, series in self._series.items()}
+        for label_values, series in sorted(snapshot.items()):
+            base = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(self.labels, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series):
+                cumulative += count
+                le = 'le="%s"' % ('+Inf' if bound == float('inf') else repr(bound))
+                lines.append(f'{self.name}_bucket{{{_join(base, le)}}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{base}}} {series[-1]}')
+            lines.append(f'{self.name}_count{{{base}}} {cumulative}')
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _join(*parts):
+    return ','.join(part for part in parts if part)
+
+
+REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds', 'Wall time per request', ('view', 'method', 'status')
+)
+SQL_SECONDS = Histogram(
+    'http_request_sql_seconds', 'Time spent in SQL per request', ('view',)
+)
+SQL_QUERIES = Histogram(
+    'http_request_sql_queries', 'SQL queries per request', ('view',),
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200)
+)
+TEMPLATE_SECONDS = Histogram(
+    'http_request_template_seconds', 'Template render time per request', ('view',)
+)
+DARAJA_SECONDS = Histogram(
+    'daraja_request_duration_seconds', 'Outbound M-Pesa Daraja call time', ('endpoint',)
+)
+
+REGISTRY = [REQUEST_SECONDS, SQL_SECONDS, SQL_QUERIES, TEMPLATE_SECONDS, DARAJA_SECONDS]
+
+
+def render_prometheus():
+    """Every metric in the Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.collect())
+    return '\n'.join(lines) + '\n'
+
+
+def shows_server_timing(user):
+    """Whether a response to this user may carry the Server-Timing header"""
+    return getattr(settings, 'SERVER_TIMING_PUBLIC', False) or bool(user and user.is_staff)
+
+
+@require_GET
+def metrics_view(request):
+    """Prometheus scrape endpoint, for staff and METRICS_ALLOWED_IPS"""
+    if client_ip(request) not in getattr(settings, 'METRICS_ALLOWED_IPS', []) and not request.user.is_staff:
+        raise PermissionDenied
+    return HttpResponse(render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def observe_request(view, method, status, elapsed, timings):
+    REQUEST_SECONDS.observe((view, method, str(status)), elapsed)
+    SQL_SECONDS.observe((view,), timings.sql_time)
+    SQL_QUERIES.observe((view,), timings.sql_count)
+    TEMPLATE_SECONDS.observe((view,), timings.template_time)
+
+
+def observe_daraja(endpoint, elapsed):
+    """Record one outbound Daraja call, inside a request or not"""
+    timings = _current.get()
+    if timings is not None:
+        timings.daraja_count += 1
+        timings.daraja_time += elapsed
+    if metrics_enabled():
+        DARAJA_SECONDS.observe((endpoint,), elapsed)
+
+
+def sql_timer(execute, sql, params, many, context):
+    """connection.execute_wrapper that charges query time to the sampled request"""
+    timings = _current.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.sql_count += 1
+        timings.sql_time += time.perf_counter() - started
+
+
+def install_sql_timer(sender, connection, **kwargs):
+    """connection_created receiver adding sql_timer to every new connection"""
+    if sql_timer not in connection.execute_wrappers:
+        connection.execute_wrappers.append(sql_timer)
+
+
+class TimedTemplate(Template):
+    def render(self, context=None, request=None):
+        timings = _current.get()
+        if timings is None:
+            return super().render(context, request)
+        started = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            timings.template_time += time.perf_counter() - started
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """DjangoTemplates backend whose templates report their render time"""
+
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        template = super().get_template(template_name)
+        return TimedTemplate(template.template, self)
@@ -0,0 +1,168 @@
+"""
+Performance Instrumentation Middleware
+Times each sampled request and reports it as Server-Timing headers and
+Prometheus histograms (see nyumbaProject.metrics), and optionally logs
+N+1 query patterns (see nyumbaProject.nplusone), and routes read-only
+pages to database replicas (see nyumbaProject.replicas)
+"""
+import random
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db.backends.signals import connection_created
+from django.db import connections
+
+from . import metrics, replicas
+from .nplusone import NPlusOneDetector
+
+
+class PerformanceMiddleware:
+    """
+    Record view name, wall time, SQL, template and Daraja time per request
+
+    METRICS_SAMPLE_RATE is the fraction of requests measured. At 0 the
+    SQL hook is never installed and each request costs one comparison.
+    The Server-Timing header only goes to staff, or to everyone with
+    SERVER_TIMING_PUBLIC.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'METRICS_SAMPLE_RATE', 0)
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+        if self.sample_rate > 0:
+            connection_created.connect(metrics.install_sql_timer, dispatch_uid='metrics_sql_timer')
+            for connection in connections.all(initialized_only=True):
+                metrics.install_sql_timer(None, connection)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return self.get_response(request)
+
+        timings, token = metrics.start_request()
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            metrics.end_request(token)
+        return self.finish(request, response, timings, started, getattr(request, 'user', None))
+
+    async def __acall__(self, request):
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return await self.get_response(request)
+
+        timings, token = metrics.start_request()
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            metrics.end_request(token)
+        user = None
+        if not getattr(settings, 'SERVER_TIMING_PUBLIC', False) and hasattr(request, 'auser'):
+            user = await request.auser()
+        return self.finish(request, response, timings, started, user)
+
+    def finish(self, request, response, timings, started, user):
+        elapsed = time.perf_counter() - started
+        match = request.resolver_match
+        view = match.view_name if match else '<unresolved>'
+        metrics.observe_request(view, request.method, response.status_code, elapsed, timings)
+        # Query counts and timings say too much about the site to hand to anyone
+        if not metrics.shows_server_timing(user):
+            return response
+
+        entries = [
+            f'db;dur={timings.sql_time * 1000:.2f};desc="{timings.sql_count} queries"',
+            f'tpl;dur={timings.template_time * 1000:.2f}',
+        ]
+        if timings.daraja_count:
+            entries.append(f'daraja;dur={timings.daraja_time * 1000:.2f};desc="{timings.daraja_count} calls"')
+        entries.append(f'total;dur={elapsed * 1000:.2f}')
+        response['Server-Timing'] = ', '.join(entries)
+        return response
+
+
+class NPlusOneMiddleware:
+    """
+    Log queries repeated from one call site within a request
+
+    Only loaded when NPLUSONE_DETECTION is on; stack inspection on every
+    query is too slow for production traffic.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'NPLUSONE_DETECTION', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        with NPlusOneDetector() as detector:
+            response = self.get_response(request)
+        detector.report(self.label(request))
+        return response
+
+    async def __acall__(self, request):
+        with NPlusOneDetector() as detector:
+            response = await self.get_response(request)
+        detector.report(self.label(request))
+        return response
+
+    def label(self, request):
+        match = request.resolver_match
+        return match.view_name if match else request.path
+
+
+class ReplicaMiddleware:
+    """
+    Let read-only pages read from DATABASE_REPLICAS; pin writers to the primary
+
+    The choice is made in process_view, once the URL has resolved, so the
+    session and user lookups in earlier middleware always hit the primary.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        token = replicas.begin_request()
+        try:
+            response = self.get_response(request)
+            replicas.pin_if_written(request, response)
+        finally:
+            replicas.end_request(token)
+        return response
+
+    async def __acall__(self, request):
+        token = replicas.begin_request()
+        try:
+            response = await self.get_response(request)
+            replicas.pin_if_written(request, response)
+        finally:
+            replicas.end_request(token)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        replicas.choose_replica(request, request.resolver_match)
@@ -0,0 +1,94 @@
+"""
+N+1 Query Detector
+Counts identical SQL statements per call site while active and reports
+the ones repeated often enough to look like a query inside a loop
+"""
+import logging
+import os
+import sys
+from collections import Counter
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+
+logger = logging.getLogger(__name__)
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__)) + os.sep
+
+_active = ContextVar('nplusone_detector', default=None)
+
+
+def _record_query(execute, sql, params, many, context):
+    detector = _active.get()
+    if detector is not None:
+        detector.record(sql)
+    return execute(sql, params, many, context)
+
+
+def _install_wrapper(sender, connection, **kwargs):
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+def install():
+    """Hook every current and future database connection"""
+    connection_created.connect(_install_wrapper, dispatch_uid='nplusone_detector')
+    for connection in connections.all(initialized_only=True):
+        _install_wrapper(None, connection)
+
+
+def call_site():
+    """'path:line in function' of the innermost app frame running the query"""
+    base_dir = str(settings.BASE_DIR) + os.sep
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        # Skip this project package too: its middleware and hooks wrap every query
+        if filename.startswith(base_dir) and not filename.startswith(PROJECT_DIR):
+            return f'{os.path.relpath(filename, base_dir)}:{frame.f_lineno} in {frame.f_code.co_name}'
+        frame = frame.f_back
+    return '<unknown>'
+
+
+class NPlusOneDetector:
+    """
+    Context manager collecting repeated queries
+
+    Statements are compared with their parameters left out, so loading
+    the related row of each item in a list shows up as one statement run
+    once per item from the same line.
+
+        with NPlusOneDetector() as detector:
+            ...
+        detector.repeats()  # [(sql, call site, count)]
+    """
+
+    def __init__(self, threshold=None):
+        if threshold is None:
+            threshold = getattr(settings, 'NPLUSONE_THRESHOLD', 5)
+        self.threshold = threshold
+        self.counts = Counter()
+
+    def __enter__(self):
+        install()
+        self._token = _active.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _active.reset(self._token)
+
+    def record(self, sql):
+        self.counts[(sql, call_site())] += 1
+
+    def repeats(self):
+        return [
+            (sql, site, count) for (sql, site), count in self.counts.most_common()
+            if count >= self.threshold
+        ]
+
+    def report(self, label):
+        for sql, site, count in self.repeats():
+            logger.warning('Possible N+1 in %s: %d identical queries from %s: %s', label, count, site, sql)
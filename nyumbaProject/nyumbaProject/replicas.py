@@ -0,0 +1,112 @@
+"""
+Read Replica Routing
+Sends the queries of read-only pages to DATABASE_REPLICAS while every
+write, and every read anywhere else, stays on the primary
+
+ReplicaMiddleware marks a request as replica-safe when it is a GET for
+one of REPLICA_READ_VIEWS or an admin changelist, and the visitor hasn't
+written in the last REPLICA_PIN_SECONDS. After any write the response
+sets a short-lived cookie pinning that browser to the primary, so a
+booking followed by the dashboard always shows the booking.
+"""
+import random
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+
+PIN_COOKIE = 'pin_primary'
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Who is logged in, and with which session, must never lag behind
+PRIMARY_APPS = {'auth', 'sessions'}
+
+
+@dataclass
+class RequestDatabases:
+    replica: str = None  # alias reads go to, or None for the primary
+    wrote: bool = False
+
+
+_request = ContextVar('request_databases', default=None)
+
+
+def begin_request():
+    """Start tracking the current request's database use; returns a token for end_request"""
+    return _request.set(RequestDatabases())
+
+
+def end_request(token):
+    _request.reset(token)
+
+
+def current():
+    return _request.get()
+
+
+def replica_allowed(request, match):
+    """Whether this request may read from a replica"""
+    if request.method not in SAFE_METHODS or PIN_COOKIE in request.COOKIES:
+        return False
+    if match.namespace == 'admin':
+        return match.url_name.endswith('_changelist')
+    return match.view_name in getattr(settings, 'REPLICA_READ_VIEWS', ())
+
+
+def choose_replica(request, match):
+    """Send the rest of the request's reads to one replica, if it may use one"""
+    state = current()
+    replicas = getattr(settings, 'DATABASE_REPLICAS', [])
+    if state is not None and replicas and replica_allowed(request, match):
+        # One replica per request, so a page never mixes two replication lags
+        state.replica = random.choice(replicas)
+
+
+def pin_if_written(request, response):
+    """Keep a browser that just wrote on the primary until the replicas catch up"""
+    state = current()
+    if state is None or not getattr(settings, 'DATABASE_REPLICAS', []):
+        return
+    if state.wrote or request.method not in SAFE_METHODS:
+        response.set_cookie(
+            PIN_COOKIE, '1', max_age=getattr(settings, 'REPLICA_PIN_SECONDS', 5),
+            httponly=True, samesite='Lax'
+        )
+
+
+def replica_may_lag(version):
+    """
+    Whether this request reads a replica that may not have the change made
+    at `version` (a cache version, in microseconds since the epoch)
+    """
+    state = current()
+    if state is None or state.replica is None:
+        return False
+    return time.time() - version / 1_000_000 < getattr(settings, 'REPLICA_PIN_SECONDS', 5)
+
+
+class ReplicaRouter:
+    """Database router for DATABASE_REPLICAS; a no-op outside ReplicaMiddleware"""
+
+    def db_for_read(self, model, **hints):
+        state = current()
+        if state is None or state.replica is None or model._meta.app_label in PRIMARY_APPS:
+            return None
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        state = current()
+        if state is not None:
+            state.wrote = True
+        # Explicit, or Django would save an instance back to the replica it was read from
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        pool = {DEFAULT_DB_ALIAS, *getattr(settings, 'DATABASE_REPLICAS', [])}
+        if obj1._state.db in pool and obj2._state.db in pool:
+            return True
+        return None
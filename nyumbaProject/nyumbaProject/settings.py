@@ -10,8 +10,11 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -41,6 +44,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'nyumbaProject.middleware.PerformanceMiddleware',
+    'nyumbaProject.middleware.NPlusOneMiddleware',
+    'nyumbaProject.middleware.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -52,9 +58,21 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'nyumbaProject.urls'
 
+# Fraction of requests timed for Server-Timing headers and /metrics (0 turns it off)
+METRICS_SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', '0.01'))
+# Who may scrape /metrics besides staff: comma-separated client addresses
+METRICS_ALLOWED_IPS = [ip.strip() for ip in os.environ.get('METRICS_ALLOWED_IPS', '').split(',') if ip.strip()]
+# Server-Timing goes to staff only, unless this is on (e.g. while load testing)
+SERVER_TIMING_PUBLIC = os.environ.get('SERVER_TIMING_PUBLIC') == '1'
+
+# Log statements run NPLUSONE_THRESHOLD+ times from one line in a request (development only)
+NPLUSONE_DETECTION = os.environ.get('NPLUSONE_DETECTION') == '1'
+NPLUSONE_THRESHOLD = 5
+
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates that reports render time to PerformanceMiddleware
+        'BACKEND': 'nyumbaProject.metrics.TimedDjangoTemplates',
         'DIRS': [BASE_DIR / 'templates'],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -73,12 +91,137 @@ WSGI_APPLICATION = 'nyumbaProject.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# DATABASE_PROFILE picks the database:
+#   sqlite      development defaults (rollback journal, writers fail fast)
+#   sqlite-wal  SQLite tuned for concurrent readers and writers on one host
+#   postgres    PostgreSQL with persistent connections
+
+DATABASE_PROFILE = os.environ.get('DATABASE_PROFILE', 'sqlite')
+SQLITE_PATH = os.environ.get('SQLITE_PATH', BASE_DIR / 'db.sqlite3')
+
+if DATABASE_PROFILE == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': SQLITE_PATH,
+        }
+    }
+elif DATABASE_PROFILE == 'sqlite-wal':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': SQLITE_PATH,
+            'OPTIONS': {
+                # busy_timeout: wait this many seconds for the write lock instead of failing
+                'timeout': 20,
+                # Take the write lock at BEGIN; upgrading a read lock mid-transaction
+                # fails immediately with "database is locked", whatever the timeout
+                'transaction_mode': 'IMMEDIATE',
+                # WAL lets readers run alongside the single writer; synchronous=NORMAL
+                # is durable in WAL mode except on power loss
+                'init_command': (
+                    'PRAGMA journal_mode=WAL;'
+                    'PRAGMA synchronous=NORMAL;'
+                    'PRAGMA mmap_size=268435456;'
+                    'PRAGMA cache_size=-65536;'
+                    'PRAGMA temp_store=MEMORY;'
+                ),
+            },
+        }
+    }
+elif DATABASE_PROFILE == 'postgres':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'nyumba'),
+            'USER': os.environ.get('POSTGRES_USER', 'nyumba'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            # Reuse each thread's connection across requests, checking it before reuse
+            'CONN_MAX_AGE': int(os.environ.get('CONN_MAX_AGE', 600)),
+            'CONN_HEALTH_CHECKS': True,
+            # QuerySet.iterator() streams through server-side cursors; they don't
+            # survive PgBouncer in transaction pooling mode
+            'DISABLE_SERVER_SIDE_CURSORS': os.environ.get('PGBOUNCER') == '1',
+        }
     }
+else:
+    raise ImproperlyConfigured(f"Unknown DATABASE_PROFILE {DATABASE_PROFILE!r}")
+
+# Read replicas of default, kept current by replication outside Django: a
+# comma-separated list of database files (sqlite profiles) or hosts
+# (postgres), added as replica1, replica2, ... Only REPLICA_READ_VIEWS and
+# admin changelists read from them (nyumbaProject.replicas).
+DATABASE_REPLICAS = []
+for number, location in enumerate(filter(None, os.environ.get('DATABASE_REPLICAS', '').split(',')), start=1):
+    alias = f'replica{number}'
+    DATABASES[alias] = {**DATABASES['default'], 'TEST': {'MIRROR': 'default'}}
+    DATABASES[alias]['NAME' if DATABASE_PROFILE.startswith('sqlite') else 'HOST'] = location.strip()
+    DATABASE_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['nyumbaProject.replicas.ReplicaRouter']
+
+REPLICA_READ_VIEWS = {
+    'housesApp:home', 'housesApp:houses_api', 'housesApp:house_detail',
+    'housesApp:search', 'housesApp:search_api', 'housesApp:nearby_api', 'housesApp:dashboard',
 }
+# Longest replication lag expected: browsers stay on the primary this long after
+# writing, and pages changed more recently than this aren't cached from a replica
+REPLICA_PIN_SECONDS = 5
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# Set REDIS_URL so every worker process shares one cache (M-Pesa tokens etc.)
+
+REDIS_URL = os.environ.get('REDIS_URL')
+
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Where sessions and request.user come from on each logged-in request:
+#   db: a django_session row and an auth_user row per request (Django's defaults)
+#   cached: cached_db sessions and CachedModelBackend users, both read through
+#           the cache and written through to the database
+#   cookie: sessions in a signed cookie (no server-side store) and cached users
+# ModelBackend stays listed so sessions started under `db` keep working.
+# cached and cookie need REDIS_URL: saving a user forgets its cached copy only
+# in the cache it can reach, and a per-process LocMemCache would leave the
+# other workers serving the old user (and its old password hash) for up to
+# USER_CACHE_TIMEOUT.
+SESSION_PROFILE = os.environ.get('SESSION_PROFILE', 'db')
+SESSION_PROFILES = {
+    'db': ('django.contrib.sessions.backends.db', ['django.contrib.auth.backends.ModelBackend']),
+    'cached': ('django.contrib.sessions.backends.cached_db', [
+        'housesApp.auth_backends.CachedModelBackend', 'django.contrib.auth.backends.ModelBackend',
+    ]),
+    'cookie': ('django.contrib.sessions.backends.signed_cookies', [
+        'housesApp.auth_backends.CachedModelBackend', 'django.contrib.auth.backends.ModelBackend',
+    ]),
+}
+if SESSION_PROFILE not in SESSION_PROFILES:
+    raise ImproperlyConfigured(f"Unknown SESSION_PROFILE {SESSION_PROFILE!r}")
+SESSION_ENGINE, AUTHENTICATION_BACKENDS = SESSION_PROFILES[SESSION_PROFILE]
+if 'housesApp.auth_backends.CachedModelBackend' in AUTHENTICATION_BACKENDS and not REDIS_URL:
+    raise ImproperlyConfigured(f"SESSION_PROFILE {SESSION_PROFILE!r} caches users, so it needs REDIS_URL")
+USER_CACHE_TIMEOUT = 300  # seconds; saving a user forgets the cached copy sooner
+
+# Pub/sub behind the live payment status stream; Redis reaches every worker process
+EVENTS_BACKEND = 'housesApp.events.RedisBroker' if REDIS_URL else 'housesApp.events.LocalBroker'
+EVENTS_KEEPALIVE = 15  # seconds between comments on an idle event stream
+EVENTS_MAX_AGE = 300  # seconds before a stream ends and the browser reconnects
 
 
 # Password validation
@@ -122,7 +265,6 @@ STATICFILES_DIRS=[
 STATIC_ROOT = BASE_DIR / "staticfiles"
 
 # Media files (User uploads)
-import os
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
@@ -143,3 +285,46 @@ MPESA_CONSUMER_KEY = 'uqapRtNQY3TjkEf03evE0u9cTKeZjqaDQsGXmk4U1HSUaLSl'
 MPESA_CONSUMER_SECRET = 'fzQdooUO6DNQMVjsnc7TnEfCpId8UNqJLEArFGARVEedcwk80AauF0wUImmDX6mO' 
 MPESA_PASSKEY = 'bfb279f9aa9bdbcf158e97dd71a467cd2e0c893059b10f78e6b72ada1ed2c919'  
 MPESA_CALLBACK_URL = 'http://localhost:8000/mpesa/callback/'
+# Point MpesaService at a local Daraja stub (see `manage.py loadtest`); unset uses MPESA_ENVIRONMENT
+MPESA_BASE_URL = os.environ.get('MPESA_BASE_URL')
+MPESA_TOKEN_REFRESH_MARGIN = 300  # seconds before expiry to refresh the OAuth token
+MPESA_POOL_SIZE = 20  # keep-alive connections to Daraja per process
+MPESA_MAX_RETRIES = 3
+MPESA_TIMEOUTS = {'auth': (3.05, 10), 'stk_push': (3.05, 15), 'stk_query': (3.05, 15)}  # (connect, read) seconds
+
+# Seconds to keep facet counts; any house change retires them early
+FACET_CACHE_TIMEOUT = 300
+# Seconds to keep rendered home/house pages; same early invalidation
+PAGE_CACHE_TIMEOUT = 600
+
+# Background dispatcher for STK pushes and other outbound work
+DISPATCH_WORKERS = 8
+DISPATCH_EAGER = False  # run jobs inline after commit (tests)
+
+# Apply stored M-Pesa callbacks on the dispatcher as they arrive. Set to False
+# when a dedicated `manage.py process_callbacks --loop` worker is running.
+MPESA_CALLBACK_AUTO_APPLY = True
+
+# `manage.py reconcile_payments`: STK-query payments still pending after this many seconds
+MPESA_RECONCILE_AFTER = 300
+MPESA_RECONCILE_BATCH_SIZE = 200
+MPESA_RECONCILE_WORKERS = 8
+MPESA_QUERY_RATE = 5  # STK queries per second, kept under Daraja's rate limit
+
+# Most STK pushes waiting on Daraja, across every worker with Redis (per process
+# without); past it initiate_payment answers 429 with Retry-After instead of
+# queueing the push until it times out
+MPESA_MAX_INFLIGHT_PUSHES = 200
+MPESA_PUSH_SLOT_TIMEOUT = 60  # seconds before a slot held by a dead worker is reclaimed
+MPESA_BUSY_RETRY_AFTER = 5  # seconds
+
+# Token buckets per view and key: 'N/period' lets N through at once and refills
+# evenly over the period (s, m, h or d). DISABLE_RATE_LIMITS=1 turns them off,
+# e.g. for `manage.py loadtest`, which sends every flow from one address.
+RATE_LIMITS = {} if os.environ.get('DISABLE_RATE_LIMITS') == '1' else {
+    'login': {'ip': '20/m', 'username': '5/m'},
+    'register': {'ip': '10/h'},
+    'payment': {'user': '5/m', 'phone': '3/m', 'ip': '30/m'},
+}
+# Request header holding the client address behind a reverse proxy, e.g. 'HTTP_X_FORWARDED_FOR'
+RATE_LIMIT_IP_HEADER = os.environ.get('RATE_LIMIT_IP_HEADER')
@@ -0,0 +1,17 @@
+"""
+Settings for the test suite:
+
+    python manage.py test --settings=nyumbaProject.test_settings
+
+Adds replica1 as a second, separate test database for ReplicaRoutingTests.
+Reads stay on the primary except in tests that turn DATABASE_REPLICAS on.
+"""
+from .settings import *  # noqa: F401,F403
+from .settings import DATABASES
+
+
+DATABASE_REPLICAS = []
+DATABASES = {
+    'default': DATABASES['default'],
+    'replica1': {**DATABASES['default'], 'NAME': f"{DATABASES['default']['NAME']}-replica1"},
+}